@@ -43,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Server-Timing header and /metrics histograms, first so it times everything below
+    'spotify.metrics.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -124,3 +126,112 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Spotify upstream HTTP client
+# Connections are pooled and kept alive per worker process (see spotify/client.py)
+
+SPOTIFY_HTTP_POOL_CONNECTIONS = 10
+SPOTIFY_HTTP_POOL_MAXSIZE = 20
+SPOTIFY_HTTP_CONNECT_TIMEOUT = 3.05
+SPOTIFY_HTTP_READ_TIMEOUT = 10
+SPOTIFY_HTTP_RETRIES = 2
+SPOTIFY_HTTP_BACKOFF = 0.3
+
+
+# Spotify response cache
+# Per-session LRU cache under execute_spotify_api_request (see spotify/cache.py).
+# TTLs are in seconds, a trailing '*' matches endpoints by prefix.
+
+SPOTIFY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+SPOTIFY_CACHE_TTLS = {
+    '': 60 * 60,
+    '/player/currently-playing': 5,
+    '/player/recently-played': 60,
+    '/top/*': 6 * 60 * 60,
+    '/playlists': 15 * 60,
+    '/following': 15 * 60,
+    '/tracks': 5 * 60,
+}
+
+
+# Spotify token cache
+# SpotifyToken rows are cached per worker for SPOTIFY_TOKEN_CACHE_TTL seconds.
+# Point SPOTIFY_TOKEN_CACHE_ALIAS at a shared CACHES alias (e.g. Redis) when
+# running several workers so refreshed tokens are visible to all of them.
+
+SPOTIFY_TOKEN_CACHE_TTL = 5 * 60
+SPOTIFY_TOKEN_CACHE_ALIAS = None
+
+# Tokens expiring within this many seconds are refreshed ahead of time, either by
+# `manage.py refresh_tokens --loop` or in the background on the next request.
+SPOTIFY_TOKEN_REFRESH_LEAD = 5 * 60
+
+
+# Offset-paginated endpoints fetch their remaining pages concurrently, at most
+# this many at a time per request (see spotify/pagination.py).
+SPOTIFY_PAGINATION_CONCURRENCY = 8
+
+# Connection limit of the async client used by the ASGI views
+SPOTIFY_HTTP_ASYNC_MAX_CONNECTIONS = 1000
+
+
+# Spotify rate limiting
+# One token bucket per client ID (see spotify/ratelimit.py): RATE requests per second
+# with bursts up to BURST. Bulk calls leave BULK_RESERVE tokens for interactive ones.
+# A 429 blocks the bucket for Retry-After seconds, the call is retried up to
+# MAX_RETRIES times unless Retry-After exceeds MAX_WAIT seconds.
+
+SPOTIFY_RATE_LIMIT_RATE = 10
+SPOTIFY_RATE_LIMIT_BURST = 20
+SPOTIFY_RATE_LIMIT_BULK_RESERVE = 5
+SPOTIFY_RATE_LIMIT_MAX_RETRIES = 2
+SPOTIFY_RATE_LIMIT_MAX_WAIT = 10
+
+# `manage.py sync_spotify library` only fetches tracks saved since the previous run,
+# and re-fetches the whole library (to catch removals) every this many seconds.
+SPOTIFY_LIBRARY_RECONCILE_INTERVAL = 24 * 60 * 60
+
+# Listening analytics keep each user's plays as NumPy columns in this CACHES alias,
+# appending new plays on every request and rebuilt from scratch after the TTL.
+SPOTIFY_ANALYTICS_CACHE_ALIAS = 'default'
+SPOTIFY_ANALYTICS_CACHE_TTL = 24 * 60 * 60
+
+# Taste-vector index behind /spotify/similar-users, updated by the catalog sync and
+# rebuilt with `manage.py build_taste_index`. Changing DIMENSIONS discards the index.
+SPOTIFY_TASTE_INDEX_DIR = BASE_DIR / 'taste_index'
+SPOTIFY_TASTE_DIMENSIONS = 1024
+
+# DRF renders and parses JSON with orjson when it's installed (spotify/renderers.py),
+# falling back to the stdlib json module otherwise
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'spotify.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'spotify.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
+# get-all-tokens reports the table's row count, cached this many seconds
+SPOTIFY_TOKEN_COUNT_CACHE_ALIAS = 'default'
+SPOTIFY_TOKEN_COUNT_TTL = 60
+
+# `manage.py sweep_tokens` deletes expired tokens whose refresh was rejected this
+# many times in a row, along with tokens whose session no longer exists
+SPOTIFY_TOKEN_MAX_REFRESH_FAILURES = 3
+
+# get-current-song/stream polls /player/currently-playing once per session: up to the
+# end of the current track but at most every PLAYING seconds, every PAUSED seconds
+# while paused and every IDLE seconds when nothing plays (see spotify/nowplaying.py)
+SPOTIFY_NOW_PLAYING_PLAYING_INTERVAL = 10
+SPOTIFY_NOW_PLAYING_PAUSED_INTERVAL = 20
+SPOTIFY_NOW_PLAYING_IDLE_INTERVAL = 60
+
+# ?enrich=1 fetches artist genres and images through the batch endpoints, 50 ids per
+# call, and keeps them per id (shared by all users) for this many seconds
+SPOTIFY_ENRICHMENT_CACHE_ALIAS = 'default'
+SPOTIFY_ENRICHMENT_CACHE_TTL = 24 * 60 * 60
@@ -15,9 +15,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from spotify.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'), #Prometheus metrics of this process
     path('', include('frontend.urls')), #Include frontend app urls
     path('spotify/', include('spotify.urls')), #Include sotify app urls
 ]
@@ -0,0 +1,75 @@
+"""Throughput of the sync (WSGI) views against their async (ASGI) versions.
+
+The sync side serves requests from a fixed pool of threads, as a threaded WSGI
+worker would. The async side runs every request on one event loop, as a single
+ASGI worker would. Both talk to the local fake API, run in its own process, with
+artificial latency standing in for the round trip to api.spotify.com.
+
+Usage: python benchmarks/bench_async.py [--requests 500] [--threads 8] [--latency 0.2]
+"""
+from common import setup_django, setup_database, make_session, login, FakeAPIProcess
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+setup_django()
+
+from django.test import AsyncClient, Client
+
+PATH = 'top-tracks?refresh=1'
+
+
+def run_sync(session_key, requests, threads):
+    def one(_):
+        client = login(Client(), session_key)
+        return client.get('/spotify/' + PATH).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = list(pool.map(one, range(requests)))
+    return time.perf_counter() - start, statuses
+
+
+def run_async(session_key, requests):
+    async def main():
+        client = login(AsyncClient(), session_key)
+        responses = await asyncio.gather(*(client.get('/spotify/async/' + PATH) for _ in range(requests)))
+        return [r.status_code for r in responses]
+
+    start = time.perf_counter()
+    statuses = asyncio.run(main())
+    return time.perf_counter() - start, statuses
+
+
+def report(name, requests, elapsed, statuses):
+    ok = sum(1 for s in statuses if s == 200)
+    print(f'{name:<28} {elapsed:7.3f}s   {requests / elapsed:8.1f} req/s   {ok}/{requests} ok')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    from django.conf import settings
+    settings.ALLOWED_HOSTS = ['*']
+    teardown = setup_database()
+
+    try:
+        with FakeAPIProcess('--latency', args.latency) as api:
+            session_key = make_session(api)
+
+            elapsed, statuses = run_sync(session_key, args.requests, args.threads)
+            report(f'sync, {args.threads} threads', args.requests, elapsed, statuses)
+
+            elapsed, statuses = run_async(session_key, args.requests)
+            report('async, 1 event loop', args.requests, elapsed, statuses)
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Compare per-call connections against the pooled keep-alive session.
+
+Usage: python benchmarks/bench_http_pool.py [--calls 300] [--threads 8]
+"""
+from common import setup_django
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+setup_django()
+
+import requests
+from spotify.client import get_session, get_timeout, reset_session
+from spotify.fakeapi import FakeSpotifyAPI
+
+
+def timed_calls(fetch, url, calls, threads):
+    latencies = []
+
+    def one(i):
+        start = time.perf_counter()
+        fetch(url, params={'limit': 50, 'offset': i % 3 * 50}, timeout=get_timeout()).json()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(calls)))
+    return time.perf_counter() - start, latencies
+
+
+def report(name, elapsed, latencies):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+    print(f'{name:<10} total {elapsed:7.3f}s   p50 {p50:6.2f}ms   p95 {p95:6.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with FakeSpotifyAPI() as api:
+        url = api.base_url + '/playlists'
+
+        reset_session()
+        timed_calls(get_session().get, url, args.threads, args.threads)  # warm the pool
+
+        elapsed, latencies = timed_calls(requests.get, url, args.calls, args.threads)
+        report('unpooled', elapsed, latencies)
+
+        elapsed, latencies = timed_calls(get_session().get, url, args.calls, args.threads)
+        report('pooled', elapsed, latencies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Render time of DRF's JSONRenderer against FastJSONRenderer for large playlist and
+followed-artist payloads, and parse time of the upstream pages they're built from.
+
+Usage: python benchmarks/bench_json.py [--items 10000] [--repeat 10]
+"""
+from common import setup_django
+import argparse
+import json
+import time
+
+setup_django()
+
+from rest_framework.renderers import JSONRenderer
+from spotify import fastjson
+from spotify.fakeapi import FakeLibrary, page
+from spotify.renderers import FastJSONRenderer
+from spotify.transforms import build_user_playlists, build_followed_artists
+
+
+def best_ms(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def compare(name, before, after, repeat):
+    old = best_ms(before, repeat)
+    new = best_ms(after, repeat)
+    print(f'{name:<28}{old:9.2f}{new:9.2f}{old / new:8.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    n = args.items
+    lib = FakeLibrary(playlists=n, followed_artists=n, artists=n)
+    playlist_pages = [json.dumps(page(lib.playlists, 50, offset)).encode() for offset in range(0, n, 50)]
+    artist_pages = [json.dumps({'artists': {'items': lib.followed[offset:offset + 50]}}).encode()
+                    for offset in range(0, n, 50)]
+    playlists = build_user_playlists([json.loads(body) for body in playlist_pages])
+    artists = build_followed_artists([json.loads(body) for body in artist_pages])
+
+    drf, fast = JSONRenderer(), FastJSONRenderer()
+    assert json.loads(drf.render(playlists)) == json.loads(fast.render(playlists))
+
+    print(f'{n} items, best of {args.repeat}, milliseconds (json = {"orjson" if fastjson.orjson else "stdlib"})')
+    print(f'{"":<28}{"before":>9}{"after":>9}{"speedup":>9}')
+    compare('render playlists', lambda: drf.render(playlists), lambda: fast.render(playlists), args.repeat)
+    compare('render followed artists', lambda: drf.render(artists), lambda: fast.render(artists), args.repeat)
+    compare('parse playlist pages', lambda: [json.loads(body) for body in playlist_pages],
+            lambda: [fastjson.loads(body) for body in playlist_pages], args.repeat)
+    compare('parse followed-artist pages', lambda: [json.loads(body) for body in artist_pages],
+            lambda: [fastjson.loads(body) for body in artist_pages], args.repeat)
+
+
+if __name__ == '__main__':
+    main()
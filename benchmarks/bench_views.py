@@ -0,0 +1,224 @@
+"""Latency, upstream calls, DB queries and peak memory per request of every URL in
+spotify/urls.py, driven through the Django test client against the local fake API
+(in its own process) for small, medium and huge libraries.
+
+Upstream calls are counted by the client hooks of spotify/metrics.py, DB queries
+from the Server-Timing header and on the request thread (streamed bodies run their
+queries after the header is sent), peak memory with tracemalloc on one extra request
+so it doesn't slow down the timed ones. The async views run on one event loop, as
+under an ASGI worker. The rate limiter is opened up, the benchmark measures the app,
+not the bucket.
+
+--save-baseline stores the results in benchmarks/baseline.json, --check compares
+them against it and exits with 1 when a URL regressed: a different status code,
+more upstream calls or DB queries than the baseline, or median latency / peak memory above it by more than
+the tolerance (p95 and p99 of millisecond views are too noisy to gate on). Latencies
+depend on the machine, regenerate the baseline where the check runs.
+
+Usage: python benchmarks/bench_views.py [--profiles small,medium,huge] [--requests 30]
+       [--only user-playlists,followed-artists] [--check | --save-baseline]
+"""
+from common import setup_django, setup_database, make_session, login, FakeAPIProcess
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+setup_django()
+
+from django.conf import settings
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext
+
+# Library sizes, as fake API arguments
+PROFILES = {
+    'small': {'playlists': 20, 'followed-artists': 20, 'saved-tracks': 50, 'artists': 100, 'plays': 50},
+    'medium': {'playlists': 500, 'followed-artists': 500, 'saved-tracks': 1000, 'artists': 1000, 'plays': 200},
+    'huge': {'playlists': 5000, 'followed-artists': 5000, 'saved-tracks': 10000, 'artists': 10000, 'plays': 1000},
+}
+
+# URL names left out, and why
+SKIPPED = {
+    'callback': 'exchanges an authorization code',
+    'current-song-stream': 'SSE, never ends under ASGI (one event under WSGI)',
+}
+
+# Query strings benchmarked besides each URL's default
+VARIANTS = [
+    'get-songs-history?source=local',
+    'top-tracks?source=local',
+    'top-tracks?enrich=1',
+    'last-saved-songs?all=1',
+    'last-saved-songs?source=local',
+    'user-playlists?stream=1',
+    'followed-artists?stream=1',
+    'get-all-tokens?export=1',
+]
+
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+LATENCY_SLACK_MS = 2
+MEMORY_SLACK_KB = 64
+
+
+def benchmark_paths():
+    from spotify.urls import urlpatterns
+
+    paths = [str(pattern.pattern) for pattern in urlpatterns if pattern.name not in SKIPPED]
+    return paths + VARIANTS
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+# Queries reported in a Server-Timing header ('db;dur=0.4;desc="3x"')
+def header_queries(response):
+    match = re.search(r'(?:^|, )db;dur=[\d.]+;desc="(\d+)x"', response.get('Server-Timing', ''))
+    return int(match.group(1)) if match else 0
+
+
+# Test clients of one session: (Client, AsyncClient, asyncio.Runner of the async views)
+def make_clients(session_key):
+    return login(Client(), session_key), login(AsyncClient(), session_key), asyncio.Runner()
+
+
+# One request, streamed bodies read to the end. Returns (status, seconds, DB queries).
+def timed_get(clients, url):
+    client, async_client, runner = clients
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        if url.startswith('/spotify/async/'):
+            response = runner.run(async_client.get(url))
+        else:
+            response = client.get(url)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        elapsed = time.perf_counter() - start
+    return response.status_code, elapsed, max(len(queries), header_queries(response))
+
+
+def measure(clients, path, requests):
+    from spotify.metrics import UPSTREAM_SECONDS
+
+    # ?refresh=1 so every request goes upstream instead of the response cache
+    url = '/spotify/' + path + ('&' if '?' in path else '?') + 'refresh=1'
+    status = timed_get(clients, url)[0]  # warm-up (compiled projections, shared caches)
+
+    upstream = UPSTREAM_SECONDS.count()
+    latencies, queries = [], []
+    for _ in range(requests):
+        _, elapsed, count = timed_get(clients, url)
+        latencies.append(elapsed * 1000)
+        queries.append(count)
+    upstream = (UPSTREAM_SECONDS.count() - upstream) / requests
+
+    tracemalloc.start()
+    try:
+        timed_get(clients, url)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'status': status,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'upstream': round(upstream, 2),
+        'queries': max(queries),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def run_profile(name, paths, requests):
+    from spotify.sync import sync_sessions
+
+    args = [arg for option, value in PROFILES[name].items() for arg in (f'--{option}', value)]
+    with FakeAPIProcess(*args) as api:
+        session_key = make_session(api)
+        # Stored catalog, plays and library for the ?source=local views and analytics
+        sync_sessions(['catalog', 'history', 'library'], [session_key])
+        clients = make_clients(session_key)
+
+        results = {}
+        try:
+            for path in paths:
+                results[path] = result = measure(clients, path, requests)
+                print(f'{path:<34}{result["status"]:>5}{result["p50_ms"]:9.2f}{result["p95_ms"]:9.2f}'
+                      f'{result["p99_ms"]:9.2f}{result["upstream"]:10.2f}{result["queries"]:9}{result["peak_kb"]:11.1f}')
+        finally:
+            clients[2].close()
+        return results
+
+
+# Regressions of `results` against `baseline`, as printable lines
+def regressions(profile, results, baseline, latency_tolerance, memory_tolerance):
+    found = []
+    for path, result in results.items():
+        base = baseline.get(path)
+        if base is None:
+            continue
+        if result['status'] != base['status']:
+            found.append(f'{profile} {path}: status {base["status"]} -> {result["status"]}')
+        for key in ('upstream', 'queries'):
+            if result[key] > base[key]:
+                found.append(f'{profile} {path}: {key} {base[key]} -> {result[key]}')
+        if result['p50_ms'] > base['p50_ms'] * (1 + latency_tolerance) + LATENCY_SLACK_MS:
+            found.append(f'{profile} {path}: p50 {base["p50_ms"]}ms -> {result["p50_ms"]}ms')
+        if result['peak_kb'] > base['peak_kb'] * (1 + memory_tolerance) + MEMORY_SLACK_KB:
+            found.append(f'{profile} {path}: peak memory {base["peak_kb"]}KB -> {result["peak_kb"]}KB')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', default='small,medium,huge')
+    parser.add_argument('--requests', type=int, default=30)
+    parser.add_argument('--only', help='Comma-separated paths to benchmark (default: all).')
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--latency-tolerance', type=float, default=0.5, help='Allowed p50 increase (0.5 = +50%%).')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='Allowed peak memory increase.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--check', action='store_true', help='Fail on regressions against the baseline.')
+    mode.add_argument('--save-baseline', action='store_true', help='Store the results as the baseline.')
+    args = parser.parse_args()
+
+    settings.ALLOWED_HOSTS = ['*']
+    settings.SPOTIFY_RATE_LIMIT_RATE = settings.SPOTIFY_RATE_LIMIT_BURST = 10 ** 6
+    settings.SPOTIFY_TASTE_INDEX_DIR = tempfile.mkdtemp()
+    teardown = setup_database()
+
+    paths = args.only.split(',') if args.only else benchmark_paths()
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    found = []
+    try:
+        for profile in args.profiles.split(','):
+            print(f'\n{profile}: {args.requests} requests per URL, latency in ms')
+            print(f'{"":<34}{"status":>5}{"p50":>9}{"p95":>9}{"p99":>9}{"upstream":>10}{"queries":>9}{"peak KB":>11}')
+            results = run_profile(profile, paths, args.requests)
+            if args.check:
+                found += regressions(profile, results, baseline.get(profile, {}),
+                                     args.latency_tolerance, args.memory_tolerance)
+            baseline[profile] = {**baseline.get(profile, {}), **results} if args.only else results
+    finally:
+        teardown()
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(baseline, indent=1, sort_keys=True) + '\n')
+        print(f'\nBaseline written to {args.baseline}')
+    if args.check:
+        if found:
+            print('\nRegressions:\n  ' + '\n  '.join(found))
+            sys.exit(1)
+        print('\nNo regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
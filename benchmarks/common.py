@@ -0,0 +1,96 @@
+"""Shared setup for the benchmark scripts: Django, a throwaway database and a
+session whose tokens point at the local fake Spotify API."""
+from pathlib import Path
+import os
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'apisdjango.settings')
+
+
+def setup_django():
+    import django
+    django.setup()
+
+
+# Create an in-memory test database, returns a callable tearing it down
+def setup_database():
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+
+    def teardown():
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+    return teardown
+
+
+# Point the upstream URLs at `api` and store tokens for a new session
+def make_session(api):
+    from django.contrib.sessions.backends.db import SessionStore
+    from spotify import util
+
+    util.BASE_URL = api.base_url
+    util.TOKEN_URL = api.token_url
+
+    session = SessionStore()
+    session.create()
+    util.update_or_create_user_tokens(session.session_key, 'access', 'Bearer', 3600, 'refresh')
+    return session.session_key
+
+
+# Attach a session cookie to a (sync or async) test client
+def login(client, session_key):
+    from django.conf import settings
+    client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+    return client
+
+
+# Fake API in a separate process, so its CPU time doesn't compete with the
+# Django side for the GIL. Use as a context manager.
+class FakeAPIProcess:
+    def __init__(self, *args):
+        self.args = [str(a) for a in args]
+        self.process = None
+        self.port = None
+
+    @property
+    def root_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def base_url(self):
+        return self.root_url + '/v1/me'
+
+    @property
+    def token_url(self):
+        return self.root_url + '/api/token'
+
+    def __enter__(self):
+        import socket
+        import subprocess
+        import time
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+
+        root = Path(__file__).resolve().parent.parent
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'spotify.fakeapi', '--port', str(self.port)] + self.args,
+            cwd=root, stdout=subprocess.DEVNULL)
+
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=0.1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError('Fake Spotify API did not start')
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.wait()
@@ -0,0 +1,205 @@
+from .models import PlayHistory, TrackArtist
+from django.conf import settings
+from django.core.cache import caches
+import numpy as np
+import time
+
+# Listening analytics over the synced play history. Plays are kept as columns
+# (unix seconds, track code) plus track->artist and artist->genre pair arrays, so
+# every distribution is a bincount instead of a Python loop over plays. The columns
+# are cached per user and only plays stored since the last call are appended; artist
+# names and genres are read once per artist, so they refresh when the cache expires.
+# Genres come from the catalog: the history sync enriches played artists with them
+# (spotify/sync.py), genre_coverage is the share of plays the distribution covers.
+
+DAY = 24 * 60 * 60
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+TREND_WINDOWS = (7, 30)
+TOP_N = 10
+WEEKS = 12
+MAX_CACHED_RESULTS = 8
+
+
+def get_analytics_cache():
+    return caches[getattr(settings, 'SPOTIFY_ANALYTICS_CACHE_ALIAS', 'default')]
+
+
+def analytics_cache_key(tokens):
+    return f'spotify:analytics:{tokens.pk}'
+
+
+# Columnar listening data of one user
+class PlayColumns:
+    def __init__(self):
+        self.last_id = 0
+        self.played_at = np.empty(0, dtype=np.int64)
+        self.track = np.empty(0, dtype=np.int32)
+
+        self.track_ids = []
+        self.track_index = {}
+        self.credit_track = np.empty(0, dtype=np.int32)
+        self.credit_artist = np.empty(0, dtype=np.int32)
+
+        self.artist_ids = []
+        self.artist_names = []
+        self.artist_index = {}
+        self.genre_artist = np.empty(0, dtype=np.int32)
+        self.genre = np.empty(0, dtype=np.int32)
+        self.genre_names = []
+        self.genre_index = {}
+
+        self.results = {}
+
+    # Append plays stored after the last one seen. Returns how many were added.
+    def update(self, tokens):
+        plays = list(PlayHistory.objects.filter(token=tokens, id__gt=self.last_id)
+                     .order_by('id').values_list('id', 'played_at', 'track_id'))
+        if not plays:
+            return 0
+
+        ids, played_at, track_ids = zip(*plays)
+        unique_tracks, inverse = np.unique(np.array(track_ids, dtype=object), return_inverse=True)
+        new_tracks = [track_id for track_id in unique_tracks if track_id not in self.track_index]
+        self.add_tracks(new_tracks)
+        codes = np.array([self.track_index[track_id] for track_id in unique_tracks], dtype=np.int32)
+
+        self.played_at = np.concatenate([self.played_at,
+                                         np.array([int(moment.timestamp()) for moment in played_at], dtype=np.int64)])
+        self.track = np.concatenate([self.track, codes[inverse]])
+        self.last_id = ids[-1]
+        self.results = {}
+        return len(plays)
+
+    # Register tracks with their artist credits and the artists' genres
+    def add_tracks(self, track_ids):
+        for track_id in track_ids:
+            self.track_index[track_id] = len(self.track_ids)
+            self.track_ids.append(track_id)
+        if not track_ids:
+            return
+
+        credits = (TrackArtist.objects.filter(track_id__in=track_ids)
+                   .values_list('track_id', 'artist_id', 'artist__name', 'artist__genres'))
+        credit_track, credit_artist, genre_artist, genre = [], [], [], []
+        for track_id, artist_id, name, genres in credits:
+            artist = self.artist_index.get(artist_id)
+            if artist is None:
+                artist = self.artist_index[artist_id] = len(self.artist_ids)
+                self.artist_ids.append(artist_id)
+                self.artist_names.append(name)
+                for genre_name in genres or []:
+                    if genre_name not in self.genre_index:
+                        self.genre_index[genre_name] = len(self.genre_names)
+                        self.genre_names.append(genre_name)
+                    genre_artist.append(artist)
+                    genre.append(self.genre_index[genre_name])
+            credit_track.append(self.track_index[track_id])
+            credit_artist.append(artist)
+
+        self.credit_track = np.concatenate([self.credit_track, np.array(credit_track, dtype=np.int32)])
+        self.credit_artist = np.concatenate([self.credit_artist, np.array(credit_artist, dtype=np.int32)])
+        self.genre_artist = np.concatenate([self.genre_artist, np.array(genre_artist, dtype=np.int32)])
+        self.genre = np.concatenate([self.genre, np.array(genre, dtype=np.int32)])
+
+    # Plays per artist and per genre (a play counts for every credited artist and
+    # every genre of those artists) among the plays selected by `mask`
+    def artist_counts(self, mask):
+        track_plays = np.bincount(self.track[mask], minlength=len(self.track_ids))
+        return np.bincount(self.credit_artist, weights=track_plays[self.credit_track],
+                           minlength=len(self.artist_ids))
+
+    def genre_counts(self, artist_plays):
+        return np.bincount(self.genre, weights=artist_plays[self.genre_artist], minlength=len(self.genre_names))
+
+    # Share of the plays selected by `mask` with a credited artist whose genres are
+    # stored, the plays the genre distribution accounts for
+    def genre_coverage(self, mask):
+        if not mask.any():
+            return None
+        has_genres = np.bincount(self.genre_artist, minlength=len(self.artist_ids)) > 0
+        covered = np.bincount(self.credit_track, weights=has_genres[self.credit_artist],
+                              minlength=len(self.track_ids)) > 0
+        return round(float(covered[self.track[mask]].mean()), 3)
+
+    def top_artists(self, artist_plays, n=TOP_N):
+        return [{'id':self.artist_ids[i], 'name':self.artist_names[i], 'plays':int(artist_plays[i])}
+                for i in top_indices(artist_plays, n)]
+
+    def top_genres(self, genre_plays, n=TOP_N):
+        return [{'genre':self.genre_names[i], 'plays':int(genre_plays[i])} for i in top_indices(genre_plays, n)]
+
+    # Distributions over the last `days` days (all plays when None), times in UTC
+    def summarize(self, now, days=None):
+        mask = self.played_at >= now - days * DAY if days is not None else np.ones(len(self.played_at), dtype=bool)
+        played_at = self.played_at[mask]
+        artist_plays = self.artist_counts(mask)
+
+        hours = (played_at // 3600) % 24
+        weekdays = (played_at // DAY + 3) % 7  # 1970-01-01 was a Thursday, Monday is 0
+        heatmap = np.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+
+        return {
+            'plays':int(mask.sum()),
+            'top_artists':self.top_artists(artist_plays),
+            'top_genres':self.top_genres(self.genre_counts(artist_plays)),
+            'genre_coverage':self.genre_coverage(mask),
+            'hour_of_day':heatmap.sum(axis=0).tolist(),
+            'day_of_week':heatmap.sum(axis=1).tolist(),
+            'heatmap':heatmap.tolist(),
+        }
+
+    # Plays and top artists of each window against the window before it, plus the
+    # weekly play counts of the last WEEKS weeks (oldest first)
+    def trends(self, now):
+        age = now - self.played_at
+        trends = {}
+        for days in TREND_WINDOWS:
+            current = age < days * DAY
+            previous = (age >= days * DAY) & (age < 2 * days * DAY)
+            plays, before = int(current.sum()), int(previous.sum())
+            trends[f'{days}d'] = {
+                'plays':plays,
+                'previous_plays':before,
+                'change':round((plays - before) / before, 3) if before else None,
+                'top_artists':self.top_artists(self.artist_counts(current), 5),
+            }
+
+        weeks = age[(age >= 0) & (age < WEEKS * 7 * DAY)] // (7 * DAY)
+        trends['weekly_plays'] = np.bincount(weeks, minlength=WEEKS)[::-1].tolist()
+        return trends
+
+
+# Indices of the n largest counts, largest first, zero counts left out
+def top_indices(counts, n):
+    if not len(counts):
+        return []
+    n = min(n, len(counts))
+    top = np.argpartition(-counts, n - 1)[:n]
+    top = top[np.argsort(-counts[top], kind='stable')]
+    return [int(i) for i in top if counts[i] > 0]
+
+
+# Analytics of a user's stored plays over the last `days` days (all time when None).
+# Cached with the columns, recomputed when new plays have been stored and at least
+# hourly since the windows move with the clock. Results of earlier hours are dropped
+# and at most MAX_CACHED_RESULTS values of `days` are kept, oldest out first.
+def listening_analytics(tokens, days=None) -> dict:
+    if days is not None and days < 1:
+        raise ValueError('days must be at least 1.')
+
+    cache = get_analytics_cache()
+    key = analytics_cache_key(tokens)
+    columns = cache.get(key) or PlayColumns()
+
+    columns.update(tokens)
+    now = int(time.time())
+    hour = now // 3600
+    result = columns.results.get(days)
+    if result is None or result[0] != hour:
+        results = {cached: value for cached, value in columns.results.items() if value[0] == hour and cached != days}
+        while len(results) >= MAX_CACHED_RESULTS:
+            del results[next(iter(results))]
+        result = results[days] = (hour, {**columns.summarize(now, days), 'trends':columns.trends(now)})
+        columns.results = results
+        cache.set(key, columns, getattr(settings, 'SPOTIFY_ANALYTICS_CACHE_TTL', DEFAULT_CACHE_TTL))
+    return result[1]
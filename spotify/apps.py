@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class SpotifyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'spotify'
+
+    # Time DB queries into the request metrics (see spotify/metrics.py)
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from .metrics import instrument_connection
+
+        connection_created.connect(instrument_connection)
@@ -0,0 +1,132 @@
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from .serializers import SpotifyTokensSerializer
+from .util import aexecute_spotify_api_request, aget_valid_tokens, cache_bypassed, query_flag, requested_fields, normalized_requested
+from .pagination import afetch_offset_pages, afetch_cursor_pages
+from .enrichment import aenrich_pages
+from .transforms import *
+from .dashboard import abuild_dashboard, parse_sections
+from .nowplaying import stream_now_playing, now_playing_snapshot
+from .errors import upstream_errors
+
+# Async versions of the Spotify views. Under ASGI an upstream call only suspends the
+# coroutine, so one worker can hold many calls in flight instead of one per thread.
+# They return the same payloads as their APIView counterparts in views.py.
+
+
+# Show if current user current session is authenticated on spotify
+async def is_authenticated(request):
+    tokens = await aget_valid_tokens(request.session.session_key)
+    return JsonResponse({'status':tokens is not None,
+                         'tokens':SpotifyTokensSerializer(tokens).data})
+
+
+# Retrieve User Info
+@upstream_errors
+async def user_info(request):
+    response = await aexecute_spotify_api_request(request.session.session_key, "",
+                                                  bypass_cache=cache_bypassed(request))
+    return JsonResponse(build_user_info(response, requested_fields(request)))
+
+
+# Retrieving current playing song from Spotify API
+@upstream_errors
+async def current_song(request):
+    response = await aexecute_spotify_api_request(request.session.session_key, "/player/currently-playing",
+                                                  bypass_cache=cache_bypassed(request))
+    return JsonResponse(build_current_song(response, requested_fields(request)))
+
+
+# Now-playing changes as Server-Sent Events. All of a session's open streams share one
+# upstream poller (spotify/nowplaying.py). Served as a stream only under ASGI, a WSGI
+# worker would buffer the endless body forever, so there it answers one event.
+@upstream_errors
+async def current_song_stream(request):
+    session_id = request.session.session_key
+    if await aget_valid_tokens(session_id) is None:
+        return JsonResponse({'error':'Not authenticated.'}, status=401)
+
+    if isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(stream_now_playing(session_id), content_type='text/event-stream')
+    else:
+        response = HttpResponse(await now_playing_snapshot(session_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Get user last played songs
+@upstream_errors
+async def songs_history(request):
+    response = await aexecute_spotify_api_request(request.session.session_key, "/player/recently-played",
+                                                  bypass_cache=cache_bypassed(request))
+    enrich = query_flag(request, 'enrich')
+    if enrich:
+        response = (await aenrich_pages(request.session.session_key, [response], 'track'))[0]
+    return JsonResponse(build_songs_history(response, requested_fields(request), normalized_requested(request), enrich))
+
+
+# Get user top Artists & Top Genres
+@upstream_errors
+async def top_artists(request):
+    response = await aexecute_spotify_api_request(request.session.session_key, "/top/artists",
+                                                  bypass_cache=cache_bypassed(request))
+    return JsonResponse(build_top_artists(response, requested_fields(request)))
+
+
+# Get user top tracks
+@upstream_errors
+async def top_tracks(request):
+    response = await aexecute_spotify_api_request(request.session.session_key, "/top/tracks",
+                                                  bypass_cache=cache_bypassed(request))
+    enrich = query_flag(request, 'enrich')
+    if enrich:
+        response = (await aenrich_pages(request.session.session_key, [response]))[0]
+    return JsonResponse(build_top_tracks(response, requested_fields(request), normalized_requested(request), enrich))
+
+
+# Get user last saved songs (?all=1 returns the whole library)
+@upstream_errors
+async def last_saved_songs(request):
+    user_session = request.session.session_key
+    endpoint = "/tracks"
+
+    if request.GET.get('all') in ('1', 'true'):
+        pages = await afetch_offset_pages(user_session, endpoint, page_size=50, bypass_cache=cache_bypassed(request))
+    else:
+        pages = [await aexecute_spotify_api_request(user_session, endpoint, params_={'limit':10},
+                                                    bypass_cache=cache_bypassed(request))]
+    enrich = query_flag(request, 'enrich')
+    if enrich:
+        pages = await aenrich_pages(user_session, pages, 'track')
+    return JsonResponse(build_saved_songs(pages, requested_fields(request), normalized_requested(request), enrich))
+
+
+# Get user seved playlists
+@upstream_errors
+async def user_playlists(request):
+    pages = await afetch_offset_pages(request.session.session_key, "/playlists", page_size=50,
+                                      bypass_cache=cache_bypassed(request))
+    return JsonResponse(build_user_playlists(pages, requested_fields(request)))
+
+
+# Get user followed artists
+@upstream_errors
+async def followed_artists(request):
+    pages = await afetch_cursor_pages(request.session.session_key, "/following", {'type':'artist','limit':50},
+                                      bypass_cache=cache_bypassed(request))
+    return JsonResponse(build_followed_artists(pages, requested_fields(request)))
+
+
+# All dashboard sections in one response, fetched concurrently (?sections= picks them)
+async def dashboard(request):
+    try:
+        sections = parse_sections(request.GET.get('sections'))
+    except ValueError as e:
+        return JsonResponse({'error':str(e)}, status=400)
+
+    dashboard = await abuild_dashboard(request.session.session_key, sections, bypass_cache=cache_bypassed(request))
+    if dashboard is None:
+        return JsonResponse({'error':'Not authenticated.'}, status=401)
+
+    return JsonResponse(dashboard)
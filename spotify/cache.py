@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from django.conf import settings
+import threading
+import time
+
+# Seconds each endpoint's response stays fresh. A trailing '*' matches by prefix,
+# endpoints without a TTL are never cached.
+DEFAULT_TTLS = {
+    '': 60 * 60,
+    '/player/currently-playing': 5,
+    '/player/recently-played': 60,
+    '/top/*': 6 * 60 * 60,
+    '/playlists': 15 * 60,
+    '/following': 15 * 60,
+    '/tracks': 5 * 60,
+}
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TOKEN_TTL = 5 * 60
+
+
+class CacheEntry:
+    __slots__ = ('value', 'etag', 'expires_at', 'size')
+
+    def __init__(self, value, etag, expires_at, size):
+        self.value = value
+        self.etag = etag
+        self.expires_at = expires_at
+        self.size = size
+
+    def is_fresh(self):
+        return time.monotonic() < self.expires_at
+
+
+# Process-local LRU cache of parsed upstream responses, bounded by body size
+class ResponseCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, etag, ttl, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = CacheEntry(value, etag, time.monotonic() + ttl, size)
+            self._by_user.setdefault(key[0], set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    # Mark a stale entry fresh again after the upstream answered 304 Not Modified
+    def revalidate(self, key, ttl):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires_at = time.monotonic() + ttl
+                self._entries.move_to_end(key)
+
+    # Drop every entry belonging to a session, or only those for one endpoint
+    def invalidate(self, session_id, endpoint=None):
+        with self._lock:
+            for key in list(self._by_user.get(session_id, ())):
+                if endpoint is None or key[1] == endpoint:
+                    self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
+
+# Build the cache key for a call, params are order independent
+def make_cache_key(session_id, endpoint, params):
+    return (session_id, endpoint, tuple(sorted((params or {}).items())))
+
+
+# Fresh lifetime for an endpoint, 0 if it shouldn't be cached
+def get_cache_ttl(endpoint):
+    ttls = getattr(settings, 'SPOTIFY_CACHE_TTLS', DEFAULT_TTLS)
+
+    if endpoint in ttls:
+        return ttls[endpoint]
+
+    best, ttl = -1, 0
+    for pattern, seconds in ttls.items():
+        if pattern.endswith('*') and endpoint.startswith(pattern[:-1]) and len(pattern) > best:
+            best, ttl = len(pattern), seconds
+    return ttl
+
+
+# Process-local cache of SpotifyToken rows keyed by session, optionally backed by a
+# shared Django cache so several workers see each other's refreshed tokens.
+# Callers never mutate cached instances, writers replace them (write-through).
+class TokenCache:
+    def __init__(self, ttl=DEFAULT_TOKEN_TTL, alias=None):
+        self.ttl = ttl
+        self.alias = alias
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        if self.alias is None:
+            return None
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def get(self, session_id):
+        with self._lock:
+            item = self._tokens.get(session_id)
+        if item is not None and time.monotonic() < item[1]:
+            return item[0]
+
+        shared = self.shared
+        if shared is not None:
+            tokens = shared.get(self.shared_key(session_id))
+            if tokens is not None:
+                self._set_local(session_id, tokens)
+                return tokens
+        return None
+
+    def set(self, session_id, tokens):
+        self._set_local(session_id, tokens)
+        shared = self.shared
+        if shared is not None:
+            shared.set(self.shared_key(session_id), tokens, self.ttl)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._tokens.pop(session_id, None)
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self.shared_key(session_id))
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def shared_key(self, session_id):
+        return f'spotify:tokens:{session_id}'
+
+    def _set_local(self, session_id, tokens):
+        with self._lock:
+            self._tokens[session_id] = (tokens, time.monotonic() + self.ttl)
+
+
+response_cache = ResponseCache(getattr(settings, 'SPOTIFY_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+token_cache = TokenCache(getattr(settings, 'SPOTIFY_TOKEN_CACHE_TTL', DEFAULT_TOKEN_TTL),
+                         getattr(settings, 'SPOTIFY_TOKEN_CACHE_ALIAS', None))
@@ -0,0 +1,283 @@
+from .models import Artist, Album, Track, TrackArtist, Playlist, SavedTrack, FollowedArtist, UserPlaylist, TopTrack, TopArtist, PlayHistory
+from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch
+from datetime import datetime, timezone
+
+# Ingestion of raw Spotify objects into the normalized catalog. Rows are written with
+# one bulk upsert per table, every artist/album/track is stored once however many
+# users reference it.
+
+ARTIST_FIELDS = ['name', 'url', 'genres', 'image_url', 'followers', 'popularity', 'updated_at']
+SIMPLE_ARTIST_FIELDS = ['name', 'url', 'updated_at']
+ENRICHED_ARTIST_FIELDS = ['name', 'url', 'genres', 'image_url', 'updated_at']
+ALBUM_FIELDS = ['name', 'url', 'image_url', 'updated_at']
+TRACK_FIELDS = ['name', 'url', 'album', 'duration_ms', 'popularity', 'updated_at']
+PLAYLIST_FIELDS = ['name', 'url', 'owner_name', 'owner_url', 'is_public', 'total_tracks', 'image_url', 'updated_at']
+
+
+def first_image_url(obj):
+    images = obj.get('images') or []
+    return (images[0].get('url') or '') if images else ''
+
+
+def spotify_url(obj):
+    return (obj.get('external_urls') or {}).get('spotify') or ''
+
+
+# Spotify timestamps, with or without fractional seconds ("2024-01-01T10:00:00.123Z")
+def parse_timestamp(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+# Insert or update rows by primary key, last occurrence wins within a batch
+def bulk_upsert(model, rows, update_fields):
+    rows = list({row.pk: row for row in rows}.values())
+    if rows:
+        model.objects.bulk_create(rows, update_conflicts=True, unique_fields=['id'],
+                                  update_fields=update_fields, batch_size=500)
+    return rows
+
+
+# Full artist objects (top artists, followed artists) update every column, the
+# simplified ones embedded in tracks only name and url so genres aren't wiped.
+def upsert_artists(artists, full=True):
+    rows = []
+    for artist in artists:
+        if not artist or not artist.get('id'):
+            continue
+        row = Artist(id=artist['id'], name=artist.get('name') or '', url=spotify_url(artist))
+        if full:
+            row.genres = artist.get('genres') or []
+            row.image_url = first_image_url(artist)
+            row.followers = (artist.get('followers') or {}).get('total')
+            row.popularity = artist.get('popularity')
+        rows.append(row)
+    return bulk_upsert(Artist, rows, ARTIST_FIELDS if full else SIMPLE_ARTIST_FIELDS)
+
+
+# Simplified artists enriched with their genres and images (spotify/enrichment.py)
+# update those too, followers and popularity are left as they are
+def upsert_enriched_artists(artists):
+    rows = [Artist(id=artist['id'], name=artist.get('name') or '', url=spotify_url(artist),
+                   genres=artist.get('genres') or [], image_url=first_image_url(artist))
+            for artist in artists if artist and artist.get('id')]
+    return bulk_upsert(Artist, rows, ENRICHED_ARTIST_FIELDS)
+
+
+def upsert_albums(albums):
+    rows = [Album(id=album['id'], name=album.get('name') or '', url=spotify_url(album),
+                  image_url=first_image_url(album))
+            for album in albums if album and album.get('id')]
+    return bulk_upsert(Album, rows, ALBUM_FIELDS)
+
+
+# Tracks with their albums, simplified artists and artist credits
+def upsert_tracks(tracks):
+    tracks = [track for track in tracks if track and track.get('id')]
+
+    upsert_albums(track.get('album') for track in tracks)
+    artists = [artist for track in tracks for artist in track.get('artists') or [] if isinstance(artist, dict)]
+    upsert_artists((artist for artist in artists if 'genres' not in artist), full=False)
+    upsert_enriched_artists(artist for artist in artists if 'genres' in artist)
+
+    rows = [Track(id=track['id'], name=track.get('name') or '', url=spotify_url(track),
+                  album_id=(track.get('album') or {}).get('id'),
+                  duration_ms=track.get('duration_ms'), popularity=track.get('popularity'))
+            for track in tracks]
+    rows = bulk_upsert(Track, rows, TRACK_FIELDS)
+
+    credits = [TrackArtist(track_id=track['id'], artist_id=artist['id'], position=position)
+               for track in tracks
+               for position, artist in enumerate(track.get('artists') or [])
+               if artist.get('id')]
+    TrackArtist.objects.bulk_create(credits, ignore_conflicts=True, batch_size=500)
+    return rows
+
+
+def upsert_playlists(playlists):
+    rows = [Playlist(id=playlist['id'], name=playlist.get('name') or '', url=spotify_url(playlist),
+                     owner_name=(playlist.get('owner') or {}).get('display_name') or '',
+                     owner_url=spotify_url(playlist.get('owner') or {}),
+                     is_public=playlist.get('public'),
+                     total_tracks=(playlist.get('tracks') or {}).get('total') or 0,
+                     image_url=first_image_url(playlist))
+            for playlist in playlists if playlist and playlist.get('id')]
+    return bulk_upsert(Playlist, rows, PLAYLIST_FIELDS)
+
+
+# Replace a user's top tracks snapshot for a time range
+@transaction.atomic
+def ingest_top_tracks(tokens, tracks, time_range='medium_term'):
+    rows = upsert_tracks(tracks)
+    TopTrack.objects.filter(token=tokens, time_range=time_range).delete()
+    TopTrack.objects.bulk_create([TopTrack(token=tokens, track_id=row.id, time_range=time_range, rank=rank)
+                                  for rank, row in enumerate(rows, start=1)])
+
+
+# Replace a user's top artists snapshot for a time range
+@transaction.atomic
+def ingest_top_artists(tokens, artists, time_range='medium_term'):
+    rows = upsert_artists(artists)
+    TopArtist.objects.filter(token=tokens, time_range=time_range).delete()
+    TopArtist.objects.bulk_create([TopArtist(token=tokens, artist_id=row.id, time_range=time_range, rank=rank)
+                                   for rank, row in enumerate(rows, start=1)])
+
+
+# Add /tracks items ({'added_at', 'track'}) to a user's saved library
+@transaction.atomic
+def ingest_saved_tracks(tokens, items):
+    items = [item for item in items if item.get('track') and item['track'].get('id')]
+    upsert_tracks(item['track'] for item in items)
+    SavedTrack.objects.bulk_create(
+        [SavedTrack(token=tokens, track_id=item['track']['id'], added_at=parse_timestamp(item['added_at']))
+         for item in items],
+        update_conflicts=True, unique_fields=['token', 'track'], update_fields=['added_at'], batch_size=500)
+
+
+# (track id, added_at) pairs of the given items already in a user's saved library
+def stored_saved_tracks(tokens, items):
+    track_ids = [item['track']['id'] for item in items if item.get('track') and item['track'].get('id')]
+    return set(SavedTrack.objects.filter(token=tokens, track_id__in=track_ids).values_list('track_id', 'added_at'))
+
+
+# Drop saved tracks no longer in the user's library
+def prune_saved_tracks(tokens, track_ids):
+    return SavedTrack.objects.filter(token=tokens).exclude(track_id__in=track_ids).delete()[0]
+
+
+# Replace the set of artists a user follows
+@transaction.atomic
+def ingest_followed_artists(tokens, artists):
+    rows = upsert_artists(artists)
+    FollowedArtist.objects.filter(token=tokens).exclude(artist_id__in=[row.id for row in rows]).delete()
+    FollowedArtist.objects.bulk_create([FollowedArtist(token=tokens, artist_id=row.id) for row in rows],
+                                       ignore_conflicts=True, batch_size=500)
+
+
+# Replace the set of playlists a user has saved
+@transaction.atomic
+def ingest_playlists(tokens, playlists):
+    rows = upsert_playlists(playlists)
+    UserPlaylist.objects.filter(token=tokens).exclude(playlist_id__in=[row.id for row in rows]).delete()
+    UserPlaylist.objects.bulk_create([UserPlaylist(token=tokens, playlist_id=row.id) for row in rows],
+                                     ignore_conflicts=True, batch_size=500)
+
+
+# Append /player/recently-played items ({'played_at', 'track'}) to a user's history,
+# plays already stored are skipped. Returns the number of items received.
+@transaction.atomic
+def ingest_plays(tokens, items):
+    items = [item for item in items if item.get('track') and item['track'].get('id')]
+    upsert_tracks(item['track'] for item in items)
+    PlayHistory.objects.bulk_create(
+        [PlayHistory(token=tokens, track_id=item['track']['id'], played_at=parse_timestamp(item['played_at']))
+         for item in items],
+        ignore_conflicts=True, batch_size=500)
+    return len(items)
+
+
+# Keyset cursor for a play, unix milliseconds like Spotify's own cursors
+def to_cursor(moment):
+    return str(int(moment.timestamp() * 1000))
+
+
+# ValueError for anything that isn't a representable moment, as for a non-number
+def from_cursor(cursor):
+    try:
+        return datetime.fromtimestamp(int(cursor) / 1000, tz=timezone.utc)
+    except (OverflowError, OSError):
+        raise ValueError(f'Cursor out of range: {cursor}')
+
+
+# Prefetch for a track's artists in credit order
+def track_artists_prefetch(prefix='track__'):
+    return Prefetch(prefix + 'credits', queryset=TrackArtist.objects.select_related('artist').order_by('position'))
+
+
+# Local payload of a stored track, same shape as build_top_tracks' items
+def local_track_info(track) -> dict:
+    return {
+        'name': track.name,
+        'artists':[{'name':credit.artist.name, 'profile_url':credit.artist.url} for credit in track.credits.all()],
+        'album':track.album.name if track.album else None,
+        'thumbnail':track.album.image_url if track.album else None,
+        'song_url':track.url,
+    }
+
+
+# Top tracks answered from the local store
+def local_top_tracks(tokens, time_range='medium_term') -> dict:
+    top = (TopTrack.objects.filter(token=tokens, time_range=time_range).order_by('rank')
+           .select_related('track__album').prefetch_related(track_artists_prefetch()))
+    return {'top_tracks':[local_track_info(row.track) for row in top]}
+
+
+# Top artists & top genres answered from the local store
+def local_top_artists(tokens, time_range='medium_term') -> dict:
+    top = TopArtist.objects.filter(token=tokens, time_range=time_range).order_by('rank').select_related('artist')
+
+    artists_list = []
+    all_genres = {}
+    for row in top:
+        artist = row.artist
+        artists_list.append({
+            'name':artist.name,
+            'artist_url':artist.url,
+            'genres':artist.genres,
+            'thumbnail':artist.image_url,
+            'followers':artist.followers,
+            'popularity':artist.popularity
+        })
+        for genre in artist.genres:
+            all_genres[genre] = all_genres.get(genre, 0) + 1
+
+    genres_list = [genre for genre, votes in sorted(all_genres.items(), key=lambda kv: kv[1], reverse=True)[:10]]
+    return {'top_artists':artists_list, 'top_genres':genres_list}
+
+
+# Stored listening history newest first, `limit` plays older than the `before`
+# cursor. The response carries the cursor of the next page (None on the last one).
+def local_songs_history(tokens, before=None, limit=50) -> dict:
+    plays = PlayHistory.objects.filter(token=tokens)
+    if before:
+        plays = plays.filter(played_at__lt=from_cursor(before))
+    plays = list(plays.order_by('-played_at').select_related('track__album')
+                 .prefetch_related(track_artists_prefetch())[:limit + 1])
+
+    track_list = []
+    for play in plays[:limit]:
+        track_info = local_track_info(play.track)
+        track_info['played_at'] = play.played_at
+        track_list.append(track_info)
+
+    next_cursor = to_cursor(plays[limit - 1].played_at) if len(plays) > limit else None
+    return {'last_played_songs':track_list, 'next':next_cursor}
+
+
+# Stored saved library newest first, optionally filtered by a text search over
+# track/album/artist names or by artist id. Pages are `limit` long, the `next`
+# cursor is "<added_at ms>_<row id>" since several tracks can share an added_at.
+def local_saved_songs(tokens, search=None, artist=None, before=None, limit=50) -> dict:
+    saved = SavedTrack.objects.filter(token=tokens)
+    if search:
+        saved = saved.filter(Q(track__name__icontains=search) | Q(track__album__name__icontains=search) |
+                             Q(track__credits__artist__name__icontains=search)).distinct()
+    if artist:
+        saved = saved.filter(track__credits__artist_id=artist)
+    if before:
+        moment, row_id = before.split('_')
+        moment = from_cursor(moment)
+        saved = saved.filter(Q(added_at__lt=moment) | Q(added_at=moment, id__lt=int(row_id)))
+    saved = list(saved.order_by('-added_at', '-id').select_related('track__album')
+                 .prefetch_related(track_artists_prefetch())[:limit + 1])
+
+    track_list = []
+    for row in saved[:limit]:
+        track_info = local_track_info(row.track)
+        track_info['added_at'] = row.added_at.strftime("%d-%m-%Y")
+        track_list.append(track_info)
+
+    last = saved[limit - 1] if len(saved) > limit else None
+    next_cursor = f'{to_cursor(last.added_at)}_{last.id}' if last else None
+    return {'saved_songs':track_list, 'next':next_cursor}
@@ -0,0 +1,123 @@
+from django.conf import settings
+from .metrics import observe_response, mark_request_start, observe_async_response
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import asyncio
+import httpx
+import threading
+import weakref
+
+# Defaults used when the project settings don't override them
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 20
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.3
+DEFAULT_ASYNC_MAX_CONNECTIONS = 1000
+
+_session = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+# Read a SPOTIFY_HTTP_* setting, falling back to the module default
+def get_client_setting(name, default):
+    return getattr(settings, f'SPOTIFY_HTTP_{name}', default)
+
+
+# Connect/read timeouts passed to every upstream call
+def get_timeout():
+    return (get_client_setting('CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+            get_client_setting('READ_TIMEOUT', DEFAULT_READ_TIMEOUT))
+
+
+# Build a session whose adapter keeps a pool of keep-alive connections per host.
+# Every response is timed into the request metrics (see spotify/metrics.py).
+def build_session():
+    retries = Retry(
+        total=get_client_setting('RETRIES', DEFAULT_RETRIES),
+        backoff_factor=get_client_setting('BACKOFF', DEFAULT_BACKOFF),
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'PUT']),
+        raise_on_status=False,
+        # 429 Retry-After is handled by the rate limiter, not inside the pool
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=get_client_setting('POOL_CONNECTIONS', DEFAULT_POOL_CONNECTIONS),
+        pool_maxsize=get_client_setting('POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE),
+        max_retries=retries,
+    )
+
+    session = Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(observe_response)
+    return session
+
+
+# Shared session for the current worker process, created on first use
+def get_session():
+    global _session
+
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+# Drop the shared session (used after settings change and by benchmarks)
+def reset_session():
+    global _session
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+# Async client with the same pool and timeout settings. An ASGI worker can keep far
+# more calls in flight than it has threads, hence the separate connection limit.
+def build_async_client():
+    connect_timeout, read_timeout = get_timeout()
+    limits = httpx.Limits(
+        max_connections=get_client_setting('ASYNC_MAX_CONNECTIONS', DEFAULT_ASYNC_MAX_CONNECTIONS),
+        max_keepalive_connections=get_client_setting('POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE),
+    )
+    transport = httpx.AsyncHTTPTransport(
+        limits=limits,
+        retries=get_client_setting('RETRIES', DEFAULT_RETRIES),
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        event_hooks={'request':[mark_request_start], 'response':[observe_async_response]},
+    )
+
+
+# Shared async client for the running event loop (clients can't cross loops). Under
+# ASGI the loop lives as long as the worker. Under WSGI asgiref runs each async view
+# on a loop of its own, so the client is closed with the loop: asyncio.run (and
+# asyncio.Runner) cancel the pending tasks before closing it, close_with_loop among them.
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(loop)
+    if entry is None or entry[0].is_closed:
+        client = build_async_client()
+        entry = _async_clients[loop] = (client, loop.create_task(close_with_loop(client)))
+    return entry[0]
+
+
+# Hold the client open until the task is cancelled at loop shutdown. The entry goes
+# too, its task keeps the loop alive otherwise.
+async def close_with_loop(client):
+    try:
+        await asyncio.Event().wait()
+    finally:
+        loop = asyncio.get_running_loop()
+        if _async_clients.get(loop, (None,))[0] is client:
+            del _async_clients[loop]
+        await client.aclose()
@@ -0,0 +1,106 @@
+from .util import execute_spotify_api_request, aexecute_spotify_api_request, get_valid_tokens, aget_valid_tokens
+from .transforms import *
+from .metrics import in_request_context
+from .errors import SpotifyAPIError, error_message
+from django.db import connections
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sections of the composite dashboard: name -> (endpoint, params, transform)
+DASHBOARD_SECTIONS = {
+    'user_info': ("", {}, build_user_info),
+    'current_song': ("/player/currently-playing", {}, build_current_song),
+    'songs_history': ("/player/recently-played", {}, build_songs_history),
+    'top_artists': ("/top/artists", {}, build_top_artists),
+    'top_tracks': ("/top/tracks", {}, build_top_tracks),
+    'saved_songs': ("/tracks", {'limit':10}, lambda response: build_saved_songs([response])),
+}
+
+
+# Parse ?sections=a,b,c into known section names (all of them when empty).
+# Raises ValueError naming any unknown section.
+def parse_sections(value):
+    if not value:
+        return list(DASHBOARD_SECTIONS)
+
+    sections = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in sections if name not in DASHBOARD_SECTIONS]
+    if unknown:
+        raise ValueError(f"Unknown sections: {', '.join(unknown)}.")
+    return list(dict.fromkeys(sections))
+
+
+# Turn one section's upstream response into its payload, or an error message
+def build_section(name, response):
+    if 'error' in response:
+        error = response['error']
+        return None, error.get('message') if isinstance(error, dict) else error
+
+    try:
+        return DASHBOARD_SECTIONS[name][2](response), None
+    except Exception as e:
+        logger.warning('Dashboard section %s failed: %r', name, e)
+        return None, 'Unexpected response from Spotify.'
+
+
+# Merge section payloads, failed sections are listed under 'errors'
+def merge_sections(results):
+    dashboard = {}
+    errors = {}
+
+    for name, (payload, error) in results:
+        if error is None:
+            dashboard.update(payload)
+        else:
+            errors[name] = error
+
+    dashboard['errors'] = errors
+    return dashboard
+
+
+# Run every section's upstream call concurrently with a single token lookup
+def build_dashboard(session_id, sections, bypass_cache=False):
+    tokens = get_valid_tokens(session_id)
+    if tokens is None:
+        return None
+
+    def fetch(name):
+        endpoint, params, transform = DASHBOARD_SECTIONS[name]
+        try:
+            response = execute_spotify_api_request(session_id, endpoint, params_=params,
+                                                   bypass_cache=bypass_cache, tokens=tokens)
+        except SpotifyAPIError as e:
+            return name, (None, error_message(e))
+        except Exception as e:
+            logger.warning('Dashboard section %s failed: %r', name, e)
+            return name, (None, 'Spotify request failed.')
+        finally:
+            connections.close_all()
+        return name, build_section(name, response)
+
+    with ThreadPoolExecutor(max_workers=len(sections) or 1, thread_name_prefix='spotify-dashboard') as pool:
+        return merge_sections(pool.map(in_request_context(fetch), sections))
+
+
+# Async counterpart of build_dashboard
+async def abuild_dashboard(session_id, sections, bypass_cache=False):
+    tokens = await aget_valid_tokens(session_id)
+    if tokens is None:
+        return None
+
+    async def fetch(name):
+        endpoint, params, transform = DASHBOARD_SECTIONS[name]
+        try:
+            response = await aexecute_spotify_api_request(session_id, endpoint, params_=params,
+                                                          bypass_cache=bypass_cache, tokens=tokens)
+        except SpotifyAPIError as e:
+            return name, (None, error_message(e))
+        except Exception as e:
+            logger.warning('Dashboard section %s failed: %r', name, e)
+            return name, (None, 'Spotify request failed.')
+        return name, build_section(name, response)
+
+    return merge_sections(await asyncio.gather(*(fetch(name) for name in sections)))
@@ -0,0 +1,168 @@
+from .util import execute_spotify_api_request, aexecute_spotify_api_request, get_valid_tokens, aget_valid_tokens, get_api_root
+from .pagination import get_concurrency
+from .ratelimit import INTERACTIVE
+from .metrics import in_request_context
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+# Enrichment of track payloads with what simplified objects leave out: the genres and
+# images of artists, and the album of simplified tracks. The unique ids of a response
+# are looked up in a cache shared by every user, the others are fetched through the
+# batch endpoints (/artists?ids=, /tracks?ids=) in chunks of BATCH_SIZE, all chunks at
+# once, so N artists cost at most ceil(N / 50) upstream calls instead of N.
+
+BATCH_SIZE = 50
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
+# Fields kept from the full objects and merged into the simplified ones
+ENRICHED_FIELDS = {
+    'artists': ('genres', 'images'),
+    'tracks': ('album', 'popularity'),
+}
+
+
+def get_enrichment_cache():
+    return caches[getattr(settings, 'SPOTIFY_ENRICHMENT_CACHE_ALIAS', 'default')]
+
+
+def enrichment_cache_key(kind, object_id):
+    return f'spotify:{kind}:{object_id}'
+
+
+def chunked(ids, size=BATCH_SIZE):
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+# Unique ids of what needs enriching: artists without genres, tracks without an album
+def collect_ids(tracks) -> dict:
+    artist_ids, track_ids = {}, {}
+    for track in tracks:
+        for artist in track.get('artists') or []:
+            if isinstance(artist, dict) and artist.get('id') and 'genres' not in artist:
+                artist_ids[artist['id']] = None
+        if track.get('id') and not isinstance(track.get('album'), dict):
+            track_ids[track['id']] = None
+    return {'artists':list(artist_ids), 'tracks':list(track_ids)}
+
+
+# Cached objects by kind and id, and the (kind, chunk of ids) batches still to fetch
+def lookup_cached(wanted):
+    keys = {enrichment_cache_key(kind, object_id): (kind, object_id)
+            for kind, ids in wanted.items() for object_id in ids}
+    objects = {kind: {} for kind in wanted}
+    for key, obj in get_enrichment_cache().get_many(list(keys)).items():
+        kind, object_id = keys[key]
+        objects[kind][object_id] = obj
+
+    batches = []
+    for kind, ids in wanted.items():
+        batches += [(kind, chunk) for chunk in chunked([i for i in ids if i not in objects[kind]])]
+    return objects, batches
+
+
+# Keep the enriched fields of fetched objects, in `objects` and in the cache. Unknown
+# ids come back as null and error responses carry no objects, neither is cached.
+def store_fetched(objects, batches, responses):
+    fetched = {}
+    for (kind, _), response in zip(batches, responses):
+        for obj in (response or {}).get(kind) or []:
+            if isinstance(obj, dict) and obj.get('id'):
+                objects[kind][obj['id']] = fetched[enrichment_cache_key(kind, obj['id'])] = \
+                    {field: obj.get(field) for field in ENRICHED_FIELDS[kind]}
+    if fetched:
+        get_enrichment_cache().set_many(fetched, getattr(settings, 'SPOTIFY_ENRICHMENT_CACHE_TTL', DEFAULT_CACHE_TTL))
+    return objects
+
+
+# Enriched fields of the wanted objects ({kind: [ids]}) by kind and id
+def fetch_catalog(session_id, wanted, tokens=None, priority=INTERACTIVE) -> dict:
+    objects, batches = lookup_cached(wanted)
+    if not batches:
+        return objects
+
+    tokens = get_valid_tokens(session_id, tokens)
+    root = get_api_root()
+
+    def fetch(batch):
+        kind, ids = batch
+        return execute_spotify_api_request(session_id, f'/{kind}', params_={'ids':','.join(ids)},
+                                           tokens=tokens, priority=priority, base_url=root)
+
+    def fetch_in_thread(batch):
+        try:
+            return fetch(batch)
+        finally:
+            connections.close_all()
+
+    if len(batches) == 1:
+        responses = [fetch(batches[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(get_concurrency(), len(batches)),
+                                thread_name_prefix='spotify-enrich') as pool:
+            responses = list(pool.map(in_request_context(fetch_in_thread), batches))
+    return store_fetched(objects, batches, responses)
+
+
+# Async counterpart of fetch_catalog
+async def afetch_catalog(session_id, wanted, tokens=None) -> dict:
+    objects, batches = lookup_cached(wanted)
+    if not batches:
+        return objects
+
+    tokens = await aget_valid_tokens(session_id, tokens)
+    root = get_api_root()
+    limit = asyncio.Semaphore(get_concurrency())
+
+    async def fetch(batch):
+        kind, ids = batch
+        async with limit:
+            return await aexecute_spotify_api_request(session_id, f'/{kind}', params_={'ids':','.join(ids)},
+                                                      tokens=tokens, base_url=root)
+
+    return store_fetched(objects, batches, await asyncio.gather(*(fetch(batch) for batch in batches)))
+
+
+# Copy of a track with the enriched fields merged in (cached responses aren't mutated)
+def enrich_track(track, objects):
+    extra = objects['tracks'].get(track.get('id'))
+    track = {**track, **extra} if extra else dict(track)
+    track['artists'] = [{**artist, **objects['artists'].get(artist.get('id'), {})} if isinstance(artist, dict) else artist
+                        for artist in track.get('artists') or []]
+    return track
+
+
+def page_tracks(pages, track_path=None):
+    for response in pages:
+        for item in (response or {}).get('items') or []:
+            track = item.get(track_path) if track_path else item
+            if isinstance(track, dict):
+                yield track
+
+
+def enriched_pages(pages, objects, track_path=None) -> list:
+    enriched = []
+    for response in pages:
+        items = []
+        for item in (response or {}).get('items') or []:
+            track = item.get(track_path) if track_path else item
+            if isinstance(track, dict):
+                item = {**item, track_path:enrich_track(track, objects)} if track_path else enrich_track(item, objects)
+            items.append(item)
+        enriched.append({**response, 'items':items} if response else response)
+    return enriched
+
+
+# Copies of the pages of a track list with their tracks enriched, track_path locates
+# the track in an item (e.g. 'track' for recently played and saved tracks)
+def enrich_pages(session_id, pages, track_path=None, tokens=None, priority=INTERACTIVE) -> list:
+    objects = fetch_catalog(session_id, collect_ids(page_tracks(pages, track_path)), tokens, priority)
+    return enriched_pages(pages, objects, track_path)
+
+
+# Async counterpart of enrich_pages
+async def aenrich_pages(session_id, pages, track_path=None, tokens=None) -> list:
+    objects = await afetch_catalog(session_id, collect_ids(page_tracks(pages, track_path)), tokens)
+    return enriched_pages(pages, objects, track_path)
@@ -0,0 +1,60 @@
+from django.http import JsonResponse
+from functools import wraps
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+# Upstream failures surfaced by the views. They're DRF exceptions, so the APIViews
+# answer them with their status (and Retry-After) through the default exception
+# handler, the async views through the upstream_errors decorator.
+
+
+# An upstream error response. Spotify rejecting the user's token is passed on as a
+# 401, anything else is a 502.
+class SpotifyAPIError(APIException):
+    status_code = status.HTTP_502_BAD_GATEWAY
+    default_detail = 'Spotify request failed.'
+    default_code = 'spotify_error'
+
+    def __init__(self, message=None, upstream_status=None):
+        super().__init__({'error':message or self.default_detail})
+        if upstream_status == status.HTTP_401_UNAUTHORIZED:
+            self.status_code = status.HTTP_401_UNAUTHORIZED
+
+
+# Spotify still answered 429 after the last retry, wait is the Retry-After in seconds
+class SpotifyRateLimited(SpotifyAPIError):
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    default_detail = 'Rate limited by Spotify, try again later.'
+    default_code = 'spotify_rate_limited'
+
+    def __init__(self, wait=None):
+        super().__init__()
+        self.wait = wait
+
+
+# The response, or SpotifyAPIError for an upstream error response ({'error': ...})
+def check_response(response):
+    if isinstance(response, dict) and 'error' in response:
+        error = response['error']
+        if isinstance(error, dict):
+            raise SpotifyAPIError(error.get('message'), error.get('status'))
+        raise SpotifyAPIError(error)
+    return response
+
+
+def error_message(error):
+    return str(error.detail['error'])
+
+
+# Async view decorator answering upstream errors like the APIViews do
+def upstream_errors(view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        except SpotifyAPIError as e:
+            response = JsonResponse({'error':error_message(e)}, status=e.status_code)
+            if getattr(e, 'wait', None):
+                response['Retry-After'] = '%d' % e.wait
+            return response
+    return wrapper
@@ -0,0 +1,464 @@
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlencode, urlsplit
+from urllib.request import Request, urlopen
+import hashlib
+import json
+import threading
+import time
+
+# Local stand-in for api.spotify.com and accounts.spotify.com, used by the tests and
+# the benchmarks so every upstream path can be exercised without the real service.
+# Latency, the largest page served and injected 429s are configurable. With fixtures
+# it either records what a real upstream answers (upstream=...) or replays them.
+
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+# Synthetic, deterministic user library
+class FakeLibrary:
+    def __init__(self, playlists=120, followed_artists=120, saved_tracks=200, artists=300, albums=150, plays=50):
+        self.artists = [self.make_artist(i) for i in range(artists)]
+        self.albums = [self.make_album(i) for i in range(albums)]
+        self.tracks = [self.make_track(i) for i in range(max(saved_tracks, 100))]
+        self.playlists = [self.make_playlist(i) for i in range(playlists)]
+        self.followed = self.artists[:followed_artists] if followed_artists <= artists else \
+            [self.make_artist(i) for i in range(followed_artists)]
+        self.saved = [{
+            'added_at': (EPOCH - timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'track': self.tracks[i % len(self.tracks)],
+        } for i in range(saved_tracks)]
+        # Currently-playing response, None when nothing is playing (204)
+        self.now_playing = {'is_playing': True, 'progress_ms': 1000, 'item': self.tracks[0]}
+        self.plays = []
+        for i in reversed(range(plays)):
+            self.play(self.tracks[i % len(self.tracks)], EPOCH - timedelta(minutes=4 * i))
+
+    # Record a play (newest first), as listening would
+    def play(self, track, played_at):
+        self.plays.insert(0, (int(played_at.timestamp() * 1000), {
+            'track': track,
+            'played_at': played_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        }))
+
+    # Save a track to the library (newest first) or remove it, as the app would
+    def save(self, track, added_at):
+        self.unsave(track)
+        self.saved.insert(0, {'added_at': added_at.strftime("%Y-%m-%dT%H:%M:%SZ"), 'track': track})
+
+    def unsave(self, track):
+        self.saved = [item for item in self.saved if item['track']['id'] != track['id']]
+
+    def make_artist(self, i):
+        return {
+            'id': f'artist{i:06d}',
+            'name': f'Artist {i}',
+            'type': 'artist',
+            'external_urls': {'spotify': f'https://open.spotify.com/artist/artist{i:06d}'},
+            'genres': [f'genre {i % 17}', f'genre {i % 5 + 17}'],
+            'images': [{'url': f'https://i.scdn.co/image/artist{i}', 'height': 640, 'width': 640}],
+            'followers': {'total': 1000 + i * 37 % 100000},
+            'popularity': i * 7 % 100,
+        }
+
+    def make_album(self, i):
+        return {
+            'id': f'album{i:06d}',
+            'name': f'Album {i}',
+            'external_urls': {'spotify': f'https://open.spotify.com/album/album{i:06d}'},
+            'images': [{'url': f'https://i.scdn.co/image/album{i}', 'height': 640, 'width': 640}],
+        }
+
+    def make_track(self, i):
+        artist = self.artists[i % len(self.artists)]
+        return {
+            'id': f'track{i:06d}',
+            'name': f'Track {i}',
+            'duration_ms': 180000 + i % 60 * 1000,
+            'popularity': i * 13 % 100,
+            'external_urls': {'spotify': f'https://open.spotify.com/track/track{i:06d}'},
+            'artists': [{
+                'id': artist['id'],
+                'name': artist['name'],
+                'external_urls': artist['external_urls'],
+            }],
+            'album': self.albums[i % len(self.albums)],
+        }
+
+    def make_playlist(self, i):
+        return {
+            'id': f'playlist{i:06d}',
+            'name': f'Playlist {i}',
+            'public': i % 2 == 0,
+            'tracks': {'total': i * 11 % 500},
+            'external_urls': {'spotify': f'https://open.spotify.com/playlist/playlist{i:06d}'},
+            'owner': {
+                'display_name': 'Fake User',
+                'external_urls': {'spotify': 'https://open.spotify.com/user/fake'},
+            },
+            'images': [{'url': f'https://i.scdn.co/image/playlist{i}'}],
+        }
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def dispatch(self, method):
+        server = self.server.api
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if method == 'POST':
+                params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+
+        server.record_hit(url.path)
+        if server.latency:
+            time.sleep(server.latency)
+
+        retry_after = server.throttled(url.path)
+        if retry_after is not None:
+            self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                           {'Retry-After': str(retry_after)})
+            return
+
+        status, payload = server.respond(method, url, params, self.headers, body if length else b'')
+        self.send_json(status, payload)
+
+    def send_json(self, status, payload, headers=None):
+        body = b'' if payload is None else json.dumps(payload).encode()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+# Fake API server running on a background thread. Pages hold at most max_page_size
+# items whatever limit is asked for. Every throttle_every-th API call is answered
+# with a 429 (Retry-After: retry_after), inject_429() rate-limits the next calls.
+# Given fixtures, calls are forwarded to `upstream` and recorded when it's set, and
+# answered from the fixtures otherwise.
+class FakeSpotifyAPI:
+    def __init__(self, library=None, latency=0.0, host='127.0.0.1', port=0, max_page_size=50,
+                 throttle_every=0, retry_after=1, fixtures=None, upstream=None, accounts_upstream=None):
+        self.library = library or FakeLibrary()
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.fixtures = fixtures
+        self.upstream = upstream.rstrip('/') if upstream else None
+        self.accounts_upstream = (accounts_upstream or upstream or '').rstrip('/')
+        self.hits = Counter()
+        self.calls = 0
+        self.rate_limited = 0
+        self._injected = []
+        self._lock = threading.Lock()
+        self.httpd = FakeSpotifyServer((host, port), FakeSpotifyHandler)
+        self.httpd.api = self
+        self.thread = None
+
+    @property
+    def root_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def base_url(self):
+        return self.root_url + '/v1/me'
+
+    @property
+    def token_url(self):
+        return self.root_url + '/api/token'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def record_hit(self, path):
+        with self._lock:
+            self.hits[path] += 1
+
+    def total_hits(self):
+        with self._lock:
+            return sum(self.hits.values())
+
+    def reset_hits(self):
+        with self._lock:
+            self.hits.clear()
+
+    # Answer the next `count` API calls with a 429
+    def inject_429(self, count=1, retry_after=None):
+        with self._lock:
+            self._injected += [self.retry_after if retry_after is None else retry_after] * count
+
+    # Retry-After of a call that gets a 429, None when it goes through. The token
+    # endpoint is never rate-limited.
+    def throttled(self, path):
+        if path == '/api/token':
+            return None
+        with self._lock:
+            self.calls += 1
+            if self._injected:
+                retry_after = self._injected.pop(0)
+            elif self.throttle_every and self.calls % self.throttle_every == 0:
+                retry_after = self.retry_after
+            else:
+                return None
+            self.rate_limited += 1
+            return retry_after
+
+    def respond(self, method, url, params, headers, body):
+        if self.fixtures is None:
+            return self.route(method, url.path, params)
+
+        key = fixture_key(method, url)
+        if self.upstream:
+            status, payload = self.forward(method, url, headers, body)
+            self.fixtures.put(key, status, scrub_tokens(payload))
+            return status, payload
+
+        recorded = self.fixtures.get(key)
+        if recorded is None:
+            return 404, {'error': {'status': 404, 'message': f'No recorded response for {key}'}}
+        return recorded
+
+    # Pass a call on to the upstream service (accounts_upstream for the token endpoint)
+    def forward(self, method, url, headers, body):
+        root = self.accounts_upstream if url.path == '/api/token' else self.upstream
+        request = Request(root + url.path + (f'?{url.query}' if url.query else ''), data=body or None, method=method,
+                          headers={name: headers[name] for name in ('Authorization', 'Content-Type') if headers.get(name)})
+        try:
+            with urlopen(request, timeout=30) as response:
+                status, data = response.status, response.read()
+        except HTTPError as e:
+            status, data = e.code, e.read()
+        return status, json.loads(data) if data else None
+
+    def route(self, method, path, params):
+        lib = self.library
+
+        if path == '/api/token' and method == 'POST':
+            return 200, {
+                'access_token': f'access-{time.monotonic_ns()}',
+                'token_type': 'Bearer',
+                'expires_in': 3600,
+                'scope': '',
+            }
+
+        if path in ('/v1/artists', '/v1/tracks'):
+            return catalog(path[len('/v1/'):], lib, params.get('ids'))
+
+        if not path.startswith('/v1/me'):
+            return 404, {'error': {'status': 404, 'message': 'Not found'}}
+        path = path[len('/v1/me'):]
+        limit = min(int(params.get('limit', 20)), self.max_page_size)
+        offset = int(params.get('offset', 0))
+
+        if path == '':
+            return 200, {
+                'display_name': 'Fake User',
+                'external_urls': {'spotify': 'https://open.spotify.com/user/fake'},
+                'images': [{'url': 'https://i.scdn.co/image/user'}],
+                'followers': {'total': 42},
+            }
+        if path == '/player/currently-playing':
+            return (200, lib.now_playing) if lib.now_playing is not None else (204, None)
+        if path == '/player/recently-played':
+            return 200, recently_played(lib.plays, limit, params.get('after'), params.get('before'))
+        if path == '/top/artists':
+            return 200, page(lib.artists[:50], limit, offset)
+        if path == '/top/tracks':
+            return 200, page(lib.tracks[:50], limit, offset)
+        if path == '/tracks':
+            return 200, page(lib.saved, limit, offset)
+        if path == '/playlists':
+            return 200, page(lib.playlists, limit, offset)
+        if path == '/following':
+            return 200, {'artists': cursor_page(lib.followed, limit, params.get('after'))}
+
+        return 404, {'error': {'status': 404, 'message': 'Not found'}}
+
+
+# Batch lookup (/artists?ids=, /tracks?ids=), at most 50 ids, unknown ones are null
+def catalog(kind, lib, ids):
+    ids = [i for i in (ids or '').split(',') if i]
+    if not ids or len(ids) > 50:
+        return 400, {'error': {'status': 400, 'message': 'Invalid ids'}}
+    objects = {obj['id']: obj for obj in (lib.artists if kind == 'artists' else lib.tracks)}
+    return 200, {kind: [objects.get(i) for i in ids]}
+
+
+# Recorded responses by call, saved as JSON so fixtures can be checked in
+class Fixtures:
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with self._lock:
+            data = json.dumps(self.responses, indent=1, sort_keys=True)
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def get(self, key):
+        with self._lock:
+            recorded = self.responses.get(key)
+        return None if recorded is None else (recorded['status'], recorded['body'])
+
+    # The last response of a call is kept
+    def put(self, key, status, payload):
+        with self._lock:
+            self.responses[key] = {'status': status, 'body': payload}
+
+
+# "GET /v1/me/tracks?limit=50&offset=0", query parameters sorted. Form fields of the
+# token request aren't part of it, they hold the client secret.
+def fixture_key(method, url):
+    query = urlencode(sorted(parse_qs(url.query).items()), doseq=True)
+    return f'{method} {url.path}' + (f'?{query}' if query else '')
+
+
+# Recorded token responses never hold real tokens
+def scrub_tokens(payload):
+    if isinstance(payload, dict) and 'access_token' in payload:
+        return {**payload, 'access_token': 'recorded-access-token',
+                **({'refresh_token': 'recorded-refresh-token'} if 'refresh_token' in payload else {})}
+    return payload
+
+
+# Offset-paginated response envelope
+def page(items, limit, offset):
+    return {
+        'items': items[offset:offset + limit],
+        'limit': limit,
+        'offset': offset,
+        'total': len(items),
+    }
+
+
+# Recently played envelope, plays are (unix ms, item) pairs newest first. `after`
+# returns the plays closest after the cursor, `before` those closest before it.
+def recently_played(plays, limit, after=None, before=None):
+    if after is not None:
+        chunk = [p for p in plays if p[0] > int(after)][-limit:]
+    elif before is not None:
+        chunk = [p for p in plays if p[0] < int(before)][:limit]
+    else:
+        chunk = plays[:limit]
+    return {
+        'items': [item for ms, item in chunk],
+        'limit': limit,
+        'cursors': {'after': str(chunk[0][0]), 'before': str(chunk[-1][0])} if chunk else None,
+    }
+
+
+# Cursor-paginated response envelope (used by /following)
+def cursor_page(items, limit, after):
+    start = 0
+    if after:
+        ids = [item['id'] for item in items]
+        start = ids.index(after) + 1 if after in ids else len(items)
+    chunk = items[start:start + limit]
+    return {
+        'items': chunk,
+        'limit': limit,
+        'total': len(items),
+        'cursors': {'after': chunk[-1]['id'] if start + limit < len(items) and chunk else None},
+    }
+
+
+# Run the fake API in the foreground: python -m spotify.fakeapi --port 8765
+# --record https://api.spotify.com --fixtures calls.json records the calls proxied to
+# the real service (written on exit), --fixtures calls.json alone replays them.
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local fake Spotify API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--playlists', type=int, default=120)
+    parser.add_argument('--followed-artists', type=int, default=120)
+    parser.add_argument('--saved-tracks', type=int, default=200)
+    parser.add_argument('--artists', type=int, default=300)
+    parser.add_argument('--plays', type=int, default=50)
+    parser.add_argument('--max-page-size', type=int, default=50, help='Largest page served, whatever the limit.')
+    parser.add_argument('--throttle-every', type=int, default=0, help='Answer every Nth API call with a 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of the injected 429s.')
+    parser.add_argument('--fixtures', help='JSON file of recorded calls, replayed unless --record is given.')
+    parser.add_argument('--record', metavar='URL', help='Upstream to forward and record calls to.')
+    parser.add_argument('--accounts-url', default='https://accounts.spotify.com',
+                        help='Upstream of the token endpoint when recording.')
+    args = parser.parse_args(argv)
+    if args.record and not args.fixtures:
+        parser.error('--record needs --fixtures')
+
+    library = FakeLibrary(playlists=args.playlists, followed_artists=args.followed_artists,
+                          saved_tracks=args.saved_tracks, artists=args.artists, plays=args.plays)
+    fixtures = None
+    if args.fixtures:
+        fixtures = Fixtures() if args.record else Fixtures.load(args.fixtures)
+    api = FakeSpotifyAPI(library, latency=args.latency, host=args.host, port=args.port,
+                         max_page_size=args.max_page_size, throttle_every=args.throttle_every,
+                         retry_after=args.retry_after, fixtures=fixtures, upstream=args.record,
+                         accounts_upstream=args.accounts_url if args.record else None)
+    print(f'Fake Spotify API on {api.base_url} (token endpoint {api.token_url})')
+    try:
+        api.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.httpd.server_close()
+        if args.record:
+            fixtures.save(args.fixtures)
+            print(f'Recorded {len(fixtures.responses)} calls to {args.fixtures}')
+
+
+if __name__ == '__main__':
+    main()
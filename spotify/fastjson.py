@@ -0,0 +1,28 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json module is used without it
+    orjson = None
+
+# JSON encoding/decoding for upstream bodies and our own responses, through orjson
+# when it's installed. Both paths take and return the same types: loads() accepts
+# bytes or str, dumps() returns UTF-8 bytes.
+
+# Raised by dumps() for what it can't encode (orjson also refuses integers over 64 bits)
+EncodeError = orjson.JSONEncodeError if orjson is not None else TypeError
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# `default` converts objects neither library handles natively. Datetimes always go
+# through it, so they're formatted the same way whichever library is used.
+def dumps(obj, default=None):
+    if orjson is not None:
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from spotify.models import SpotifyToken
+from spotify.taste import get_taste_index, taste_features
+import time
+
+
+class Command(BaseCommand):
+    help = "Rebuild the taste-vector index from every session's stored top lists."
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        index = get_taste_index()
+        token_ids = set()
+        updated = 0
+        for tokens in SpotifyToken.objects.order_by('id').iterator(chunk_size=200):
+            token_ids.add(str(tokens.pk))
+            updated += index.update(tokens.pk, taste_features(tokens))
+
+        removed = 0
+        for token_id in index.token_ids() - token_ids:
+            removed += index.remove(token_id)
+
+        self.stdout.write(f"Indexed {len(token_ids)} sessions ({updated} updated, {removed} removed) "
+                          f"in {time.monotonic() - start:.2f}s")
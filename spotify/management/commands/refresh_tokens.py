@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from spotify.refresher import refresh_expiring_tokens
+from spotify.util import get_refresh_lead
+import time
+
+
+class Command(BaseCommand):
+    help = 'Refresh Spotify tokens that are about to expire, optionally in a loop.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lead', type=int, default=None,
+                            help='Refresh tokens expiring within this many seconds (default: SPOTIFY_TOKEN_REFRESH_LEAD).')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Maximum concurrent calls to the token endpoint.')
+        parser.add_argument('--loop', action='store_true', help='Keep running as a background worker.')
+        parser.add_argument('--interval', type=int, default=60, help='Seconds between scans with --loop.')
+
+    def handle(self, *args, **options):
+        lead = options['lead'] if options['lead'] is not None else get_refresh_lead()
+
+        while True:
+            start = time.monotonic()
+            refreshed, failed = refresh_expiring_tokens(lead, options['batch_size'], options['workers'])
+            self.stdout.write(f'Refreshed {refreshed} tokens, {failed} failed in {time.monotonic() - start:.2f}s')
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
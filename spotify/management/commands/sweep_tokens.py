@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from spotify.sweeper import sweep_tokens, get_max_refresh_failures, DEFAULT_GRACE
+import time
+
+
+class Command(BaseCommand):
+    help = 'Delete tokens whose session is gone or whose refresh keeps failing, optionally in a loop.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Tokens deleted per statement.')
+        parser.add_argument('--max-failures', type=int, default=None,
+                            help='Rejected refreshes after which an expired token is dead '
+                                 '(default: SPOTIFY_TOKEN_MAX_REFRESH_FAILURES).')
+        parser.add_argument('--grace', type=int, default=DEFAULT_GRACE,
+                            help='Seconds a new token is kept even without a session.')
+        parser.add_argument('--loop', action='store_true', help='Keep running as a background worker.')
+        parser.add_argument('--interval', type=int, default=60 * 60, help='Seconds between sweeps with --loop.')
+
+    def handle(self, *args, **options):
+        max_failures = options['max_failures'] if options['max_failures'] is not None else get_max_refresh_failures()
+
+        while True:
+            start = time.monotonic()
+            counts = sweep_tokens(options['batch_size'], max_failures, options['grace'])
+            self.stdout.write(f"Deleted {counts['orphaned']} orphaned and {counts['dead']} dead tokens "
+                              f"in {time.monotonic() - start:.2f}s")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from spotify.sync import SYNC_JOBS, DEFAULT_SYNC_BATCH_SIZE, sync_sessions
+import time
+
+
+class Command(BaseCommand):
+    help = 'Pull user data from Spotify into the local store for every stored session.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('jobs', nargs='*', help=f"Jobs to run (default: all of {', '.join(SYNC_JOBS)}).")
+        parser.add_argument('--session', action='append', dest='sessions', help='Only sync this session (repeatable).')
+        parser.add_argument('--workers', type=int, default=4, help='Sessions fetched concurrently.')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_SYNC_BATCH_SIZE,
+                            help='Sessions read and submitted at a time.')
+        parser.add_argument('--loop', action='store_true', help='Keep running as a background worker.')
+        parser.add_argument('--interval', type=int, default=15 * 60, help='Seconds between runs with --loop.')
+
+    def handle(self, *args, **options):
+        jobs = options['jobs'] or list(SYNC_JOBS)
+        unknown = [job for job in jobs if job not in SYNC_JOBS]
+        if unknown:
+            raise CommandError(f"Unknown jobs: {', '.join(unknown)}")
+
+        while True:
+            start = time.monotonic()
+            synced, failed = sync_sessions(jobs, options['sessions'], options['workers'], options['batch_size'])
+            self.stdout.write(f"Synced {', '.join(jobs)} for {synced} sessions, {failed} failed "
+                              f"in {time.monotonic() - start:.2f}s")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,226 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from functools import wraps
+import contextvars
+import re
+import threading
+import time
+
+# Request instrumentation. Upstream calls (through hooks on the HTTP clients), DB
+# queries (through a wrapper on every connection), transforms and rendering add their
+# time to the timings of the current request, which ServerTimingMiddleware sends back
+# as a Server-Timing header and folds into histograms. GET /metrics exposes those in
+# the Prometheus text format; they're per process, like everything else in memory.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+PHASES = ('upstream', 'db', 'transform', 'render')
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    # Observations across every label set
+    def count(self):
+        with self._lock:
+            return sum(series[2] for series in self._series.values())
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, (list(buckets), total, count)) for labels, (buckets, total, count) in self._series.items())
+        for labels, (buckets, total, count) in series:
+            pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, labels)]
+            for bound, cumulative in zip(list(self.buckets) + ['+Inf'], buckets + [count]):
+                le = ','.join(pairs + [f'le="{bound}"'])
+                lines.append(f'{self.name}_bucket{{{le}}} {cumulative}')
+            suffix = '{' + ','.join(pairs) + '}' if pairs else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+        return lines
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+UPSTREAM_SECONDS = Histogram('spotify_upstream_request_duration_seconds',
+                             'Spotify API calls by path and status.', ('path', 'status'))
+REQUEST_SECONDS = Histogram('spotify_request_duration_seconds', 'Requests by view.', ('view',))
+PHASE_SECONDS = Histogram('spotify_request_phase_duration_seconds',
+                          'Time spent per request in upstream calls, DB queries, transforms and rendering.',
+                          ('view', 'phase'))
+PHASE_CALLS = Histogram('spotify_request_phase_calls',
+                        'Upstream calls, DB queries, transforms and renders per request.',
+                        ('view', 'phase'), COUNT_BUCKETS)
+REGISTRY = [UPSTREAM_SECONDS, REQUEST_SECONDS, PHASE_SECONDS, PHASE_CALLS]
+
+
+# Time spent by one request per phase, and per upstream path
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {phase: [0, 0.0] for phase in PHASES}
+        self.upstream = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds, path=None):
+        with self._lock:
+            totals = self.phases[phase]
+            totals[0] += 1
+            totals[1] += seconds
+            if path is not None:
+                totals = self.upstream.setdefault(path, [0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total):
+        entries = [f'total;dur={total * 1000:.1f}']
+        for phase, (count, seconds) in self.phases.items():
+            if count:
+                entries.append(f'{phase};dur={seconds * 1000:.1f};desc="{count}x"')
+        for path, (count, seconds) in self.upstream.items():
+            entries.append(f'upstream-{metric_token(path)};dur={seconds * 1000:.1f};desc="{count}x {path}"')
+        return ', '.join(entries)
+
+    def observe(self, view, total):
+        REQUEST_SECONDS.observe(total, view)
+        for phase, (count, seconds) in self.phases.items():
+            PHASE_SECONDS.observe(seconds, view, phase)
+            PHASE_CALLS.observe(count, view, phase)
+
+
+current_timings = contextvars.ContextVar('spotify_request_timings', default=None)
+
+
+# '/v1/me/top/tracks' -> 'v1-me-top-tracks', a valid Server-Timing metric name
+def metric_token(path):
+    return re.sub(r'[^A-Za-z0-9]+', '-', path).strip('-')
+
+
+def record(phase, seconds, path=None):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(phase, seconds, path)
+
+
+def record_upstream(path, status, seconds):
+    UPSTREAM_SECONDS.observe(seconds, path, str(status))
+    record('upstream', seconds, path)
+
+
+# Decorator adding the time spent in a function to a phase of the current request
+def timed(phase):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if current_timings.get() is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(phase, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# fn running in a copy of the caller's context, so calls made from pool threads are
+# recorded in the timings of the request that started them
+def in_request_context(fn):
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
+
+
+# requests response hook, `elapsed` runs from sending the request to parsing the headers
+def observe_response(response, *args, **kwargs):
+    record_upstream(response.request.path_url.split('?', 1)[0], response.status_code, response.elapsed.total_seconds())
+
+
+# httpx event hooks, the response hook runs once the headers have arrived
+async def mark_request_start(request):
+    request.extensions['spotify_started'] = time.perf_counter()
+
+
+async def observe_async_response(response):
+    started = response.request.extensions.get('spotify_started')
+    if started is not None:
+        record_upstream(response.request.url.path, response.status_code, time.perf_counter() - started)
+
+
+# Connection execute wrapper timing every query run while a request is being served
+def record_query(execute, sql, params, many, context):
+    if current_timings.get() is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record('db', time.perf_counter() - start)
+
+
+# connection_created receiver installing record_query (see SpotifyConfig.ready)
+def instrument_connection(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        total = timings.elapsed()
+        match = getattr(request, 'resolver_match', None)
+        timings.observe(match.view_name if match else 'unmatched', total)
+        response['Server-Timing'] = timings.server_timing(total)
+        return response
+
+
+# Every histogram in the Prometheus text exposition format
+def render_metrics():
+    return '\n'.join(line for histogram in REGISTRY for line in histogram.collect()) + '\n'
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='spotifytoken',
+            name='expires_in',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,145 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify', '0002_spotifytoken_expires_in_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Album',
+            fields=[
+                ('id', models.CharField(max_length=62, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('url', models.URLField(blank=True, max_length=255)),
+                ('image_url', models.URLField(blank=True, max_length=255)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Artist',
+            fields=[
+                ('id', models.CharField(max_length=62, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('url', models.URLField(blank=True, max_length=255)),
+                ('genres', models.JSONField(default=list)),
+                ('image_url', models.URLField(blank=True, max_length=255)),
+                ('followers', models.PositiveIntegerField(null=True)),
+                ('popularity', models.PositiveSmallIntegerField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Playlist',
+            fields=[
+                ('id', models.CharField(max_length=62, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('url', models.URLField(blank=True, max_length=255)),
+                ('owner_name', models.CharField(blank=True, max_length=255)),
+                ('owner_url', models.URLField(blank=True, max_length=255)),
+                ('is_public', models.BooleanField(null=True)),
+                ('total_tracks', models.PositiveIntegerField(default=0)),
+                ('image_url', models.URLField(blank=True, max_length=255)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Track',
+            fields=[
+                ('id', models.CharField(max_length=62, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('url', models.URLField(blank=True, max_length=255)),
+                ('duration_ms', models.PositiveIntegerField(null=True)),
+                ('popularity', models.PositiveSmallIntegerField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('album', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tracks', to='spotify.album')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TrackArtist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField(default=0)),
+                ('artist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credits', to='spotify.artist')),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credits', to='spotify.track')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='track',
+            name='artists',
+            field=models.ManyToManyField(related_name='tracks', through='spotify.TrackArtist', to='spotify.artist'),
+        ),
+        migrations.CreateModel(
+            name='UserPlaylist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('playlist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotify.playlist')),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='playlists', to='spotify.spotifytoken')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FollowedArtist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('artist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotify.artist')),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='followed_artists', to='spotify.spotifytoken')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('token', 'artist'), name='unique_followed_artist')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TopArtist',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time_range', models.CharField(default='medium_term', max_length=12)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('taken_at', models.DateTimeField(auto_now_add=True)),
+                ('artist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotify.artist')),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='top_artists', to='spotify.spotifytoken')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('token', 'time_range', 'rank'), name='unique_top_artist_rank')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TopTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time_range', models.CharField(default='medium_term', max_length=12)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('taken_at', models.DateTimeField(auto_now_add=True)),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='top_tracks', to='spotify.spotifytoken')),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotify.track')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('token', 'time_range', 'rank'), name='unique_top_track_rank')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SavedTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('added_at', models.DateTimeField()),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='saved_tracks', to='spotify.spotifytoken')),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotify.track')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['token', '-added_at'], name='saved_track_recent')],
+                'constraints': [models.UniqueConstraint(fields=('token', 'track'), name='unique_saved_track')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='trackartist',
+            constraint=models.UniqueConstraint(fields=('track', 'artist'), name='unique_track_artist'),
+        ),
+        migrations.AddConstraint(
+            model_name='userplaylist',
+            constraint=models.UniqueConstraint(fields=('token', 'playlist'), name='unique_user_playlist'),
+        ),
+    ]
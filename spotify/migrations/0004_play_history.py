@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify', '0003_catalog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('played_at', models.DateTimeField()),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='plays', to='spotify.spotifytoken')),
+                ('track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='spotify.track')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('token', 'played_at'), name='unique_play')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify', '0004_play_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job', models.CharField(max_length=20)),
+                ('last_synced', models.DateTimeField(null=True)),
+                ('last_full_sync', models.DateTimeField(null=True)),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_states', to='spotify.spotifytoken')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('token', 'job'), name='unique_sync_state')],
+            },
+        ),
+    ]
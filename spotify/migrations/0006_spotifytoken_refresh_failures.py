@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spotify', '0005_sync_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spotifytoken',
+            name='refresh_failures',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -5,10 +5,151 @@ class SpotifyToken(models.Model):
     token_type = models.CharField(max_length=50)
     access_token = models.CharField(max_length=150)
     refresh_token = models.CharField(max_length=150)
-    expires_in = models.DateTimeField()
+    expires_in = models.DateTimeField(db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    refresh_failures = models.PositiveSmallIntegerField(default=0)
 
     def __str__(self) -> str:
         return (f"{self.user} | {self.created_at}")
 
-    
\ No newline at end of file
+
+# Catalog entities, keyed by their Spotify ID and shared by every user
+
+class Artist(models.Model):
+    id = models.CharField(max_length=62, primary_key=True)
+    name = models.CharField(max_length=255)
+    url = models.URLField(max_length=255, blank=True)
+    genres = models.JSONField(default=list)
+    image_url = models.URLField(max_length=255, blank=True)
+    followers = models.PositiveIntegerField(null=True)
+    popularity = models.PositiveSmallIntegerField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class Album(models.Model):
+    id = models.CharField(max_length=62, primary_key=True)
+    name = models.CharField(max_length=255)
+    url = models.URLField(max_length=255, blank=True)
+    image_url = models.URLField(max_length=255, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class Track(models.Model):
+    id = models.CharField(max_length=62, primary_key=True)
+    name = models.CharField(max_length=255)
+    url = models.URLField(max_length=255, blank=True)
+    album = models.ForeignKey(Album, null=True, on_delete=models.SET_NULL, related_name='tracks')
+    artists = models.ManyToManyField(Artist, through='TrackArtist', related_name='tracks')
+    duration_ms = models.PositiveIntegerField(null=True)
+    popularity = models.PositiveSmallIntegerField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class TrackArtist(models.Model):
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='credits')
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name='credits')
+    position = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['track', 'artist'], name='unique_track_artist')]
+
+
+class Playlist(models.Model):
+    id = models.CharField(max_length=62, primary_key=True)
+    name = models.CharField(max_length=255)
+    url = models.URLField(max_length=255, blank=True)
+    owner_name = models.CharField(max_length=255, blank=True)
+    owner_url = models.URLField(max_length=255, blank=True)
+    is_public = models.BooleanField(null=True)
+    total_tracks = models.PositiveIntegerField(default=0)
+    image_url = models.URLField(max_length=255, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+# Per-user relations, removed together with the session's tokens
+
+class SavedTrack(models.Model):
+    token = models.ForeignKey(SpotifyToken, on_delete=models.CASCADE, related_name='saved_tracks')
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='+')
+    added_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['token', 'track'], name='unique_saved_track')]
+        indexes = [models.Index(fields=['token', '-added_at'], name='saved_track_recent')]
+
+
+class FollowedArtist(models.Model):
+    token = models.ForeignKey(SpotifyToken, on_delete=models.CASCADE, related_name='followed_artists')
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['token', 'artist'], name='unique_followed_artist')]
+
+
+class UserPlaylist(models.Model):
+    token = models.ForeignKey(SpotifyToken, on_delete=models.CASCADE, related_name='playlists')
+    playlist = models.ForeignKey(Playlist, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['token', 'playlist'], name='unique_user_playlist')]
+
+
+# Latest top-N snapshot per time range, replaced as a whole on every sync
+
+class TopTrack(models.Model):
+    token = models.ForeignKey(SpotifyToken, on_delete=models.CASCADE, related_name='top_tracks')
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='+')
+    time_range = models.CharField(max_length=12, default='medium_term')
+    rank = models.PositiveSmallIntegerField()
+    taken_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['token', 'time_range', 'rank'], name='unique_top_track_rank')]
+
+
+class TopArtist(models.Model):
+    token = models.ForeignKey(SpotifyToken, on_delete=models.CASCADE, related_name='top_artists')
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name='+')
+    time_range = models.CharField(max_length=12, default='medium_term')
+    rank = models.PositiveSmallIntegerField()
+    taken_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['token', 'time_range', 'rank'], name='unique_top_artist_rank')]
+
+
+# Listening history, appended by the incremental sync. One row per play, the unique
+# (token, played_at) index also serves keyset pagination newest first.
+
+class PlayHistory(models.Model):
+    token = models.ForeignKey(SpotifyToken, on_delete=models.CASCADE, related_name='plays')
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name='+')
+    played_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['token', 'played_at'], name='unique_play')]
+
+
+# Bookkeeping of the incremental sync jobs: when a job last ran for a user, and
+# when it last did a full reconciliation (the only pass that detects removals).
+
+class SyncState(models.Model):
+    token = models.ForeignKey(SpotifyToken, on_delete=models.CASCADE, related_name='sync_states')
+    job = models.CharField(max_length=20)
+    last_synced = models.DateTimeField(null=True)
+    last_full_sync = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['token', 'job'], name='unique_sync_state')]
@@ -0,0 +1,149 @@
+from django.conf import settings
+from .util import aexecute_spotify_api_request
+from .transforms import build_current_song
+from .errors import SpotifyRateLimited
+from .fastjson import dumps
+import asyncio
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Now-playing updates pushed over Server-Sent Events. Every stream open for a session
+# subscribes to one poller, which calls /player/currently-playing on its own schedule
+# and broadcasts an event only when the track or the play state changes. The poller
+# stops with its last subscriber, so sessions nobody is watching cost no calls.
+
+DEFAULT_INTERVALS = {
+    'PLAYING': 10,      # longest wait while a track plays, a skip shows up within this
+    'PAUSED': 20,
+    'IDLE': 60,         # nothing playing, or the upstream call failed
+    'MIN': 1,
+    'KEEPALIVE': 15,    # comment line sent to idle streams so proxies keep them open
+}
+
+
+def get_interval(name):
+    return getattr(settings, f'SPOTIFY_NOW_PLAYING_{name}_INTERVAL', DEFAULT_INTERVALS[name])
+
+
+# What a change is detected on: the track and whether it's playing
+def playback_state(response):
+    item = response.get('item') or {}
+    return item.get('id'), bool(response.get('is_playing'))
+
+
+# Seconds until the next poll: up to the end of the current track while one plays
+# (plus a little slack for the next one to start), longer when paused or idle
+def next_poll_in(response):
+    item = response.get('item')
+    if not item:
+        return get_interval('IDLE')
+    if not response.get('is_playing'):
+        return get_interval('PAUSED')
+
+    remaining = ((item.get('duration_ms') or 0) - (response.get('progress_ms') or 0)) / 1000
+    return min(max(remaining + 0.5, get_interval('MIN')), get_interval('PLAYING'))
+
+
+# One SSE message
+def sse_event(name, data):
+    return b'event: ' + name.encode() + b'\ndata: ' + dumps(data) + b'\n\n'
+
+
+class NowPlayingPoller:
+    def __init__(self, session_id, registry):
+        self.session_id = session_id
+        self.registry = registry
+        self.subscribers = set()
+        self.state = None
+        self.last_event = None
+        self.task = None
+
+    def subscribe(self):
+        queue = asyncio.Queue()
+        if self.last_event is not None:
+            queue.put_nowait(self.last_event)
+        self.subscribers.add(queue)
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            self.stop()
+
+    def stop(self):
+        if self.registry.get(self.session_id) is self:
+            del self.registry[self.session_id]
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def publish(self, event):
+        self.last_event = event
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    async def run(self):
+        while self.subscribers:
+            try:
+                response = await aexecute_spotify_api_request(self.session_id, "/player/currently-playing",
+                                                              bypass_cache=True)
+            except SpotifyRateLimited as e:
+                logger.warning('Now-playing poll rate limited for session %s', self.session_id)
+                await asyncio.sleep(max(e.wait, get_interval('IDLE')))
+                continue
+            except Exception:
+                logger.exception('Now-playing poll failed for session %s', self.session_id)
+                response = {}
+
+            if 'error' in response:
+                # An API error (expired grant...), not "nothing playing"
+                logger.warning('Now-playing poll failed for session %s: %s', self.session_id, response['error'])
+                await asyncio.sleep(get_interval('IDLE'))
+                continue
+
+            state = playback_state(response)
+            if state != self.state:
+                self.state = state
+                self.publish(sse_event('current_song', build_current_song(response)))
+            await asyncio.sleep(next_poll_in(response))
+
+
+# Pollers of the running event loop by session (tasks can't cross loops)
+_pollers = weakref.WeakKeyDictionary()
+
+
+def get_poller(session_id):
+    registry = _pollers.setdefault(asyncio.get_running_loop(), {})
+    poller = registry.get(session_id)
+    if poller is None:
+        poller = registry[session_id] = NowPlayingPoller(session_id, registry)
+    return poller
+
+
+# SSE body of one stream: the current state right away, then every change, with
+# keepalive comments in between. Unsubscribes when the client goes away.
+async def stream_now_playing(session_id):
+    poller = get_poller(session_id)
+    queue = poller.subscribe()
+    try:
+        yield b'retry: 5000\n\n'
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), get_interval('KEEPALIVE'))
+            except asyncio.TimeoutError:
+                yield b': keepalive\n\n'
+    finally:
+        poller.unsubscribe(queue)
+
+
+# SSE body of one event with the current state, for servers that can't hold a stream
+# open (WSGI): `retry` has the EventSource reconnect when a change is next expected,
+# so the client polls at the poller's pace. Errors raise like the other views.
+async def now_playing_snapshot(session_id):
+    response = await aexecute_spotify_api_request(session_id, "/player/currently-playing")
+    event = sse_event('current_song', build_current_song(response))
+    return b'retry: %d\n\n' % (next_poll_in(response) * 1000) + event
@@ -0,0 +1,127 @@
+from .util import execute_spotify_api_request, aexecute_spotify_api_request, get_valid_tokens, aget_valid_tokens
+from .ratelimit import BULK
+from .metrics import in_request_context
+from .errors import check_response
+from django.conf import settings
+from django.db import connections
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import itertools
+
+DEFAULT_CONCURRENCY = 8
+
+
+# Maximum pages fetched at once for a single paginated call
+def get_concurrency():
+    return getattr(settings, 'SPOTIFY_PAGINATION_CONCURRENCY', DEFAULT_CONCURRENCY)
+
+
+# Yield every page of an offset-paginated endpoint in offset order. The first page
+# gives `total`, after which all remaining offsets are fetched concurrently.
+# Page fetches run at bulk priority so they yield to interactive calls.
+def iter_offset_pages(session_id, endpoint, params=None, page_size=50, max_workers=None,
+                      tokens=None, bypass_cache=False, total_key='total', priority=BULK):
+    params = dict(params or {}, limit=page_size, offset=0)
+    tokens = get_valid_tokens(session_id, tokens)
+
+    def fetch(offset):
+        try:
+            return execute_spotify_api_request(session_id, endpoint, params_=dict(params, offset=offset),
+                                               bypass_cache=bypass_cache, tokens=tokens, priority=priority)
+        finally:
+            connections.close_all()
+
+    first = execute_spotify_api_request(session_id, endpoint, params_=params,
+                                        bypass_cache=bypass_cache, tokens=tokens, priority=priority)
+    yield first
+
+    offsets = range(page_size, first.get(total_key) or 0, page_size)
+    if not offsets:
+        return
+
+    workers = min(max_workers or get_concurrency(), len(offsets))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='spotify-pages') as pool:
+        yield from pool.map(in_request_context(fetch), offsets)
+
+
+# The pages of iter_*_pages with the first one already fetched, so a failing first
+# call (SpotifyRateLimited, or an error response raised as SpotifyAPIError) reaches
+# the view before a streamed response starts
+def with_first_page(pages):
+    pages = iter(pages)
+    first = next(pages, None)
+    return pages if first is None else itertools.chain([check_response(first)], pages)
+
+
+# All pages of an offset-paginated endpoint, merged in order
+def fetch_offset_pages(session_id, endpoint, params=None, **kwargs):
+    return list(iter_offset_pages(session_id, endpoint, params, **kwargs))
+
+
+# Async counterpart of fetch_offset_pages
+async def afetch_offset_pages(session_id, endpoint, params=None, page_size=50, max_workers=None,
+                              tokens=None, bypass_cache=False, total_key='total', priority=BULK):
+    params = dict(params or {}, limit=page_size, offset=0)
+    tokens = await aget_valid_tokens(session_id, tokens)
+
+    first = await aexecute_spotify_api_request(session_id, endpoint, params_=params,
+                                               bypass_cache=bypass_cache, tokens=tokens, priority=priority)
+
+    offsets = range(page_size, first.get(total_key) or 0, page_size)
+    limit = asyncio.Semaphore(max_workers or get_concurrency())
+
+    async def fetch(offset):
+        async with limit:
+            return await aexecute_spotify_api_request(session_id, endpoint, params_=dict(params, offset=offset),
+                                                      bypass_cache=bypass_cache, tokens=tokens, priority=priority)
+
+    return [first] + list(await asyncio.gather(*(fetch(offset) for offset in offsets)))
+
+
+# Yield every page of a cursor-paginated endpoint (e.g. /following), following the
+# id of the last item until `total` items have been seen. Stops after an error page.
+def iter_cursor_pages(session_id, endpoint, params=None, container='artists', tokens=None, bypass_cache=False, priority=BULK):
+    params = dict(params or {})
+    tokens = get_valid_tokens(session_id, tokens)
+    seen = 0
+
+    while True:
+        response = execute_spotify_api_request(session_id, endpoint, params_=params,
+                                               bypass_cache=bypass_cache, tokens=tokens, priority=priority)
+        yield response
+
+        page = response.get(container)
+        if 'error' in response or not isinstance(page, dict):
+            return
+        items = page.get('items') or []
+        seen += len(items)
+        if not items or seen >= (page.get('total') or 0):
+            return
+        params['after'] = items[-1].get('id')
+
+
+# All pages of a cursor-paginated endpoint, in order
+def fetch_cursor_pages(session_id, endpoint, params=None, **kwargs):
+    return list(iter_cursor_pages(session_id, endpoint, params, **kwargs))
+
+
+# Async counterpart of fetch_cursor_pages
+async def afetch_cursor_pages(session_id, endpoint, params=None, container='artists', tokens=None, bypass_cache=False, priority=BULK):
+    params = dict(params or {})
+    tokens = await aget_valid_tokens(session_id, tokens)
+    pages = []
+    seen = 0
+
+    while True:
+        response = await aexecute_spotify_api_request(session_id, endpoint, params_=params,
+                                                      bypass_cache=bypass_cache, tokens=tokens, priority=priority)
+        pages.append(response)
+
+        page = response.get(container)
+        if 'error' in response or not isinstance(page, dict):
+            return pages
+        items = page.get('items') or []
+        seen += len(items)
+        if not items or seen >= (page.get('total') or 0):
+            return pages
+        params['after'] = items[-1].get('id')
@@ -0,0 +1,107 @@
+from functools import lru_cache
+
+# Declarative projections of Spotify objects. A spec maps each output field to a
+# dotted path into the raw object ('album.images.0.url', negative indexes count from
+# the end), to Each(path, spec) for a list of nested objects, or to Apply(path, fn)
+# to convert the value found. Specs are compiled once into plain Python functions
+# doing straight subscripts (prefixes shared by several fields are looked up once);
+# a missing key, a null object or an empty list along a path yields None instead of
+# raising. Compiled, a spec costs about what the hand-written .get() chains it
+# replaced did, and every ?fields= selection gets its own function; walking the spec
+# at call time instead costs 2-3x that (benchmarks/bench_projection.py).
+
+
+class Each:
+    def __init__(self, path, projection):
+        self.path = path
+        self.projection = projection
+
+
+class Apply:
+    def __init__(self, path, fn):
+        self.path = path
+        self.fn = fn
+
+
+class Projection:
+    def __init__(self, spec):
+        self.spec = spec
+        self.project = self.compile()
+
+    def __call__(self, obj):
+        return self.project(obj)
+
+    # Extractor returning only `fields` (a frozenset of possibly dotted names, a bare
+    # nested name keeps all of its fields). None means every field.
+    @lru_cache(maxsize=64)
+    def compile(self, fields=None):
+        selected = []
+        for name, source in self.spec.items():
+            nested = None
+            if fields is not None and name not in fields:
+                nested = frozenset(field[len(name) + 1:] for field in fields if field.startswith(name + '.'))
+                if not nested:
+                    continue
+            path = source if isinstance(source, str) else source.path
+            selected.append((name, source, tuple(path.split('.')) if path else (), nested))
+
+        # Path prefixes shared by several fields are looked up once, into locals
+        uses = {}
+        for _, _, path, _ in selected:
+            for i in range(1, len(path)):
+                uses[path[:i]] = uses.get(path[:i], 0) + 1
+        variables = {(): 'obj'}
+        lines = ['def project(obj):']
+
+        def lookup(path):
+            base = max((prefix for prefix in variables if path[:len(prefix)] == prefix), key=len)
+            return variables[base] + ''.join(compile_step(step) for step in path[len(base):])
+
+        def assign(target, path):
+            if not path:
+                lines.append(f'    {target} = obj')
+                return
+            lines.extend([f'    try:', f'        {target} = {lookup(path)}',
+                          f'    except LOOKUP_ERRORS:', f'        {target} = None'])
+
+        for prefix in sorted((prefix for prefix, count in uses.items() if count > 1), key=len):
+            target = f'p{len(variables)}'
+            assign(target, prefix)
+            variables[prefix] = target
+
+        namespace = {'LOOKUP_ERRORS': LOOKUP_ERRORS}
+        for i, (name, source, path, nested) in enumerate(selected):
+            assign(f'f{i}', path)
+            if isinstance(source, Each):
+                namespace[f'each{i}'] = source.projection.compile(nested)
+                lines.append(f'    f{i} = [each{i}(x) for x in f{i}] if f{i}.__class__ is list else []')
+            elif isinstance(source, Apply):
+                namespace[f'apply{i}'] = source.fn
+                lines.append(f'    if f{i} is not None:')
+                lines.append(f'        f{i} = apply{i}(f{i})')
+
+        lines.append('    return {' + ', '.join(f'{name!r}: f{i}' for i, (name, *_) in enumerate(selected)) + '}')
+        exec('\n'.join(lines), namespace)
+        return namespace['project']
+
+    def many(self, items, fields=None):
+        project = self.compile(fields)
+        return [project(item) for item in items or ()]
+
+
+# A missing key or index, or a null (or wrongly typed) object along the path
+LOOKUP_ERRORS = (KeyError, IndexError, TypeError)
+
+
+# Subscript taking one path step: a list index or a dict key
+def compile_step(step):
+    if step.lstrip('-').isdigit():
+        return f'[{int(step)}]'
+    return f'[{step!r}]'
+
+
+# Parse ?fields=a,b.c into the frozenset compile() takes (None when not given)
+def parse_fields(value):
+    if not value:
+        return None
+    return frozenset(field.strip() for field in value.split(',') if field.strip())
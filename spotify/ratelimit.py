@@ -0,0 +1,143 @@
+from django.conf import settings
+import asyncio
+import threading
+import time
+
+# Request priorities: interactive calls (a user waiting on a view) may use the
+# whole bucket, bulk calls (full-library pagination, sync jobs) leave a reserve.
+INTERACTIVE = 0
+BULK = 1
+
+DEFAULT_RATE = 10
+DEFAULT_BURST = 20
+DEFAULT_BULK_RESERVE = 5
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_MAX_WAIT = 10
+
+
+def get_rate_limit_setting(name, default):
+    return getattr(settings, f'SPOTIFY_RATE_LIMIT_{name}', default)
+
+
+# Seconds to wait from a Retry-After header, 1 when it's missing or unreadable
+def retry_after_seconds(retry_after):
+    try:
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        return 1
+
+
+# Token bucket shared by every upstream call made with one client ID. Spotify's
+# rate limit is app-wide, so a 429 blocks all callers until Retry-After passes.
+class RateLimiter:
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, bulk_reserve=DEFAULT_BULK_RESERVE,
+                 max_retries=DEFAULT_MAX_RETRIES, max_wait=DEFAULT_MAX_WAIT):
+        self.rate = rate
+        self.burst = burst
+        self.bulk_reserve = min(bulk_reserve, burst - 1)
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+        self.requests = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    # Take a token if one is available for this priority, otherwise return how long
+    # to wait before trying again
+    def reserve(self, priority=INTERACTIVE):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if now < self.blocked_until:
+                return self.blocked_until - now
+
+            floor = self.bulk_reserve if priority == BULK else 0
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                self.requests += 1
+                return 0
+            return (1 + floor - self.tokens) / self.rate
+
+    def acquire(self, priority=INTERACTIVE):
+        wait = self.reserve(priority)
+        if not wait:
+            return
+        self._enqueue(priority, 1)
+        try:
+            while wait:
+                time.sleep(wait)
+                wait = self.reserve(priority)
+        finally:
+            self._enqueue(priority, -1)
+
+    async def aacquire(self, priority=INTERACTIVE):
+        wait = self.reserve(priority)
+        if not wait:
+            return
+        self._enqueue(priority, 1)
+        try:
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.reserve(priority)
+        finally:
+            self._enqueue(priority, -1)
+
+    # Record a 429 and block the bucket for Retry-After seconds. Returns whether
+    # the call should be retried, which it isn't once the wait gets too long.
+    def backoff(self, retry_after, attempt):
+        delay = retry_after_seconds(retry_after)
+        with self._lock:
+            self.rate_limited += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return attempt < self.max_retries and delay <= self.max_wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': sum(self.waiting.values()),
+                'queued_interactive': self.waiting[INTERACTIVE],
+                'queued_bulk': self.waiting[BULK],
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'rate_limited': self.rate_limited,
+                'blocked_for': max(self.blocked_until - time.monotonic(), 0),
+            }
+
+    def _enqueue(self, priority, delta):
+        with self._lock:
+            self.waiting[priority] += delta
+            if delta > 0:
+                self.throttled += 1
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+# Rate limiter for a Spotify client ID, created on first use
+def get_rate_limiter(client_id):
+    with _limiters_lock:
+        limiter = _limiters.get(client_id)
+        if limiter is None:
+            limiter = _limiters[client_id] = RateLimiter(
+                rate=get_rate_limit_setting('RATE', DEFAULT_RATE),
+                burst=get_rate_limit_setting('BURST', DEFAULT_BURST),
+                bulk_reserve=get_rate_limit_setting('BULK_RESERVE', DEFAULT_BULK_RESERVE),
+                max_retries=get_rate_limit_setting('MAX_RETRIES', DEFAULT_MAX_RETRIES),
+                max_wait=get_rate_limit_setting('MAX_WAIT', DEFAULT_MAX_WAIT),
+            )
+        return limiter
+
+
+# Counters of every limiter, keyed by client ID
+def get_rate_limit_stats():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {str(client_id): limiter.stats() for client_id, limiter in limiters.items()}
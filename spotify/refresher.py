@@ -0,0 +1,46 @@
+from .models import SpotifyToken
+from .util import refresh_spotify_token, get_refresh_lead
+from django.db import close_old_connections
+from django.utils import timezone
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Refresh every token expiring within `lead` seconds, walking the expires_in index
+# in id-ordered batches with at most `workers` token endpoint calls in flight.
+# Returns (refreshed, failed) counts.
+def refresh_expiring_tokens(lead=None, batch_size=100, workers=4):
+    lead = get_refresh_lead() if lead is None else lead
+    deadline = timezone.now() + timedelta(seconds=lead)
+    due = SpotifyToken.objects.filter(expires_in__lte=deadline).order_by('id')
+
+    refreshed = failed = 0
+    last_id = 0
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='spotify-refresher') as pool:
+        while True:
+            batch = list(due.filter(id__gt=last_id).values_list('id', 'user')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            for ok in pool.map(lambda row: _refresh(row[1], lead), batch):
+                if ok:
+                    refreshed += 1
+                else:
+                    failed += 1
+
+    return refreshed, failed
+
+
+def _refresh(session_id, lead):
+    try:
+        return refresh_spotify_token(session_id, lead) is not None
+    except Exception:
+        logger.exception('Token refresh failed for session %s', session_id)
+        return False
+    finally:
+        close_old_connections()
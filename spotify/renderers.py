@@ -0,0 +1,53 @@
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import ParseError
+from rest_framework.utils.encoders import JSONEncoder
+from .fastjson import loads, dumps, EncodeError
+from .metrics import timed
+
+# Drop-in replacements for DRF's JSON renderer and parser backed by spotify.fastjson
+# (orjson when installed). Types orjson can't encode, datetimes included, go through
+# DRF's own encoder so the output matches JSONRenderer's, U+2028 and U+2029 are escaped
+# like JSONRenderer does, and data orjson refuses (integers over 64 bits) is left to
+# JSONRenderer. So is indented output (the browsable API, `Accept: application/json;
+# indent=4`).
+
+
+class FastJSONRenderer(JSONRenderer):
+    encoder = JSONEncoder()
+
+    @timed('render')
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = dumps(data, default=self.encoder.default)
+        except EncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+# Renderer picked by DRF's ?format= override for ?format=normalized. It writes the
+# same JSON, views check request.accepted_renderer.format to build the normalized
+# (entity-deduplicated) payload instead of the default one.
+
+
+class NormalizedJSONRenderer(FastJSONRenderer):
+    format = 'normalized'
+
+
+# A view's renderers plus the normalized one
+def with_normalized(renderer_classes):
+    return [*renderer_classes, NormalizedJSONRenderer]
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import weakref
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Deduplicates concurrent calls sharing a key: the first caller runs the function,
+# everyone arriving while it's in flight waits for and receives the same result.
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn(*args, **kwargs)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+
+# Async counterpart of SingleFlight. In-flight calls are tracked per event loop,
+# since a task can only be awaited on the loop that created it. The call runs in a
+# task of its own that every caller, the first one included, awaits through a shield:
+# a caller being cancelled (its client went away) leaves the call running for the
+# others.
+class AsyncSingleFlight:
+    def __init__(self):
+        self._calls = weakref.WeakKeyDictionary()
+
+    async def do(self, key, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        calls = self._calls.setdefault(loop, {})
+
+        task = calls.get(key)
+        if task is None:
+            task = calls[key] = loop.create_task(fn(*args, **kwargs))
+            task.add_done_callback(lambda task: self._finish(calls, key, task))
+        return await asyncio.shield(task)
+
+    # Runs before the callers are woken up, so a call made after this one returned
+    # starts a new upstream request
+    @staticmethod
+    def _finish(calls, key, task):
+        if calls.get(key) is task:
+            del calls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when every caller was cancelled
+
+    def in_flight(self, key):
+        try:
+            calls = self._calls.get(asyncio.get_running_loop(), {})
+        except RuntimeError:
+            return False
+        return key in calls
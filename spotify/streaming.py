@@ -0,0 +1,16 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from .fastjson import dumps
+
+
+# Serialize items one per line as they're produced
+def iter_ndjson(items):
+    default = DjangoJSONEncoder().default
+    for item in items:
+        yield dumps(item, default) + b'\n'
+
+
+# Newline-delimited JSON response streamed from an item iterator, each page's items
+# go out as soon as the page arrives
+def ndjson_response(items):
+    return StreamingHttpResponse(iter_ndjson(items), content_type='application/x-ndjson')
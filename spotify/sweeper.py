@@ -0,0 +1,79 @@
+from .models import SpotifyToken
+from .cache import token_cache
+from .taste import get_taste_index
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from datetime import timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Removal of tokens nobody can use anymore: orphaned ones, whose Django session has
+# expired or been deleted, and dead ones, whose refresh the token endpoint keeps
+# rejecting. Both are found with one set-based query and deleted id-batch by id-batch
+# so no single statement locks a large part of the table.
+
+DEFAULT_MAX_REFRESH_FAILURES = 3
+DEFAULT_GRACE = 60 * 60
+DB_SESSION_ENGINES = ('django.contrib.sessions.backends.db', 'django.contrib.sessions.backends.cached_db')
+
+
+def get_max_refresh_failures():
+    return getattr(settings, 'SPOTIFY_TOKEN_MAX_REFRESH_FAILURES', DEFAULT_MAX_REFRESH_FAILURES)
+
+
+# Session keys live in django_session only with the database session backends
+def sessions_in_database():
+    return settings.SESSION_ENGINE in DB_SESSION_ENGINES
+
+
+# Tokens without a live session, older than `grace` seconds (a session being
+# created and its first tokens aren't committed at the same instant)
+def orphaned_tokens(now=None, grace=DEFAULT_GRACE):
+    now = now or timezone.now()
+    live_session = Session.objects.filter(session_key=OuterRef('user'), expire_date__gt=now)
+    return SpotifyToken.objects.filter(~Exists(live_session), created_at__lte=now - timedelta(seconds=grace))
+
+
+# Expired tokens whose last `max_failures` refreshes were all rejected
+def dead_tokens(now=None, max_failures=None):
+    now = now or timezone.now()
+    max_failures = get_max_refresh_failures() if max_failures is None else max_failures
+    return SpotifyToken.objects.filter(refresh_failures__gte=max_failures, expires_in__lte=now)
+
+
+# Delete the tokens of a queryset batch_size rows at a time (with their synced data,
+# which cascades), dropping them from the token cache and the taste index as well.
+# Returns the number of tokens deleted.
+def delete_in_batches(tokens, batch_size=1000):
+    deleted = 0
+    index = get_taste_index()
+
+    while True:
+        batch = list(tokens.order_by('id').values_list('id', 'user')[:batch_size])
+        if not batch:
+            return deleted
+
+        ids = [token_id for token_id, _ in batch]
+        SpotifyToken.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+
+        for _, session_id in batch:
+            token_cache.delete(session_id)
+        index.remove_many(ids)
+
+
+# Delete orphaned and dead tokens. Returns {'orphaned': n, 'dead': n}.
+def sweep_tokens(batch_size=1000, max_failures=None, grace=DEFAULT_GRACE):
+    now = timezone.now()
+    counts = {'orphaned': 0, 'dead': 0}
+
+    if sessions_in_database():
+        counts['orphaned'] = delete_in_batches(orphaned_tokens(now, grace), batch_size)
+    else:
+        logger.warning('Sessions are not stored in the database (%s), orphaned tokens are not swept',
+                       settings.SESSION_ENGINE)
+    counts['dead'] = delete_in_batches(dead_tokens(now, max_failures), batch_size)
+    return counts
@@ -0,0 +1,198 @@
+from .models import SpotifyToken, PlayHistory, SyncState
+from .util import execute_spotify_api_request, get_valid_tokens
+from .pagination import fetch_offset_pages, fetch_cursor_pages
+from .ratelimit import BULK
+from .errors import check_response
+from .catalog import ingest_top_tracks, ingest_top_artists, ingest_followed_artists, ingest_playlists, ingest_plays, to_cursor, parse_timestamp
+from .taste import update_taste_vector
+from .enrichment import enrich_pages
+from .catalog import ingest_saved_tracks, stored_saved_tracks, prune_saved_tracks
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
+from django.db.models import Max
+from django.db import connections
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIBRARY_RECONCILE_INTERVAL = 24 * 60 * 60
+DEFAULT_SYNC_BATCH_SIZE = 200
+
+# Background jobs pulling user data into the local store. Upstream calls for many
+# sessions run concurrently on worker threads, while the writes happen on the calling
+# thread one session at a time so SQLite never sees concurrent writers.
+
+
+# Fetch a user's top lists, follows and playlists from Spotify. Every ingest replaces
+# a stored set, so any error response fails the whole fetch (SpotifyAPIError) rather
+# than replacing the user's data with an empty list.
+def fetch_catalog(tokens):
+    session_id = tokens.user
+    top_tracks = check_response(execute_spotify_api_request(session_id, "/top/tracks", params_={'limit':50},
+                                                            bypass_cache=True, tokens=tokens, priority=BULK))
+    top_artists = check_response(execute_spotify_api_request(session_id, "/top/artists", params_={'limit':50},
+                                                             bypass_cache=True, tokens=tokens, priority=BULK))
+    followed = fetch_cursor_pages(session_id, "/following", {'type':'artist','limit':50},
+                                  bypass_cache=True, tokens=tokens)
+    playlists = fetch_offset_pages(session_id, "/playlists", page_size=50, bypass_cache=True, tokens=tokens)
+    for page in followed + playlists:
+        check_response(page)
+
+    return {
+        'top_tracks': top_tracks.get('items') or [],
+        'top_artists': top_artists.get('items') or [],
+        'followed': [artist for page in followed for artist in (page.get('artists') or {}).get('items') or []],
+        'playlists': [playlist for page in playlists for playlist in page.get('items') or []],
+    }
+
+
+def ingest_catalog(tokens, data):
+    ingest_top_tracks(tokens, data['top_tracks'])
+    ingest_top_artists(tokens, data['top_artists'])
+    ingest_followed_artists(tokens, data['followed'])
+    ingest_playlists(tokens, data['playlists'])
+    update_taste_vector(tokens)
+
+
+# Plays newer than the last stored one, walking the `after` cursor forward. Their
+# artists come simplified, without genres, so they're enriched through the batch
+# endpoints (cached across users) for the genre distribution of the listening analytics.
+def fetch_history(tokens, max_pages=20):
+    last_played = PlayHistory.objects.filter(token=tokens).aggregate(last=Max('played_at'))['last']
+    params = {'limit':50}
+    if last_played is not None:
+        params['after'] = to_cursor(last_played)
+
+    items = []
+    for _ in range(max_pages):
+        response = check_response(execute_spotify_api_request(tokens.user, "/player/recently-played", params_=params,
+                                                              bypass_cache=True, tokens=tokens, priority=BULK))
+        page = response.get('items') or []
+        items += page
+
+        cursors = response.get('cursors') or {}
+        if last_played is None or len(page) < params['limit'] or not cursors.get('after'):
+            break
+        params['after'] = cursors['after']
+    return enrich_pages(tokens.user, [{'items': items}], 'track', tokens, BULK)[0]['items']
+
+
+# Whether the saved library is due a full re-fetch: never synced, or not reconciled
+# for SPOTIFY_LIBRARY_RECONCILE_INTERVAL seconds
+def library_needs_reconcile(tokens):
+    state = SyncState.objects.filter(token=tokens, job='library').first()
+    interval = getattr(settings, 'SPOTIFY_LIBRARY_RECONCILE_INTERVAL', DEFAULT_LIBRARY_RECONCILE_INTERVAL)
+    return state is None or state.last_full_sync is None or \
+        state.last_full_sync <= timezone.now() - timedelta(seconds=interval)
+
+
+# Saved tracks added since the last sync. /tracks is ordered by added_at newest first,
+# so pages are walked from the top until one reaches a track already stored. A full
+# fetch (concurrent pages) is done on the first sync and on every reconciliation.
+# A full fetch prunes every stored track it doesn't contain, so when a page is an
+# error or comes back short it's only ingested as new tracks (no prune, and the
+# reconciliation is retried on the next sync).
+def fetch_library(tokens, full=None):
+    session_id = tokens.user
+    if full is None:
+        full = library_needs_reconcile(tokens)
+
+    if full:
+        pages = fetch_offset_pages(session_id, "/tracks", page_size=50, bypass_cache=True, tokens=tokens)
+        items = [item for page in pages for item in page.get('items') or []]
+        total = pages[0].get('total') or 0
+        complete = not any('error' in page for page in pages) and len(items) >= total
+        if not complete:
+            logger.warning('Incomplete library fetch for session %s: %d of %d tracks', session_id, len(items), total)
+        return {'full': complete, 'items': items}
+
+    items = []
+    params = {'limit':50, 'offset':0}
+    while True:
+        response = check_response(execute_spotify_api_request(session_id, "/tracks", params_=params,
+                                                              bypass_cache=True, tokens=tokens, priority=BULK))
+        page = response.get('items') or []
+        stored = stored_saved_tracks(tokens, page)
+        for item in page:
+            # Removed and local tracks come back without a track or id, like in the full fetch
+            if not (item.get('track') and item['track'].get('id')):
+                continue
+            if (item['track']['id'], parse_timestamp(item['added_at'])) in stored:
+                return {'full': False, 'items': items}
+            items.append(item)
+
+        if len(page) < params['limit'] or params['offset'] + len(page) >= (response.get('total') or 0):
+            return {'full': False, 'items': items}
+        params['offset'] += params['limit']
+
+
+# Add new saved tracks; a complete full fetch also removes the ones no longer saved
+@transaction.atomic
+def ingest_library(tokens, data):
+    ingest_saved_tracks(tokens, data['items'])
+    now = timezone.now()
+    defaults = {'last_synced': now}
+    if data['full']:
+        prune_saved_tracks(tokens, [item['track']['id'] for item in data['items'] if item.get('track')])
+        defaults['last_full_sync'] = now
+    SyncState.objects.update_or_create(token=tokens, job='library', defaults=defaults)
+
+
+# Jobs by name: (fetch on a worker thread, ingest on the calling thread)
+SYNC_JOBS = {
+    'catalog': (fetch_catalog, ingest_catalog),
+    'history': (fetch_history, ingest_plays),
+    'library': (fetch_library, ingest_library),
+}
+
+
+# Run the given jobs for every stored session (or only `sessions`), at most
+# `workers` sessions fetching at once. Sessions are read and submitted batch_size
+# at a time (by id), so the fetched data held in memory is bounded by one batch
+# however many sessions are stored. Returns (synced, failed) counts, a session
+# whose fetch failed (upstream error, rate limit...) keeps its stored data.
+def sync_sessions(jobs, sessions=None, workers=4, batch_size=DEFAULT_SYNC_BATCH_SIZE):
+    queryset = SpotifyToken.objects.order_by('id')
+    if sessions:
+        queryset = queryset.filter(user__in=sessions)
+
+    def fetch(tokens):
+        try:
+            tokens = get_valid_tokens(tokens.user, tokens)
+            return tokens, {job: SYNC_JOBS[job][0](tokens) for job in jobs}
+        except Exception:
+            logger.exception('Sync failed for session %s', tokens.user)
+            return tokens, None
+        finally:
+            connections.close_all()
+
+    def ingest(tokens, results):
+        if results is None:
+            return False
+        try:
+            for job, data in results.items():
+                SYNC_JOBS[job][1](tokens, data)
+            return True
+        except Exception:
+            logger.exception('Ingest failed for session %s', tokens.user)
+            return False
+
+    synced = failed = 0
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='spotify-sync') as pool:
+        while True:
+            batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            for tokens, results in pool.map(fetch, batch):
+                if ingest(tokens, results):
+                    synced += 1
+                else:
+                    failed += 1
+
+    return synced, failed
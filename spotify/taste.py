@@ -0,0 +1,253 @@
+from .models import TopArtist, TopTrack
+from contextlib import contextmanager
+from django.conf import settings
+from pathlib import Path
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where only one process should write the index
+    fcntl = None
+
+# Taste vectors: each user's top artists, their genres and the artists of their top
+# tracks, feature-hashed into a fixed number of dimensions and L2-normalized. All
+# vectors live in one float32 matrix memory-mapped from disk, so similarity against
+# every stored user is a single matrix-vector product.
+
+DEFAULT_DIMENSIONS = 1024
+INITIAL_CAPACITY = 256
+
+
+def get_taste_setting(name, default):
+    return getattr(settings, f'SPOTIFY_TASTE_{name}', default)
+
+
+# Stable across processes, unlike hash()
+def hash_feature(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+
+
+# Weighted features of a user's stored top lists, higher ranks weigh more
+def taste_features(tokens) -> dict:
+    features = {}
+
+    def add(feature, weight):
+        features[feature] = features.get(feature, 0) + weight
+
+    for artist_id, genres, rank in TopArtist.objects.filter(token=tokens).values_list('artist_id', 'artist__genres', 'rank'):
+        weight = 1 / np.sqrt(rank)
+        add('artist:' + artist_id, weight)
+        for genre in genres or []:
+            add('genre:' + genre, weight / len(genres))
+
+    for artist_id, rank in TopTrack.objects.filter(token=tokens).values_list('track__credits__artist_id', 'rank'):
+        if artist_id:
+            add('artist:' + artist_id, 0.5 / np.sqrt(rank))
+    return features
+
+
+# Hashed, signed and normalized vector of a feature dict
+def hash_features(features, dimensions) -> np.ndarray:
+    vector = np.zeros(dimensions, dtype=np.float32)
+    if not features:
+        return vector
+
+    hashes = np.array([hash_feature(feature) for feature in features], dtype=np.uint64)
+    signs = np.where(hashes >> np.uint64(63), 1.0, -1.0)
+    np.add.at(vector, (hashes % np.uint64(dimensions)).astype(np.intp), signs * np.fromiter(features.values(), float))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def features_fingerprint(features):
+    data = json.dumps(sorted((feature, round(weight, 6)) for feature, weight in features.items()))
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+# Vectors of every user by token id: <directory>/vectors.npy holds the matrix (rows
+# of removed users are zeroed and reused), <directory>/rows.json the token id ->
+# (row, fingerprint) map. Writers hold an exclusive lock on <directory>/index.lock
+# across their read-modify-write, so web workers and sync jobs don't overwrite each
+# other's rows, and replace rows.json atomically; readers in other processes pick up
+# the new rows the next time they query.
+class TasteIndex:
+    def __init__(self, directory, dimensions=DEFAULT_DIMENSIONS):
+        self.directory = Path(directory)
+        self.dimensions = dimensions
+        self._rows = {}
+        self._matrix = None
+        self._row_tokens = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def matrix_path(self):
+        return self.directory / 'vectors.npy'
+
+    @property
+    def rows_path(self):
+        return self.directory / 'rows.json'
+
+    @property
+    def lock_path(self):
+        return self.directory / 'index.lock'
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._rows)
+
+    def token_ids(self):
+        with self._lock:
+            self._load()
+            return set(self._rows)
+
+    # Store a user's vector. Returns False when the features haven't changed.
+    def update(self, token_id, features) -> bool:
+        fingerprint = features_fingerprint(features)
+        with self._lock, self._file_lock():
+            self._load()
+            row, current = self._rows.get(str(token_id), (None, None))
+            if current == fingerprint:
+                return False
+
+            if row is None:
+                row = self._free_row()
+            matrix = self._writable(row + 1)
+            matrix[row] = hash_features(features, self.dimensions)
+            matrix.flush()
+            self._rows[str(token_id)] = (row, fingerprint)
+            self._save_rows()
+            return True
+
+    def remove(self, token_id):
+        return self.remove_many([token_id]) == 1
+
+    # Drop users from the index, returns how many were in it
+    def remove_many(self, token_ids):
+        with self._lock, self._file_lock():
+            self._load()
+            rows = [self._rows.pop(str(token_id))[0] for token_id in token_ids if str(token_id) in self._rows]
+            if not rows:
+                return 0
+            matrix = self._writable(max(rows) + 1)
+            matrix[rows] = 0
+            matrix.flush()
+            self._save_rows()
+            return len(rows)
+
+    # Top k users by cosine similarity to token_id, as (token id, similarity) pairs
+    def similar(self, token_id, k=10):
+        with self._lock:
+            self._load()
+            rows, matrix, row_tokens = self._rows, self._matrix, self._row_tokens
+        if str(token_id) not in rows or matrix is None:
+            return []
+
+        own_row = rows[str(token_id)][0]
+        scores = np.asarray(matrix @ matrix[own_row])
+        scores[own_row] = 0
+        scores[row_tokens < 0] = 0
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(row_tokens[row]), round(float(scores[row]), 4)) for row in top if scores[row] > 0]
+
+    # Exclusive lock shared with the other processes writing the index
+    @contextmanager
+    def _file_lock(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    # (Re)read the row map and remap the matrix when another process changed them
+    def _load(self):
+        try:
+            version = self.rows_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if version == self._version:
+            return
+
+        data = json.loads(self.rows_path.read_text())
+        if data.get('dimensions') != self.dimensions:
+            return  # built with other settings, rebuilt from scratch on the next update
+        self._rows = {token_id: tuple(item) for token_id, item in data['rows'].items()}
+        self._version = version
+        self._map_matrix()
+
+    def _free_row(self):
+        used = {row for row, _ in self._rows.values()}
+        return next(row for row in range(len(used) + 1) if row not in used)
+
+    # Matrix opened for writing, grown (by doubling, into a new file) to fit `rows` rows
+    def _writable(self, rows):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        capacity = len(self._matrix) if self._matrix is not None else 0
+        if rows > capacity:
+            new_capacity = max(INITIAL_CAPACITY, capacity * 2, rows)
+            tmp = self.matrix_path.with_suffix('.tmp')
+            matrix = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32,
+                                               shape=(new_capacity, self.dimensions))
+            if capacity:
+                matrix[:capacity] = self._matrix
+            matrix.flush()
+            del matrix
+            os.replace(tmp, self.matrix_path)
+        return np.load(self.matrix_path, mmap_mode='r+')
+
+    def _save_rows(self):
+        tmp = self.rows_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps({'dimensions':self.dimensions, 'rows':self._rows}))
+        os.replace(tmp, self.rows_path)
+        self._version = self.rows_path.stat().st_mtime_ns
+        self._map_matrix()
+
+    # Read-only view of the matrix and the token id of each row (-1 when unused)
+    def _map_matrix(self):
+        self._matrix = np.load(self.matrix_path, mmap_mode='r')
+        self._row_tokens = np.full(len(self._matrix), -1, dtype=np.int64)
+        for token_id, (row, _) in self._rows.items():
+            self._row_tokens[row] = int(token_id)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# Index at SPOTIFY_TASTE_INDEX_DIR, opened on first use
+def get_taste_index():
+    global _index
+
+    with _index_lock:
+        if _index is None:
+            _index = TasteIndex(get_taste_setting('INDEX_DIR', Path(settings.BASE_DIR) / 'taste_index'),
+                                get_taste_setting('DIMENSIONS', DEFAULT_DIMENSIONS))
+        return _index
+
+
+# Recompute a user's vector from their stored top lists (called after each sync)
+def update_taste_vector(tokens):
+    return get_taste_index().update(tokens.pk, taste_features(tokens))
+
+
+# Users with the most similar taste, with the artists they share (never session keys)
+def similar_users(tokens, k=10) -> dict:
+    matches = get_taste_index().similar(tokens.pk, k)
+    own_artists = set(TopArtist.objects.filter(token=tokens).values_list('artist_id', flat=True))
+
+    shared = {}
+    for token_id, artist_id, name in (TopArtist.objects.filter(token_id__in=[token_id for token_id, _ in matches])
+                                      .order_by('rank').values_list('token_id', 'artist_id', 'artist__name')):
+        if artist_id in own_artists:
+            shared.setdefault(token_id, []).append(name)
+
+    return {'similar_users':[{'user':token_id, 'similarity':score, 'shared_artists':shared.get(token_id, [])[:5]}
+                             for token_id, score in matches]}
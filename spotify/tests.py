@@ -1,3 +1,1006 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from .cache import ResponseCache, response_cache, token_cache
+from .errors import SpotifyRateLimited
+from .fakeapi import FakeSpotifyAPI, FakeLibrary, Fixtures
+from .enrichment import get_enrichment_cache
+from .analytics import listening_analytics, analytics_cache_key, get_analytics_cache, MAX_CACHED_RESULTS
+from .catalog import upsert_artists, ingest_top_tracks, ingest_top_artists, ingest_playlists, ingest_plays, local_songs_history, to_cursor
+from .models import SpotifyToken, Artist, Track, TrackArtist, TopTrack, TopArtist, FollowedArtist, UserPlaylist, PlayHistory, SavedTrack, SyncState
+from .nowplaying import stream_now_playing
+from .sweeper import sweep_tokens, delete_in_batches
+from .sync import sync_sessions
+from .taste import TasteIndex
+from .tokenlist import COUNT_CACHE_KEY
+from .transforms import get_formatted_date
+from .pagination import fetch_offset_pages, fetch_cursor_pages, afetch_cursor_pages
+from .ratelimit import RateLimiter
+from .renderers import FastJSONRenderer
+from . import cache, client, fastjson, nowplaying, sync, taste, util
+import asyncio
+import json
+import os
+import requests
+import tempfile
+import threading
 
-# Create your tests here.
+
+# Unsaved, unexpired tokens so upstream calls never touch the database
+def make_tokens(session_id='session'):
+    return SpotifyToken(user=session_id, token_type='Bearer', access_token='access',
+                        refresh_token='refresh', expires_in=timezone.now() + timedelta(hours=1))
+
+
+class CoalescingTests(SimpleTestCase):
+    callers = 10
+
+    def setUp(self):
+        self.api = FakeSpotifyAPI(latency=0.2).start()
+        self.addCleanup(self.api.stop)
+        patcher = mock.patch.object(util, 'BASE_URL', self.api.base_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        response_cache.clear()
+        self.addCleanup(response_cache.clear)
+        self.tokens = make_tokens()
+
+    def call_concurrently(self, params_list):
+        barrier = threading.Barrier(len(params_list))
+
+        def call(params):
+            barrier.wait()
+            return util.execute_spotify_api_request('session', '/top/tracks', params_=params,
+                                                    bypass_cache=True, tokens=self.tokens)
+
+        with ThreadPoolExecutor(max_workers=len(params_list)) as pool:
+            return list(pool.map(call, params_list))
+
+    def test_concurrent_identical_calls_share_one_upstream_request(self):
+        results = self.call_concurrently([{'limit': 5}] * self.callers)
+
+        self.assertEqual(self.api.hits['/v1/me/top/tracks'], 1)
+        self.assertEqual(len(results), self.callers)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(len(results[0]['items']), 5)
+
+    def test_different_params_are_not_coalesced(self):
+        self.call_concurrently([{'limit': 5}, {'limit': 6}])
+
+        self.assertEqual(self.api.hits['/v1/me/top/tracks'], 2)
+
+    def test_sequential_calls_are_not_coalesced(self):
+        for _ in range(2):
+            util.execute_spotify_api_request('session', '/top/tracks', bypass_cache=True, tokens=self.tokens)
+
+        self.assertEqual(self.api.hits['/v1/me/top/tracks'], 2)
+
+    def test_concurrent_identical_async_calls_share_one_upstream_request(self):
+        async def main():
+            return await asyncio.gather(*(
+                util.aexecute_spotify_api_request('session', '/top/tracks', params_={'limit': 5},
+                                                  bypass_cache=True, tokens=self.tokens)
+                for _ in range(self.callers)
+            ))
+
+        results = asyncio.run(main())
+
+        self.assertEqual(self.api.hits['/v1/me/top/tracks'], 1)
+        self.assertTrue(all(result == results[0] for result in results))
+
+    def test_cancelled_first_caller_leaves_the_others_running(self):
+        async def main():
+            calls = [asyncio.create_task(util.aexecute_spotify_api_request(
+                'session', '/top/tracks', params_={'limit': 5}, bypass_cache=True, tokens=self.tokens))
+                for _ in range(2)]
+            await asyncio.sleep(0.05)
+            calls[0].cancel()
+            return await asyncio.gather(*calls, return_exceptions=True)
+
+        leader, waiter = asyncio.run(main())
+
+        self.assertIsInstance(leader, asyncio.CancelledError)
+        self.assertEqual(len(waiter['items']), 5)
+        self.assertEqual(self.api.hits['/v1/me/top/tracks'], 1)
+
+
+class RendererTests(SimpleTestCase):
+    data = {
+        'name': 'Línea\u2028separada\u2029aquí',
+        'followers': 2 ** 70,
+        'counts': [-2 ** 65, 0, 1.5, None, True],
+        'added_at': datetime(2024, 1, 31, 10, 0, tzinfo=dt_timezone.utc),
+        7: 'non-string key',
+    }
+
+    def assert_renders_like_drf(self, data):
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_output_matches_json_renderer(self):
+        self.assert_renders_like_drf(self.data)
+        self.assert_renders_like_drf({key: value for key, value in self.data.items() if key != 'followers'})
+        self.assert_renders_like_drf({'name': self.data['name']})
+
+    def test_output_matches_json_renderer_without_orjson(self):
+        with mock.patch.object(fastjson, 'orjson', None):
+            self.assert_renders_like_drf(self.data)
+
+
+# Upstream paths served offline by the fake API, with a limiter of its own so no
+# test waits on the rate limit another one used up
+class FakeAPITestMixin:
+    def start_api(self, **kwargs):
+        api = FakeSpotifyAPI(**kwargs).start()
+        self.addCleanup(api.stop)
+        return api
+
+    def use_api(self, api):
+        for name, value in (('BASE_URL', api.base_url), ('TOKEN_URL', api.token_url)):
+            patcher = mock.patch.object(util, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # A session of the test clients with stored tokens (needs the database)
+    def login(self):
+        session = SessionStore()
+        session.create()
+        util.update_or_create_user_tokens(session.session_key, 'access', 'Bearer', 3600, 'refresh')
+        self.addCleanup(token_cache.delete, session.session_key)
+        for client in (self.client, self.async_client):
+            client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        return session.session_key
+
+    def setUp(self):
+        self.limiter = RateLimiter(rate=1000, burst=1000)
+        patcher = mock.patch.object(util, 'get_rate_limiter', lambda client_id: self.limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        response_cache.clear()
+        self.addCleanup(response_cache.clear)
+        self.tokens = make_tokens()
+
+
+class FakeAPITests(FakeAPITestMixin, SimpleTestCase):
+    def test_large_library_is_paginated(self):
+        api = self.start_api(library=FakeLibrary(playlists=2000, followed_artists=1500, artists=1500))
+        self.use_api(api)
+
+        playlists = fetch_offset_pages('session', '/playlists', page_size=50, tokens=self.tokens)
+        followed = fetch_cursor_pages('session', '/following', {'type': 'artist', 'limit': 50}, tokens=self.tokens)
+
+        self.assertEqual(sum(len(page['items']) for page in playlists), 2000)
+        self.assertEqual(sum(len(page['artists']['items']) for page in followed), 1500)
+        self.assertEqual(api.hits['/v1/me/playlists'], 40)
+        self.assertEqual(api.hits['/v1/me/following'], 30)
+
+    def test_pages_are_capped_at_max_page_size(self):
+        self.use_api(self.start_api(max_page_size=20))
+
+        response = util.execute_spotify_api_request('session', '/tracks', params_={'limit': 50}, tokens=self.tokens)
+
+        self.assertEqual(len(response['items']), 20)
+        self.assertEqual(response['total'], 200)
+
+    def test_top_endpoints(self):
+        self.use_api(self.start_api())
+
+        for endpoint in ('/top/artists', '/top/tracks'):
+            response = util.execute_spotify_api_request('session', endpoint, params_={'limit': 10}, tokens=self.tokens)
+            self.assertEqual(len(response['items']), 10)
+
+    def test_injected_429_is_retried(self):
+        api = self.start_api()
+        self.use_api(api)
+        api.inject_429(retry_after=0)
+
+        response = util.execute_spotify_api_request('session', '/top/artists', tokens=self.tokens)
+
+        self.assertEqual(len(response['items']), 20)
+        self.assertEqual(api.hits['/v1/me/top/artists'], 2)
+        self.assertEqual(api.rate_limited, 1)
+        self.assertEqual(self.limiter.rate_limited, 1)
+
+    def test_every_nth_call_is_rate_limited(self):
+        api = self.start_api(throttle_every=3, retry_after=0)
+        self.use_api(api)
+
+        for _ in range(4):
+            response = util.execute_spotify_api_request('session', '/tracks', bypass_cache=True, tokens=self.tokens)
+            self.assertIn('items', response)
+
+        self.assertEqual(api.hits['/v1/me/tracks'], 5)
+        self.assertEqual(api.rate_limited, 1)
+
+    def test_recorded_calls_replay_offline(self):
+        source = self.start_api()
+        fixtures = Fixtures()
+        recorder = self.start_api(fixtures=fixtures, upstream=source.root_url)
+        self.use_api(recorder)
+        calls = [('/playlists', {'limit': 50, 'offset': 50}), ('/top/tracks', {'limit': 5}), ('', {})]
+        recorded = [util.execute_spotify_api_request('session', endpoint, params_=params, tokens=self.tokens)
+                    for endpoint, params in calls]
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'calls.json')
+        fixtures.save(path)
+        source.stop()
+        response_cache.clear()
+        replay = self.start_api(fixtures=Fixtures.load(path))
+        self.use_api(replay)
+        replayed = [util.execute_spotify_api_request('session', endpoint, params_=params, tokens=self.tokens)
+                    for endpoint, params in calls]
+
+        self.assertEqual(replayed, recorded)
+        missing = util.execute_spotify_api_request('session', '/playlists', params_={'limit': 7}, tokens=self.tokens)
+        self.assertEqual(missing['error']['status'], 404)
+
+    def test_cursor_pages_stop_on_an_error_page(self):
+        self.use_api(self.start_api(fixtures=Fixtures()))
+
+        pages = fetch_cursor_pages('session', '/following', {'type': 'artist', 'limit': 50}, tokens=self.tokens)
+        async_pages = asyncio.run(afetch_cursor_pages('session', '/following', {'type': 'artist', 'limit': 50},
+                                                      tokens=self.tokens))
+
+        self.assertEqual([page['error']['status'] for page in pages + async_pages], [404, 404])
+
+
+class ResponseCacheTests(FakeAPITestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.api = self.start_api()
+        self.use_api(self.api)
+        self.now = 1000.0
+        patcher = mock.patch.object(cache, 'time', mock.Mock(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.statuses = []
+        handle = util.handle_api_response
+        patcher = mock.patch.object(util, 'handle_api_response',
+                                    lambda key, ttl, entry, response: self.statuses.append(response.status_code)
+                                    or handle(key, ttl, entry, response))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, endpoint, session_id='session'):
+        return util.execute_spotify_api_request(session_id, endpoint, tokens=make_tokens(session_id))
+
+    def test_fresh_responses_are_served_from_the_cache(self):
+        first = self.get('/top/tracks')
+        self.now += 6 * 60 * 60 - 1
+
+        self.assertEqual(self.get('/top/tracks'), first)
+        self.assertEqual(self.api.hits['/v1/me/top/tracks'], 1)
+
+    def test_stale_responses_are_revalidated_with_their_etag(self):
+        first = self.get('/player/currently-playing')
+        self.now += 5
+
+        self.assertEqual(self.get('/player/currently-playing'), first)
+        self.assertEqual(self.get('/player/currently-playing'), first)
+        self.assertEqual(self.statuses, [200, 304])
+        self.assertEqual(self.api.hits['/v1/me/player/currently-playing'], 2)
+
+    def test_changed_responses_replace_the_cached_copy(self):
+        self.get('/player/currently-playing')
+        self.api.library.now_playing = {'is_playing': False, 'item': self.api.library.tracks[1]}
+        self.now += 5
+
+        self.assertEqual(self.get('/player/currently-playing')['item']['name'], 'Track 1')
+        self.assertEqual(self.statuses, [200, 200])
+
+    @override_settings(SPOTIFY_CACHE_TTLS={'/top/*': 60})
+    def test_endpoints_without_a_ttl_are_not_cached(self):
+        self.get('/playlists')
+        self.get('/playlists')
+
+        self.assertEqual(self.api.hits['/v1/me/playlists'], 2)
+
+    def test_invalidation_is_per_session(self):
+        for session_id in ('alice', 'bob'):
+            self.get('/top/tracks', session_id)
+            self.get('/top/artists', session_id)
+
+        util.invalidate_user_cache('alice', '/top/tracks')
+        self.get('/top/tracks', 'alice')
+        self.get('/top/artists', 'alice')
+        util.invalidate_user_cache('bob')
+        self.get('/top/tracks', 'bob')
+        self.get('/top/artists', 'bob')
+
+        self.assertEqual(self.api.hits['/v1/me/top/tracks'], 4)
+        self.assertEqual(self.api.hits['/v1/me/top/artists'], 3)
+
+    def test_size_bound_evicts_least_recently_used(self):
+        lru = ResponseCache(max_bytes=100)
+        for key in ('a', 'b'):
+            lru.set((key, '/top/tracks', ()), key, None, 60, 40)
+        lru.get(('a', '/top/tracks', ()))
+        lru.set(('c', '/top/tracks', ()), 'c', None, 60, 40)
+        lru.set(('d', '/top/tracks', ()), 'd', None, 60, 101)
+
+        self.assertEqual([session for session in 'abcd' if lru.get((session, '/top/tracks', ()))], ['a', 'c'])
+        self.assertEqual(lru.size, 80)
+
+
+class RateLimitedViewTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.api = self.start_api()
+        self.use_api(self.api)
+        self.login()
+
+    def test_exhausted_retries_raise(self):
+        self.api.inject_429(count=3, retry_after=0)
+
+        with self.assertRaises(SpotifyRateLimited) as raised:
+            util.execute_spotify_api_request('session', '/top/artists', tokens=self.tokens)
+
+        self.assertEqual(raised.exception.wait, 1)
+        self.assertEqual(self.api.hits['/v1/me/top/artists'], 3)
+
+    def test_views_answer_429_with_retry_after(self):
+        for url in ('/spotify/top-artists', '/spotify/followed-artists', '/spotify/followed-artists?stream=1'):
+            self.api.inject_429(count=3, retry_after=0)
+
+            response = self.client.get(url)
+
+            self.assertEqual(response.status_code, 429, url)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertIn('error', response.json())
+
+    async def test_async_views_answer_429_with_retry_after(self):
+        self.api.inject_429(count=3, retry_after=0)
+
+        response = await self.async_client.get('/spotify/async/followed-artists')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_dashboard_reports_rate_limited_sections(self):
+        self.api.inject_429(count=3, retry_after=0)
+
+        response = self.client.get('/spotify/dashboard?sections=top_artists')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('top_artists', response.json()['errors'])
+
+
+class UpstreamErrorViewTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_api(self.start_api(fixtures=Fixtures()))  # every call answers 404
+        self.login()
+
+    def test_error_responses_are_not_projected(self):
+        for url in ('/spotify/top-tracks', '/spotify/current-user-info', '/spotify/last-saved-songs?all=1',
+                    '/spotify/followed-artists', '/spotify/user-playlists?stream=1'):
+            response = self.client.get(url)
+
+            self.assertEqual(response.status_code, 502, url)
+            self.assertIn('No recorded response', response.json()['error'])
+
+    async def test_async_error_responses_are_not_projected(self):
+        response = await self.async_client.get('/spotify/async/top-tracks')
+
+        self.assertEqual(response.status_code, 502)
+        self.assertIn('No recorded response', response.json()['error'])
+
+
+class ProjectionViewTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.library = FakeLibrary(playlists=60, followed_artists=60)
+        self.use_api(self.start_api(library=self.library))
+        self.login()
+
+    def test_fields_keep_the_requested_order(self):
+        playlists = [p['name'] for p in sorted(self.library.playlists, key=lambda p: p['tracks']['total'], reverse=True)]
+        artists = [a['name'] for a in sorted(self.library.followed, key=lambda a: a['popularity'], reverse=True)]
+
+        response = self.client.get('/spotify/user-playlists?fields=name').json()
+        streamed = b''.join(self.client.get('/spotify/user-playlists?stream=1&sort=1&fields=name').streaming_content)
+        followed = self.client.get('/spotify/followed-artists?fields=name').json()
+
+        self.assertEqual([p['name'] for p in response['user_playlists']], playlists)
+        self.assertEqual([json.loads(line) for line in streamed.splitlines()], [{'name': name} for name in playlists])
+        self.assertEqual(followed['followed_artists'], [{'name': name} for name in artists])
+
+
+class NormalizedViewTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # 120 saved tracks over 40 artists and 30 albums, so both tables de-duplicate
+        self.library = FakeLibrary(saved_tracks=120, artists=40, albums=30)
+        self.use_api(self.start_api(library=self.library))
+        self.login()
+
+    def assert_normalized(self, payload, key, items):
+        tracks = payload[key]
+        self.assertEqual([track['id'] for track in tracks], [item['id'] for item in items])
+        self.assertEqual(set(payload['artists']), {a['id'] for item in items for a in item['artists']})
+        self.assertEqual(set(payload['albums']), {item['album']['id'] for item in items})
+        for track, item in zip(tracks, items):
+            self.assertEqual(track['artists'], [a['id'] for a in item['artists']])
+            self.assertEqual(track['album'], item['album']['id'])
+        artist = items[0]['artists'][0]
+        self.assertEqual(payload['artists'][artist['id']]['name'], artist['name'])
+        self.assertEqual(payload['albums'][items[0]['album']['id']]['name'], items[0]['album']['name'])
+
+    def test_saved_songs(self):
+        payload = self.client.get('/spotify/last-saved-songs?all=1&format=normalized').json()
+
+        self.assert_normalized(payload, 'saved_songs', [item['track'] for item in self.library.saved])
+        self.assertEqual((len(payload['artists']), len(payload['albums'])), (40, 30))
+        self.assertEqual([track['added_at'] for track in payload['saved_songs']],
+                         [get_formatted_date(item['added_at']) for item in self.library.saved])
+
+    def test_top_tracks_and_history(self):
+        top = self.client.get('/spotify/top-tracks?format=normalized').json()
+        history = self.client.get('/spotify/get-songs-history?format=normalized').json()
+
+        self.assert_normalized(top, 'top_tracks', self.library.tracks[:20])
+        self.assert_normalized(history, 'last_played_songs', [item['track'] for _, item in self.library.plays][:20])
+        self.assertNotIn('added_at', top['top_tracks'][0])
+
+    def test_enriched_artists(self):
+        payload = self.client.get('/spotify/top-tracks?format=normalized&enrich=1').json()
+
+        artist = self.library.artists[0]
+        self.assertEqual(payload['artists'][artist['id']]['genres'], artist['genres'])
+
+    async def test_async_views_match(self):
+        for url in ('last-saved-songs?all=1&format=normalized', 'top-tracks?format=normalized',
+                    'get-songs-history?format=normalized&enrich=1'):
+            response = await self.async_client.get('/spotify/async/' + url)
+            expected = await self.async_client.get('/spotify/' + url)
+
+            self.assertEqual(response.json(), expected.json(), url)
+
+
+class EnrichmentTests(FakeAPITestMixin, TestCase):
+    url = '/spotify/last-saved-songs?all=1&enrich=1&refresh=1'
+
+    def setUp(self):
+        super().setUp()
+        # 120 saved tracks by 120 different artists
+        self.library = FakeLibrary(saved_tracks=120, artists=120)
+        self.api = self.start_api(library=self.library)
+        self.use_api(self.api)
+        self.login()
+        get_enrichment_cache().clear()
+        self.addCleanup(get_enrichment_cache().clear)
+
+    def test_artists_are_fetched_in_batches_once(self):
+        cold = self.client.get(self.url).json()['saved_songs']
+        self.assertEqual(self.api.hits['/v1/artists'], 3)
+
+        warm = self.client.get(self.url).json()['saved_songs']
+        self.assertEqual(self.api.hits['/v1/artists'], 3)
+        self.assertNotIn('/v1/tracks', self.api.hits)
+
+        self.assertEqual(cold, warm)
+        artist = self.library.artists[7]
+        self.assertEqual(cold[7]['artists'][0]['genres'], artist['genres'])
+        self.assertEqual(cold[7]['artists'][0]['thumbnail'], artist['images'][0]['url'])
+
+    async def test_async_artists_are_fetched_in_batches(self):
+        response = await self.async_client.get('/spotify/async/last-saved-songs?all=1&enrich=1')
+
+        self.assertEqual(len(response.json()['saved_songs']), 120)
+        self.assertEqual(self.api.hits['/v1/artists'], 3)
+
+
+class DashboardTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.library = FakeLibrary()
+        self.use_api(self.start_api(library=self.library))
+        self.login()
+
+    def test_nothing_playing_is_not_an_error(self):
+        self.library.now_playing = None
+
+        for url in ('/spotify/dashboard', '/spotify/async/dashboard'):
+            response = self.client.get(url + '?sections=current_song,user_info').json()
+
+            self.assertIsNone(response['current_song'], url)
+            self.assertEqual(response['errors'], {}, url)
+            self.assertEqual(self.client.get('/spotify/get-current-song').json(), {'current_song': None})
+
+
+class AsyncClientTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_api(self.start_api())
+        self.login()
+
+    def test_clients_of_wsgi_requests_are_closed(self):
+        built = []
+        build = client.build_async_client
+        with mock.patch.object(client, 'build_async_client', lambda: built.append(build()) or built[-1]):
+            for _ in range(3):
+                self.assertEqual(self.client.get('/spotify/async/top-tracks').status_code, 200)
+
+        self.assertEqual(len(built), 3)
+        self.assertTrue(all(http.is_closed for http in built))
+        self.assertEqual(len(client._async_clients), 0)
+
+    async def test_one_client_per_loop(self):
+        self.assertIs(client.get_async_client(), client.get_async_client())
+
+
+class FakeTokenEndpointTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        util.update_or_create_user_tokens('session', 'expired', 'Bearer', -60, 'refresh')
+        self.addCleanup(token_cache.delete, 'session')
+
+    def test_expired_tokens_are_refreshed(self):
+        api = self.start_api()
+        self.use_api(api)
+
+        tokens = util.refresh_spotify_token('session')
+
+        self.assertTrue(tokens.access_token.startswith('access-'))
+        self.assertEqual(tokens.refresh_token, 'refresh')
+        self.assertEqual(api.hits['/api/token'], 1)
+
+    def refresh_with(self, **response):
+        post = mock.Mock(side_effect=response.pop('error')) if 'error' in response else \
+            mock.Mock(return_value=mock.Mock(**response))
+        with mock.patch.object(util, 'get_session', lambda: mock.Mock(post=post)), self.assertLogs('spotify.util', 'WARNING'):
+            self.assertIsNone(util.refresh_spotify_token('session'))
+        return SpotifyToken.objects.get(user='session').refresh_failures
+
+    def test_rejected_refresh_tokens_are_counted(self):
+        self.assertEqual(self.refresh_with(status_code=400, content=b'{"error": "invalid_grant"}'), 1)
+        self.assertEqual(self.refresh_with(status_code=400, content=b'{"error": "invalid_grant"}'), 2)
+
+    def test_transient_refresh_failures_are_not_counted(self):
+        for response in ({'status_code': 500, 'content': b'{"error": "server_error"}'},
+                         {'status_code': 429, 'content': b''},
+                         {'status_code': 502, 'content': b'<html>Bad gateway</html>'},
+                         {'status_code': 400, 'content': b'{"error": "invalid_client"}'},
+                         {'error': requests.Timeout('read timeout')}):
+            self.assertEqual(self.refresh_with(**response), 0, response)
+
+    def test_recorded_token_responses_are_scrubbed(self):
+        source = self.start_api()
+        fixtures = Fixtures()
+        self.use_api(self.start_api(fixtures=fixtures, upstream=source.root_url))
+
+        tokens = util.refresh_spotify_token('session')
+
+        self.assertTrue(tokens.access_token.startswith('access-'))
+        self.assertEqual(fixtures.get('POST /api/token')[1]['access_token'], 'recorded-access-token')
+
+
+class TokenCacheTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.api = self.start_api(library=FakeLibrary(playlists=120))
+        self.use_api(self.api)
+        self.session_id = self.login()
+
+    def token_queries(self, queries):
+        return [query['sql'] for query in queries if 'spotify_spotifytoken' in query['sql']]
+
+    def test_repeated_lookups_skip_the_database(self):
+        token_cache.delete(self.session_id)
+
+        with self.assertNumQueries(1):
+            util.get_user_tokens(self.session_id)
+        with self.assertNumQueries(0):
+            util.get_user_tokens(self.session_id)
+            util.is_spotify_authenticated(self.session_id)
+
+    def test_paginated_views_read_the_tokens_once(self):
+        token_cache.delete(self.session_id)
+
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(len(self.client.get('/spotify/user-playlists?refresh=1').json()['user_playlists']), 120)
+        with CaptureQueriesContext(connection) as second:
+            self.client.get('/spotify/user-playlists?refresh=1')
+
+        self.assertEqual(self.api.hits['/v1/me/playlists'], 6)
+        self.assertEqual(len(self.token_queries(first)), 1)
+        self.assertEqual(self.token_queries(second), [])
+
+    def test_refreshed_tokens_are_written_through(self):
+        util.update_or_create_user_tokens(self.session_id, 'expired', 'Bearer', -60, 'refresh')
+
+        refreshed = util.get_valid_tokens(self.session_id)
+
+        self.assertTrue(refreshed.access_token.startswith('access-'))
+        with self.assertNumQueries(0):
+            self.assertEqual(util.get_user_tokens(self.session_id).access_token, refreshed.access_token)
+
+    def test_deleted_tokens_are_dropped(self):
+        util.get_user_tokens(self.session_id)
+
+        delete_in_batches(SpotifyToken.objects.filter(user=self.session_id))
+
+        with self.assertNumQueries(1):
+            self.assertIsNone(util.get_user_tokens(self.session_id))
+
+
+class TokenListTests(TestCase):
+    def setUp(self):
+        for i in range(5):
+            SpotifyToken.objects.create(user=f'session-{i}', token_type='Bearer', access_token='access',
+                                        refresh_token='refresh', expires_in=timezone.now())
+        self.ids = list(SpotifyToken.objects.order_by('id').values_list('id', flat=True))
+        caches['default'].delete(COUNT_CACHE_KEY)
+
+    def get(self, **params):
+        return self.client.get('/spotify/get-all-tokens', params)
+
+    def test_pages_follow_the_cursor_to_the_last_page(self):
+        seen, after, cursors = [], None, []
+        while True:
+            page = self.get(limit=2, fields='user', **({'after': after} if after else {})).json()
+            self.assertEqual(page['count'], 5)
+            seen += page['results']
+            after = page['next']
+            cursors.append(after)
+            if after is None:
+                break
+
+        self.assertEqual(seen, [{'id': i, 'user': f'session-{n}'} for n, i in enumerate(self.ids)])
+        self.assertEqual(cursors, [self.ids[1], self.ids[3], None])
+
+    def test_a_full_last_page_has_no_next_cursor(self):
+        self.assertEqual(self.get(limit=5).json()['next'], None)
+        self.assertEqual(self.get(after=self.ids[-1]).json(), {'count': 5, 'results': [], 'next': None})
+
+    def test_export_streams_every_row(self):
+        body = b''.join(self.get(export=1, fields='user').streaming_content)
+
+        self.assertEqual([json.loads(line) for line in body.splitlines()],
+                         [{'id': i, 'user': f'session-{n}'} for n, i in enumerate(self.ids)])
+
+    def test_invalid_parameters_are_rejected(self):
+        for params in ({'limit': 'abc'}, {'after': 'abc'}, {'after': '1.5'}):
+            response = self.get(**params)
+
+            self.assertEqual(response.status_code, 400, params)
+            self.assertEqual(response.json(), {'error': 'Invalid limit or cursor.'})
+        self.assertEqual(self.get(fields='user,password').json(), {'error': 'Unknown fields: password.'})
+
+
+class CatalogTests(TestCase):
+    def setUp(self):
+        self.library = FakeLibrary(playlists=5, artists=20, albums=10)
+        self.tokens = SpotifyToken.objects.create(user='catalog-a', access_token='a', refresh_token='a', token_type='Bearer',
+                                                  expires_in=timezone.now())
+        self.other = SpotifyToken.objects.create(user='catalog-b', access_token='b', refresh_token='b', token_type='Bearer',
+                                                 expires_in=timezone.now())
+
+    def test_shared_objects_are_stored_once(self):
+        ingest_top_tracks(self.tokens, self.library.tracks[:10])
+        ingest_top_tracks(self.other, self.library.tracks[:10] + self.library.tracks[:2])
+
+        self.assertEqual(Track.objects.count(), 10)
+        self.assertEqual(TrackArtist.objects.count(), 10)
+        self.assertEqual(TopTrack.objects.filter(token=self.other).count(), 10)
+
+    def test_track_artists_keep_the_full_artist_fields(self):
+        ingest_top_artists(self.tokens, self.library.artists[:1])
+        ingest_top_tracks(self.tokens, self.library.tracks[:1])
+
+        artist = Artist.objects.get(id=self.library.artists[0]['id'])
+        self.assertEqual(artist.genres, self.library.artists[0]['genres'])
+        self.assertEqual(artist.popularity, self.library.artists[0]['popularity'])
+
+    def test_snapshots_are_replaced(self):
+        tracks, playlists = self.library.tracks, self.library.playlists
+        ingest_top_tracks(self.tokens, tracks[:3])
+        ingest_top_tracks(self.tokens, [tracks[3], tracks[2]])
+        ingest_playlists(self.tokens, playlists[:3])
+        ingest_playlists(self.tokens, playlists[2:4])
+
+        top = TopTrack.objects.filter(token=self.tokens).order_by('rank').values_list('track_id', flat=True)
+        self.assertEqual(list(top), [tracks[3]['id'], tracks[2]['id']])
+        self.assertEqual(set(UserPlaylist.objects.filter(token=self.tokens).values_list('playlist_id', flat=True)),
+                         {playlists[2]['id'], playlists[3]['id']})
+
+
+# sync_sessions fetches on worker threads, which can't see a TestCase transaction
+class CatalogSyncTests(FakeAPITestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(taste, '_index', TasteIndex(directory.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.api = self.start_api(library=FakeLibrary(playlists=120, followed_artists=80))
+        self.use_api(self.api)
+        self.stored = util.update_or_create_user_tokens('sync', 'access', 'Bearer', 3600, 'refresh')
+        self.addCleanup(token_cache.delete, 'sync')
+
+    def stored_catalog(self):
+        return [model.objects.filter(token=self.stored).count() for model in (TopTrack, TopArtist, FollowedArtist, UserPlaylist)]
+
+    def test_catalog_is_synced(self):
+        self.assertEqual(sync_sessions(['catalog']), (1, 0))
+        self.assertEqual(self.stored_catalog(), [50, 50, 80, 120])
+
+    def test_error_responses_keep_the_stored_catalog(self):
+        sync_sessions(['catalog'])
+        self.use_api(self.start_api(fixtures=Fixtures()))  # every call answers 404
+
+        with self.assertLogs('spotify.sync', 'ERROR'):
+            self.assertEqual(sync_sessions(['catalog']), (0, 1))
+        self.assertEqual(self.stored_catalog(), [50, 50, 80, 120])
+
+    def test_rate_limited_fetch_keeps_the_stored_catalog(self):
+        sync_sessions(['catalog'])
+        self.api.inject_429(count=3, retry_after=0)
+
+        with self.assertLogs('spotify.sync', 'ERROR'):
+            self.assertEqual(sync_sessions(['catalog']), (0, 1))
+        self.assertEqual(self.stored_catalog(), [50, 50, 80, 120])
+
+
+class HistorySyncTests(FakeAPITestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.library = FakeLibrary(plays=50)
+        self.api = self.start_api(library=self.library)
+        self.use_api(self.api)
+        self.stored = util.update_or_create_user_tokens('history', 'access', 'Bearer', 3600, 'refresh')
+        self.addCleanup(token_cache.delete, 'history')
+
+    def test_only_new_plays_are_fetched(self):
+        self.assertEqual(sync_sessions(['history']), (1, 0))
+        self.assertEqual(PlayHistory.objects.filter(token=self.stored).count(), 50)
+
+        latest = datetime(2030, 1, 1, tzinfo=dt_timezone.utc)
+        for minutes in range(3):
+            self.library.play(self.library.tracks[minutes], latest + timedelta(minutes=minutes))
+        self.api.reset_hits()
+        self.assertEqual(sync_sessions(['history']), (1, 0))
+
+        self.assertEqual(PlayHistory.objects.filter(token=self.stored).count(), 53)
+        self.assertEqual(self.api.hits['/v1/me/player/recently-played'], 1)
+
+    def test_played_artists_are_stored_with_their_genres(self):
+        get_enrichment_cache().clear()
+        self.addCleanup(get_enrichment_cache().clear)
+        self.addCleanup(get_analytics_cache().delete, analytics_cache_key(self.stored))
+        followed = self.library.artists[3]
+        upsert_artists([followed])
+
+        self.assertEqual(sync_sessions(['history']), (1, 0))
+
+        self.assertEqual(self.api.hits['/v1/artists'], 1)
+        stored = Artist.objects.get(id=followed['id'])
+        self.assertEqual((stored.genres, stored.followers), (followed['genres'], followed['followers']['total']))
+        analytics = listening_analytics(self.stored)
+        self.assertEqual(analytics['genre_coverage'], 1.0)
+        self.assertEqual(analytics['top_genres'][0]['plays'], 10)
+
+    def test_sessions_are_synced_in_batches(self):
+        for i in range(4):
+            util.update_or_create_user_tokens(f'history-{i}', 'access', 'Bearer', 3600, 'refresh')
+            self.addCleanup(token_cache.delete, f'history-{i}')
+
+        self.assertEqual(sync_sessions(['history'], workers=2, batch_size=2), (5, 0))
+        self.assertEqual(PlayHistory.objects.count(), 250)
+
+    def test_local_history_pages_through_every_play(self):
+        sync_sessions(['history'])
+
+        played, before = [], None
+        while True:
+            page = local_songs_history(self.stored, before, limit=20)
+            played += [track['played_at'] for track in page['last_played_songs']]
+            before = page['next']
+            if before is None:
+                break
+
+        self.assertEqual(len(played), 50)
+        self.assertEqual(played, sorted(set(played), reverse=True))
+        self.assertEqual(local_songs_history(self.stored, to_cursor(played[-1]), limit=20),
+                         {'last_played_songs': [], 'next': None})
+
+    def test_out_of_range_cursors_are_rejected(self):
+        self.login()
+
+        for url in ('/spotify/get-songs-history', '/spotify/last-saved-songs'):
+            for before in ('99999999999999999999', '-99999999999999999999', 'abc'):
+                response = self.client.get(url, {'source': 'local', 'before': before})
+
+                self.assertEqual(response.status_code, 400, (url, before))
+                self.assertEqual(response.json(), {'error': 'Invalid limit or cursor.'})
+
+
+@override_settings(SPOTIFY_LIBRARY_RECONCILE_INTERVAL=0)
+class LibrarySyncTests(FakeAPITestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.library = FakeLibrary(saved_tracks=120)
+        self.api = self.start_api(library=self.library)
+        self.use_api(self.api)
+        self.stored = util.update_or_create_user_tokens('library', 'access', 'Bearer', 3600, 'refresh')
+        self.addCleanup(token_cache.delete, 'library')
+        sync_sessions(['library'])
+        self.reconciled = SyncState.objects.get(token=self.stored, job='library').last_full_sync
+
+    def saved_count(self):
+        return SavedTrack.objects.filter(token=self.stored).count()
+
+    @override_settings(SPOTIFY_LIBRARY_RECONCILE_INTERVAL=3600)
+    def test_only_new_saved_tracks_are_fetched(self):
+        added = datetime(2030, 1, 1, tzinfo=dt_timezone.utc)
+        new_tracks = [self.library.make_track(1000 + i) for i in range(3)]
+        for i, track in enumerate(new_tracks):
+            self.library.save(track, added + timedelta(minutes=i))
+        self.library.saved.insert(1, {'added_at': '2030-01-01T00:00:30Z', 'track': None})
+        self.api.reset_hits()
+
+        self.assertEqual(sync_sessions(['library']), (1, 0))
+
+        self.assertEqual(self.api.hits['/v1/me/tracks'], 1)
+        self.assertEqual(self.saved_count(), 123)
+        self.assertEqual(set(SavedTrack.objects.filter(token=self.stored, added_at__gte=added).values_list('track_id', flat=True)),
+                         {track['id'] for track in new_tracks})
+        self.assertEqual(SyncState.objects.get(token=self.stored, job='library').last_full_sync, self.reconciled)
+
+    def test_reconcile_prunes_removed_tracks(self):
+        self.library.unsave(self.library.saved[5]['track'])
+
+        self.assertEqual(sync_sessions(['library']), (1, 0))
+        self.assertEqual(self.saved_count(), 119)
+        self.assertGreater(SyncState.objects.get(token=self.stored, job='library').last_full_sync, self.reconciled)
+
+    def test_rate_limited_reconcile_keeps_the_library(self):
+        self.api.inject_429(count=100, retry_after=0)
+
+        with self.assertLogs('spotify.sync', 'ERROR'):
+            self.assertEqual(sync_sessions(['library']), (0, 1))
+        self.assertEqual(self.saved_count(), 120)
+        self.assertEqual(SyncState.objects.get(token=self.stored, job='library').last_full_sync, self.reconciled)
+
+    def test_error_page_skips_the_prune(self):
+        fetch_offset_pages = sync.fetch_offset_pages
+
+        def failing_page(*args, **kwargs):
+            pages = fetch_offset_pages(*args, **kwargs)
+            pages[1] = {'error': {'status': 500, 'message': 'Server error'}}
+            return pages
+
+        with mock.patch.object(sync, 'fetch_offset_pages', failing_page), self.assertLogs('spotify.sync', 'WARNING'):
+            self.assertEqual(sync_sessions(['library']), (1, 0))
+        self.assertEqual(self.saved_count(), 120)
+        self.assertEqual(SyncState.objects.get(token=self.stored, job='library').last_full_sync, self.reconciled)
+
+
+class AnalyticsTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.login()
+        self.stored = SpotifyToken.objects.get()
+        self.addCleanup(get_analytics_cache().delete, analytics_cache_key(self.stored))
+        now = timezone.now()
+        ingest_plays(self.stored, [{'track': track, 'played_at': (now - timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ')}
+                                   for i, track in enumerate(FakeLibrary().tracks[:10])])
+
+    def test_requires_stored_tokens(self):
+        self.client.cookies.clear()
+
+        self.assertEqual(self.client.get('/spotify/listening-analytics').status_code, 401)
+
+    def test_days_must_be_positive(self):
+        for days in ('0', '-3', 'week'):
+            self.assertEqual(self.client.get(f'/spotify/listening-analytics?days={days}').status_code, 400, days)
+        self.assertEqual(self.client.get('/spotify/listening-analytics?days=1').json()['plays'], 10)
+
+    def test_cached_results_are_bounded(self):
+        for days in range(1, 3 * MAX_CACHED_RESULTS):
+            listening_analytics(self.stored, days)
+
+        columns = get_analytics_cache().get(analytics_cache_key(self.stored))
+        self.assertEqual(len(columns.results), MAX_CACHED_RESULTS)
+        self.assertIn(3 * MAX_CACHED_RESULTS - 1, columns.results)
+
+
+class TasteIndexTests(FakeAPITestMixin, TestCase):
+    def test_similar_users_requires_stored_tokens(self):
+        self.assertEqual(self.client.get('/spotify/similar-users').status_code, 401)
+
+    # Two instances over one directory stand in for two processes: only the file
+    # lock keeps their read-modify-writes of rows.json from losing rows
+    def test_concurrent_writers_keep_every_row(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        writers = [TasteIndex(directory.name, dimensions=16) for _ in range(2)]
+
+        def write(i):
+            writers[i % 2].update(i, {f'artist:{i}': 1.0})
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(write, range(64)))
+
+        index = TasteIndex(directory.name, dimensions=16)
+        self.assertEqual(index.token_ids(), {str(i) for i in range(64)})
+
+
+class SweeperTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(taste, '_index', TasteIndex(directory.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def store(self, session_id, expires_in=3600, refresh_failures=0):
+        tokens = util.update_or_create_user_tokens(session_id, 'access', 'Bearer', expires_in, 'refresh')
+        self.addCleanup(token_cache.delete, session_id)
+        SpotifyToken.objects.filter(pk=tokens.pk).update(refresh_failures=refresh_failures)
+        return tokens
+
+    def live_session(self):
+        session = SessionStore()
+        session.create()
+        return session.session_key
+
+    def test_orphaned_and_dead_tokens_are_deleted(self):
+        kept = self.store(self.live_session())
+        failing_but_valid = self.store(self.live_session(), refresh_failures=5)
+        self.store('expired-session')
+        self.store(self.live_session(), expires_in=-60, refresh_failures=3)
+        taste.get_taste_index().update(kept.pk, {'artist:a': 1.0})
+
+        self.assertEqual(sweep_tokens(batch_size=1, grace=0), {'orphaned': 1, 'dead': 1})
+        self.assertEqual(set(SpotifyToken.objects.values_list('pk', flat=True)), {kept.pk, failing_but_valid.pk})
+        self.assertIsNone(token_cache.get('expired-session'))
+        self.assertEqual(taste.get_taste_index().token_ids(), {str(kept.pk)})
+
+    def test_new_tokens_get_a_grace_period(self):
+        self.store('session-being-created')
+
+        self.assertEqual(sweep_tokens(), {'orphaned': 0, 'dead': 0})
+
+
+class NowPlayingStreamTests(FakeAPITestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_api(self.start_api())
+        self.session_id = self.login()
+
+    def test_wsgi_requests_get_one_event(self):
+        response = self.client.get('/spotify/get-current-song/stream')
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertFalse(response.streaming)
+        body = response.content.decode()
+        self.assertTrue(body.startswith('retry: '))
+        self.assertEqual(body.count('event: current_song'), 1)
+        self.assertIn('Track 0', body)
+
+    async def test_closing_the_stream_stops_the_poller(self):
+        stream = stream_now_playing(self.session_id)
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+        self.assertIn(b'event: current_song', await anext(stream))
+
+        registry = nowplaying._pollers[asyncio.get_running_loop()]
+        poller = registry[self.session_id]
+        task = poller.task
+        await stream.aclose()
+        await asyncio.gather(task, return_exceptions=True)
+
+        self.assertNotIn(self.session_id, registry)
+        self.assertEqual(poller.subscribers, set())
+        self.assertTrue(task.cancelled())
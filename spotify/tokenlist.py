@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.cache import caches
+from .models import SpotifyToken
+
+# Listing of the token table for admin & ops tooling. Pages are keyset-paginated on
+# id and read only the requested columns with .values(), the export streams every
+# row through .iterator() so memory stays flat however large the table is.
+
+TOKEN_FIELDS = ('id', 'user', 'token_type', 'access_token', 'refresh_token', 'expires_in', 'created_at')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK_SIZE = 2000
+DEFAULT_COUNT_TTL = 60
+COUNT_CACHE_KEY = 'spotify:token-count'
+
+
+# Columns from ?fields=a,b (all of them when empty). Raises ValueError naming any
+# unknown column.
+def parse_token_fields(value):
+    if not value:
+        return TOKEN_FIELDS
+
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in TOKEN_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}.")
+    return tuple(dict.fromkeys(['id', *fields]))
+
+
+# One page of tokens with id > after. The cursor of the next page is the last id,
+# None on the last page.
+def token_page(after=None, limit=DEFAULT_PAGE_SIZE, fields=TOKEN_FIELDS):
+    tokens = SpotifyToken.objects.order_by('id')
+    if after is not None:
+        tokens = tokens.filter(id__gt=after)
+    rows = list(tokens.values(*fields)[:limit + 1])
+
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# Every token, read from the database EXPORT_CHUNK_SIZE rows at a time
+def iter_token_export(fields=TOKEN_FIELDS):
+    return SpotifyToken.objects.order_by('id').values(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+# Row count of the token table, cached for SPOTIFY_TOKEN_COUNT_TTL seconds so that
+# paging doesn't run a full COUNT(*) per page
+def get_token_count():
+    cache = caches[getattr(settings, 'SPOTIFY_TOKEN_COUNT_CACHE_ALIAS', 'default')]
+    count = cache.get(COUNT_CACHE_KEY)
+    if count is None:
+        count = SpotifyToken.objects.count()
+        cache.set(COUNT_CACHE_KEY, count, getattr(settings, 'SPOTIFY_TOKEN_COUNT_TTL', DEFAULT_COUNT_TTL))
+    return count
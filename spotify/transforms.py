@@ -0,0 +1,274 @@
+from .projection import Projection, Each, Apply
+from .metrics import timed
+from .errors import check_response
+
+# Transforms from raw Spotify API responses to the payloads served by the views.
+# The build_* functions are shared by the sync and async views. Each payload item
+# is described by a projection spec (see spotify/projection.py), and `fields` keeps
+# only some of its fields (?fields=name,artists.name). The time spent in the build_*
+# functions is reported as the request's transform time (see spotify/metrics.py).
+# Error responses are never projected: they raise SpotifyAPIError (spotify/errors.py),
+# which the views answer with its status instead of an empty payload.
+
+
+# "2024-01-31T10:00:00Z" -> "31-01-2024", by slicing since strptime dominated the
+# cost of transforming saved songs
+def get_formatted_date(date) -> str:
+    if not isinstance(date, str) or len(date) < 10 or date[4] != '-' or date[7] != '-':
+        return None
+    return f'{date[8:10]}-{date[5:7]}-{date[:4]}'
+
+
+ARTIST = Projection({
+    'name':'name',
+    'profile_url':'external_urls.spotify',
+})
+
+USER_INFO = Projection({
+    'username':'display_name',
+    'profile_url':'external_urls.spotify',
+    'thumbail':'images.-1.url',
+    'followers':'followers.total',
+})
+
+TRACK = Projection({
+    'name':'name',
+    'artists':Each('artists', ARTIST),
+    'album':'album.name',
+    'thumbnail':'album.images.0.url',
+    'song_url':'external_urls.spotify',
+})
+
+CURRENT_SONG = Projection({
+    'name':'item.name',
+    'artists':Each('item.artists', ARTIST),
+    'album':'item.album.name',
+    'thumbnail':'item.album.images.0.url',
+    'song_url':'item.external_urls.spotify',
+    'is_playing':'is_playing',
+})
+
+PLAYED_TRACK = Projection({
+    'name':'track.name',
+    'artists':Each('track.artists', ARTIST),
+    'album':'track.album.name',
+    'thumbnail':'track.album.images.0.url',
+    'song_url':'track.external_urls.spotify',
+})
+
+SAVED_TRACK = Projection({
+    'name':'track.name',
+    'added_at':Apply('added_at', get_formatted_date),
+    'artists':Each('track.artists', ARTIST),
+    'song_url':'track.external_urls.spotify',
+})
+
+# Payloads of enriched responses (?enrich=1, see spotify/enrichment.py): artists
+# carry their genres and image
+ENRICHED_ARTIST = Projection({
+    **ARTIST.spec,
+    'genres':'genres',
+    'thumbnail':'images.0.url',
+})
+
+ENRICHED_TRACK = Projection({**TRACK.spec, 'artists':Each('artists', ENRICHED_ARTIST)})
+ENRICHED_PLAYED_TRACK = Projection({**PLAYED_TRACK.spec, 'artists':Each('track.artists', ENRICHED_ARTIST)})
+ENRICHED_SAVED_TRACK = Projection({**SAVED_TRACK.spec, 'artists':Each('track.artists', ENRICHED_ARTIST)})
+
+TOP_ARTIST = Projection({
+    'name':'name',
+    'artist_url':'external_urls.spotify',
+    'genres':'genres',
+    'thumbnail':'images.0.url',
+    'followers':'followers.total',
+    'popularity':'popularity',
+})
+
+PLAYLIST = Projection({
+    'name':'name',
+    'total_songs':'tracks.total',
+    'playlist_url':'external_urls.spotify',
+    'owner':'owner.display_name',
+    'owner_url':'owner.external_urls.spotify',
+    'is_public':'public',
+    'thumbnail':'images.0.url',
+})
+
+FOLLOWED_ARTIST = Projection({
+    'name':'name',
+    'artist_url':'external_urls.spotify',
+    'followers':'followers.total',
+    'rank':'popularity',
+    'thumbnail':'images.0.url',
+})
+
+
+# Normalized payloads (?format=normalized): tracks reference their artists and album
+# by id, each artist and album appears once in the top-level tables
+ALBUM = Projection({
+    'name':'name',
+    'thumbnail':'images.0.url',
+})
+
+
+def get_ids(objects) -> list:
+    return [obj.get('id') for obj in objects if isinstance(obj, dict)] if isinstance(objects, list) else []
+
+
+NORMALIZED_TRACK = Projection({
+    'id':'id',
+    'name':'name',
+    'artists':Apply('artists', get_ids),
+    'album':'album.id',
+    'song_url':'external_urls.spotify',
+})
+
+
+# Payload with `items` under `key` as normalized tracks, track_path locates the track
+# in an item, `extra` adds item fields (e.g. added_at) to each track
+def build_normalized(key, items, track_path=None, extra=None, fields=None, enriched=False) -> dict:
+    project = NORMALIZED_TRACK.compile(fields)
+    project_artist = ENRICHED_ARTIST if enriched else ARTIST
+    track_list = []
+    artists = {}
+    albums = {}
+
+    for item in items:
+        track = item.get(track_path) if track_path else item
+        if not isinstance(track, dict):
+            continue
+
+        track_info = project(track)
+        if extra is not None:
+            track_info.update(extra(item))
+        track_list.append(track_info)
+
+        for artist in track.get('artists') or []:
+            if isinstance(artist, dict) and artist.get('id') not in artists:
+                artists[artist.get('id')] = project_artist(artist)
+        album = track.get('album')
+        if isinstance(album, dict) and album.get('id') not in albums:
+            albums[album.get('id')] = ALBUM(album)
+
+    return {key:track_list, 'artists':artists, 'albums':albums}
+
+
+def get_items(response) -> list:
+    return (check_response(response) or {}).get('items') or []
+
+
+# User profile
+@timed('transform')
+def build_user_info(response, fields=None) -> dict:
+    return {'user_info':USER_INFO.compile(fields)(check_response(response))}
+
+
+# Currently playing song (None when nothing is playing)
+@timed('transform')
+def build_current_song(response, fields=None) -> dict:
+    if not (check_response(response) or {}).get('item'):
+        return {'current_song':None}
+    return {'current_song':CURRENT_SONG.compile(fields)(response)}
+
+
+# Recently played songs
+@timed('transform')
+def build_songs_history(response, fields=None, normalized=False, enriched=False) -> dict:
+    if normalized:
+        return build_normalized('last_played_songs', get_items(response), 'track', fields=fields, enriched=enriched)
+    projection = ENRICHED_PLAYED_TRACK if enriched else PLAYED_TRACK
+    return {'last_played_songs':projection.many(get_items(response), fields)}
+
+
+# Top artists & top genres
+@timed('transform')
+def build_top_artists(response, fields=None) -> dict:
+    items = get_items(response)
+    all_genres = {}
+
+    # Adding votes to each genre
+    for artist in items:
+        for genre in artist.get('genres') or []:
+            all_genres[genre] = all_genres.get(genre, 0) + 1
+
+    # Getting the top 10 genres in list format
+    all_genres_sorted = sorted(all_genres.items(), key=lambda kv: kv[1], reverse=True)[:10]
+    genres_list = [x[0] for x in all_genres_sorted]
+
+    return {'top_artists':TOP_ARTIST.many(items, fields), 'top_genres':genres_list}
+
+
+# Top tracks
+@timed('transform')
+def build_top_tracks(response, fields=None, normalized=False, enriched=False) -> dict:
+    if normalized:
+        return build_normalized('top_tracks', get_items(response), fields=fields, enriched=enriched)
+    projection = ENRICHED_TRACK if enriched else TRACK
+    return {'top_tracks':projection.many(get_items(response), fields)}
+
+
+def get_added_at(item) -> dict:
+    return {'added_at':get_formatted_date(item.get('added_at'))}
+
+
+# Saved songs, from one or more /tracks pages
+@timed('transform')
+def build_saved_songs(pages, fields=None, normalized=False, enriched=False) -> dict:
+    if normalized:
+        return build_normalized('saved_songs', [item for response in pages for item in get_items(response)],
+                                'track', get_added_at, fields, enriched)
+    project = (ENRICHED_SAVED_TRACK if enriched else SAVED_TRACK).compile(fields)
+    return {'saved_songs':[project(item) for response in pages for item in get_items(response)]}
+
+
+# Named playlists page by page as they arrive, unprojected
+def iter_playlist_items(pages):
+    for response in pages:
+        for playlist in get_items(response):
+            if playlist.get('name'):
+                yield playlist
+
+
+# Sort raw playlists biggest first (before projecting, ?fields= may leave out the size)
+def sort_playlists(playlists) -> list:
+    return sorted(playlists, key=lambda kv: (kv.get('tracks') or {}).get('total') or 0, reverse=True)
+
+
+# Playlists page by page as they're transformed. With sort every page is read and
+# sorted right away, the projection still runs lazily.
+def iter_user_playlists(pages, fields=None, sort=False):
+    playlists = iter_playlist_items(pages)
+    if sort:
+        playlists = sort_playlists(playlists)
+    return map(PLAYLIST.compile(fields), playlists)
+
+
+# Playlists from every /playlists page, biggest first
+@timed('transform')
+def build_user_playlists(pages, fields=None) -> dict:
+    return {'user_playlists':list(iter_user_playlists(pages, fields, sort=True))}
+
+
+# Followed artists page by page as they arrive, unprojected
+def iter_followed_artist_items(pages):
+    for response in pages:
+        yield from get_items((check_response(response) or {}).get('artists'))
+
+
+# Sort raw artists most popular first (before projecting, like sort_playlists)
+def sort_followed_artists(artists) -> list:
+    return sorted(artists, key=lambda kv: kv.get('popularity') or 0, reverse=True)
+
+
+# Followed artists page by page as they're transformed, sorted like iter_user_playlists
+def iter_followed_artists(pages, fields=None, sort=False):
+    artists = iter_followed_artist_items(pages)
+    if sort:
+        artists = sort_followed_artists(artists)
+    return map(FOLLOWED_ARTIST.compile(fields), artists)
+
+
+# Followed artists from every /following page, most popular first
+@timed('transform')
+def build_followed_artists(pages, fields=None) -> dict:
+    return {'followed_artists':list(iter_followed_artists(pages, fields, sort=True))}
@@ -1,5 +1,6 @@
 from django.urls import path
 from .views import *
+from . import async_views
 
 app_name = 'spotify'
 
@@ -9,6 +10,7 @@ urlpatterns = [
     path('is-authenticated', IsAuthenticated.as_view(), name='is-authenticated'),
     path('get-all-tokens', ListAllTokens.as_view(), name='all-tokens'),
     path('get-current-song', CurrentSong.as_view(), name='current-song'),
+    path('get-current-song/stream', async_views.current_song_stream, name='current-song-stream'),
     path('get-songs-history', SongsHistory.as_view(), name='songs-history'),
     path('top-artists', TopArtists.as_view(), name='top-artists'),
     path('top-tracks', TopTracks.as_view(), name='top-tracks'),
@@ -16,4 +18,20 @@ urlpatterns = [
     path('last-saved-songs', LastSavedSongs.as_view(), name='last-saved-songs'),
     path('user-playlists', GetUserPlaylists.as_view(), name='user-playlists'),
     path('followed-artists', GetFollowedArtists.as_view(), name='followed-artists'),
+    path('dashboard', Dashboard.as_view(), name='dashboard'),
+    path('rate-limit-status', RateLimitStatus.as_view(), name='rate-limit-status'),
+    path('listening-analytics', ListeningAnalytics.as_view(), name='listening-analytics'),
+    path('similar-users', SimilarUsers.as_view(), name='similar-users'),
+
+    # Async (ASGI) versions of the views above
+    path('async/is-authenticated', async_views.is_authenticated, name='async-is-authenticated'),
+    path('async/get-current-song', async_views.current_song, name='async-current-song'),
+    path('async/get-songs-history', async_views.songs_history, name='async-songs-history'),
+    path('async/top-artists', async_views.top_artists, name='async-top-artists'),
+    path('async/top-tracks', async_views.top_tracks, name='async-top-tracks'),
+    path('async/current-user-info', async_views.user_info, name='async-current-user-info'),
+    path('async/last-saved-songs', async_views.last_saved_songs, name='async-last-saved-songs'),
+    path('async/user-playlists', async_views.user_playlists, name='async-user-playlists'),
+    path('async/followed-artists', async_views.followed_artists, name='async-followed-artists'),
+    path('async/dashboard', async_views.dashboard, name='async-dashboard'),
 ]
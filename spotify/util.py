@@ -1,9 +1,23 @@
 from .models import SpotifyToken
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
 from django.utils import timezone
 from datetime import timedelta
-from requests import post, put, get
+from concurrent.futures import ThreadPoolExecutor
+from .cache import response_cache, token_cache, make_cache_key, get_cache_ttl
+from .client import get_session, get_timeout, get_async_client
+from .ratelimit import get_rate_limiter, retry_after_seconds, INTERACTIVE
+from .singleflight import SingleFlight, AsyncSingleFlight
+from .projection import parse_fields
+from .fastjson import loads
+from .errors import SpotifyRateLimited
 from dotenv import load_dotenv
+import logging
+import math
 import os
+import requests
 
 # Global variables
 load_dotenv()
@@ -11,89 +25,344 @@ CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 BASE_URL = os.getenv("BASE_URL")
+API_URL = os.getenv("API_URL")
+TOKEN_URL = os.getenv("TOKEN_URL", "https://accounts.spotify.com/api/token")
+
+logger = logging.getLogger(__name__)
+token_refreshes = SingleFlight()
+upstream_calls = SingleFlight()
+async_upstream_calls = AsyncSingleFlight()
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='spotify-refresh')
 
 
 # Verify is there're saved tokens associated to an user session
+# Served from the token cache, the database is only read on a miss
 def get_user_tokens(session_id):
     
-    user_tokens = SpotifyToken.objects.filter(user=session_id)
-    if user_tokens.exists():
-        return user_tokens[0]
-    return None
+    tokens = token_cache.get(session_id)
+    if tokens is None:
+        tokens = SpotifyToken.objects.filter(user=session_id).first()
+        if tokens is not None:
+            token_cache.set(session_id, tokens)
+    return tokens
+
+
+# Async counterpart of get_user_tokens
+async def aget_user_tokens(session_id):
 
+    tokens = token_cache.get(session_id)
+    if tokens is None:
+        tokens = await SpotifyToken.objects.filter(user=session_id).afirst()
+        if tokens is not None:
+            token_cache.set(session_id, tokens)
+    return tokens
 
-# Create new tokens or update existing ones
+
+# Create new tokens or update existing ones (written through to the token cache)
+# The token endpoint may omit refresh_token on refresh, the stored one is kept then.
 def update_or_create_user_tokens(session_id, access_token, token_type, expires_in, refresh_token):
     
-    tokens = get_user_tokens(session_id)
+    tokens = SpotifyToken.objects.filter(user=session_id).first()
     expires_in = timezone.now() + timedelta(seconds=expires_in)
     
     if tokens:
         tokens.access_token = access_token
-        tokens.refresh_token = refresh_token
+        tokens.refresh_token = refresh_token or tokens.refresh_token
         tokens.expires_in = expires_in
         tokens.token_type = token_type
-        tokens.save(update_fields=['access_token', 'refresh_token', 'expires_in','token_type'])
+        tokens.refresh_failures = 0
+        tokens.save(update_fields=['access_token', 'refresh_token', 'expires_in','token_type', 'refresh_failures'])
     else:
         tokens = SpotifyToken(user=session_id, access_token=access_token, refresh_token=refresh_token, token_type=token_type, expires_in=expires_in)
         tokens.save()
 
+    token_cache.set(session_id, tokens)
+    return tokens
+
 
 # Check if user is authenticated (false if else) & its token hasn't expired (refresh if else)
 def is_spotify_authenticated(session_id):
     
-    tokens = get_user_tokens(session_id)
-    print(tokens) # --> DEBUG
+    tokens = get_valid_tokens(session_id)
 
     if tokens:
-        expiry = tokens.expires_in
-        if expiry <= timezone.now():
-            refresh_spotify_token(session_id)
         return (True, tokens)
-    return False
+    return (False, None)
+
+
+# Return the session tokens, refreshed if they have expired. Tokens close to expiry
+# are refreshed in the background so the request doesn't wait on the token endpoint.
+def get_valid_tokens(session_id, tokens=None):
+
+    if tokens is None:
+        tokens = get_user_tokens(session_id)
+    if tokens is None:
+        return None
+
+    now = timezone.now()
+    if tokens.expires_in <= now:
+        return refresh_spotify_token(session_id) or tokens
+    if tokens.expires_in <= now + timedelta(seconds=get_refresh_lead()):
+        refresh_in_background(session_id)
+    return tokens
+
+
+# Async counterpart of get_valid_tokens
+async def aget_valid_tokens(session_id, tokens=None):
+
+    if tokens is None:
+        tokens = await aget_user_tokens(session_id)
+    if tokens is None:
+        return None
+
+    now = timezone.now()
+    if tokens.expires_in <= now:
+        return await sync_to_async(refresh_spotify_token)(session_id) or tokens
+    if tokens.expires_in <= now + timedelta(seconds=get_refresh_lead()):
+        refresh_in_background(session_id)
+    return tokens
+
+
+# Seconds before expiry at which tokens become due for refresh
+def get_refresh_lead():
+    return getattr(settings, 'SPOTIFY_TOKEN_REFRESH_LEAD', 5 * 60)
 
 
 # Refresh spotify token
-def refresh_spotify_token(session_id):
-    refresh_token = get_user_tokens(session_id).refresh_token
-
-    response = post('https://accounts.spotify.com/api/token',
-                    data = {
-                        'grant_type':'refresh_token',
-                        'refresh_token':refresh_token,
-                        'client_id': CLIENT_ID,
-                        'client_secret': CLIENT_SECRET
-                })
-    
-    access_token = response.get('access_token')
-    token_type = response.get('token_type')
-    expires_in = response.get('expires_in')
-    refresh_token = response.get('refresh_token')
+# Single-flight per session: concurrent callers share one token endpoint call
+def refresh_spotify_token(session_id, lead=None):
+    return token_refreshes.do(session_id, _refresh_spotify_token, session_id, lead)
+
+
+def _refresh_spotify_token(session_id, lead=None):
+    tokens = SpotifyToken.objects.filter(user=session_id).first()
+    if tokens is None:
+        return None
+
+    # Another worker may already have refreshed them
+    lead = get_refresh_lead() if lead is None else lead
+    if tokens.expires_in > timezone.now() + timedelta(seconds=lead):
+        token_cache.set(session_id, tokens)
+        return tokens
+
+    try:
+        response = get_session().post(TOKEN_URL,
+                        data = {
+                            'grant_type':'refresh_token',
+                            'refresh_token':tokens.refresh_token,
+                            'client_id': CLIENT_ID,
+                            'client_secret': CLIENT_SECRET
+                    }, timeout=get_timeout())
+    except requests.RequestException as e:
+        logger.warning('Token refresh failed for session %s: %r', session_id, e)
+        return None
 
-    update_or_create_user_tokens(session_id, access_token, token_type, expires_in, refresh_token)
+    try:
+        data = loads(response.content)
+    except ValueError:
+        data = {}
+
+    access_token = data.get('access_token')
+    token_type = data.get('token_type')
+    expires_in = data.get('expires_in')
+    refresh_token = data.get('refresh_token')
+
+    # Only a refresh token the endpoint rejects (400 invalid_grant) is counted, the
+    # sweeper deletes tokens that keep failing. Outages, 429s and unreadable bodies
+    # are retried on the next request.
+    if not access_token:
+        logger.warning('Token refresh failed for session %s: %s %s', session_id, response.status_code, data.get('error'))
+        if response.status_code == 400 and data.get('error') == 'invalid_grant':
+            SpotifyToken.objects.filter(pk=tokens.pk).update(refresh_failures=F('refresh_failures') + 1)
+        return None
+
+    return update_or_create_user_tokens(session_id, access_token, token_type, expires_in, refresh_token)
+
+
+# Queue a refresh without waiting for it, skipped if one is already running
+def refresh_in_background(session_id):
+    if not token_refreshes.in_flight(session_id):
+        refresh_executor.submit(_background_refresh, session_id)
+
+
+def _background_refresh(session_id):
+    try:
+        refresh_spotify_token(session_id)
+    except Exception:
+        logger.exception('Background token refresh failed for session %s', session_id)
+    finally:
+        close_old_connections()
+
+
+# Root of the catalog endpoints (/artists, /tracks...), BASE_URL points at /v1/me
+def get_api_root():
+    return API_URL or BASE_URL.rsplit('/me', 1)[0]
 
 
 # Perform request to Spotify API endpoint
-def execute_spotify_api_request(session_id, endpoint, post_=False, put_=False, params_={}):
+# GET responses are cached per session (see spotify/cache.py), bypass_cache skips
+# the cached copy but still stores the fresh response. Paginated views load the
+# tokens once and pass them in for every page. Every upstream call goes through
+# the client's rate limiter at the given priority and is retried after a 429.
+# Raises SpotifyRateLimited when Spotify still answers 429 after the last retry.
+# base_url replaces BASE_URL (get_api_root() for catalog endpoints), such calls are
+# keyed by their full URL so they never pick up the TTL of a /me endpoint.
+def execute_spotify_api_request(session_id, endpoint, post_=False, put_=False, params_={}, bypass_cache=False, tokens=None, priority=INTERACTIVE, base_url=None):
     
-    tokens = get_user_tokens(session_id)
-    
-    headers = {
-        'Content-Type':'application/json',
-        'Authorization': f'Bearer {tokens.access_token}'
-    }
+    url = (base_url or BASE_URL) + endpoint
+    tokens = get_valid_tokens(session_id, tokens)
+    headers = get_request_headers(tokens)
     
+    http = get_session()
+    timeout = get_timeout()
+    limiter = get_rate_limiter(CLIENT_ID)
+
     if post_:
-        post(BASE_URL + endpoint, headers = headers)
+        limiter.acquire(priority)
+        http.post(url, headers = headers, timeout=timeout)
     
     if put_:
-        put(BASE_URL + endpoint, headers = headers)
-    
-    
-    response = get(BASE_URL + endpoint, headers=headers, params=params_)
-    print(response.url)
+        limiter.acquire(priority)
+        http.put(url, headers = headers, timeout=timeout)
+
+    key, ttl, entry = lookup_cached_response(session_id, url if base_url else endpoint, params_, headers, mutated=post_ or put_)
+    if entry is not None and entry.is_fresh() and not bypass_cache:
+        return entry.value
+
+    # Identical concurrent calls share one upstream request
+    return upstream_calls.do(key, fetch_api_response, http, limiter, priority, url,
+                             headers, params_, timeout, key, ttl, entry)
+
+
+# GET an endpoint through the rate limiter, retrying after 429s, and parse the result
+def fetch_api_response(http, limiter, priority, url, headers, params_, timeout, key, ttl, entry):
+    attempt = 0
+    while True:
+        limiter.acquire(priority)
+        response = http.get(url, headers=headers, params=params_, timeout=timeout)
+        logger.debug('GET %s -> %s', response.url, response.status_code)
+
+        if response.status_code != 429 or not limiter.backoff(response.headers.get('Retry-After'), attempt):
+            break
+        attempt += 1
+
+    return handle_api_response(key, ttl, entry, response)
+
+
+# Async counterpart of execute_spotify_api_request, used by the ASGI views
+async def aexecute_spotify_api_request(session_id, endpoint, post_=False, put_=False, params_={}, bypass_cache=False, tokens=None, priority=INTERACTIVE, base_url=None):
+
+    url = (base_url or BASE_URL) + endpoint
+    tokens = await aget_valid_tokens(session_id, tokens)
+    headers = get_request_headers(tokens)
+
+    http = get_async_client()
+    limiter = get_rate_limiter(CLIENT_ID)
+
+    if post_:
+        await limiter.aacquire(priority)
+        await http.post(url, headers = headers)
+
+    if put_:
+        await limiter.aacquire(priority)
+        await http.put(url, headers = headers)
+
+    key, ttl, entry = lookup_cached_response(session_id, url if base_url else endpoint, params_, headers, mutated=post_ or put_)
+    if entry is not None and entry.is_fresh() and not bypass_cache:
+        return entry.value
+
+    # Identical concurrent calls share one upstream request
+    return await async_upstream_calls.do(key, afetch_api_response, http, limiter, priority, url,
+                                         headers, params_, key, ttl, entry)
+
+
+# Async counterpart of fetch_api_response
+async def afetch_api_response(http, limiter, priority, url, headers, params_, key, ttl, entry):
+    attempt = 0
+    while True:
+        await limiter.aacquire(priority)
+        response = await http.get(url, headers=headers, params=params_)
+
+        if response.status_code != 429 or not limiter.backoff(response.headers.get('Retry-After'), attempt):
+            break
+        attempt += 1
+
+    return handle_api_response(key, ttl, entry, response)
+
+
+def get_request_headers(tokens):
+    return {
+        'Content-Type':'application/json',
+        'Authorization': f'Bearer {tokens.access_token}'
+    }
+
+
+# Find the cached response for a GET, adding If-None-Match when it's stale.
+# Returns (cache key, ttl, entry or None), a ttl of 0 means don't cache.
+def lookup_cached_response(session_id, endpoint, params_, headers, mutated=False):
+    if mutated:
+        response_cache.invalidate(session_id)
+        ttl = 0
+    else:
+        ttl = get_cache_ttl(endpoint)
+
+    key = make_cache_key(session_id, endpoint, params_)
+    entry = response_cache.get(key) if ttl else None
+
+    if entry is not None and entry.etag:
+        headers['If-None-Match'] = entry.etag
+    return key, ttl, entry
+
+
+# Parse an upstream response (requests or httpx) and keep it in the response cache.
+# A 429 left after the last retry raises SpotifyRateLimited instead of passing the
+# error body on as data.
+def handle_api_response(key, ttl, entry, response):
+    if response.status_code == 429:
+        raise SpotifyRateLimited(max(math.ceil(retry_after_seconds(response.headers.get('Retry-After'))), 1))
+
+    if entry is not None and response.status_code == 304:
+        response_cache.revalidate(key, ttl)
+        return entry.value
+
+    # No content (e.g. currently-playing when nothing plays) is an empty result, not an error
+    if response.status_code == 204:
+        return {}
 
     try:
-        return response.json()
+        data = loads(response.content)
     except:
-        return ({'error':'Request error.'})
\ No newline at end of file
+        return ({'error':'Request error.'})
+
+    if ttl and response.status_code == 200:
+        response_cache.set(key, data, response.headers.get('ETag'), ttl, len(response.content))
+    return data
+
+
+# Drop cached responses for a session, optionally only for one endpoint
+def invalidate_user_cache(session_id, endpoint=None):
+    response_cache.invalidate(session_id, endpoint)
+
+
+# Whether a boolean query parameter is set (?name=1 or ?name=true)
+def query_flag(request, name):
+    return request.GET.get(name) in ('1', 'true')
+
+
+# Whether the client asked to skip cached upstream responses (?refresh=1)
+def cache_bypassed(request):
+    return query_flag(request, 'refresh')
+
+
+# Fields the client asked for (?fields=name,artists.name), None for all of them
+def requested_fields(request):
+    return parse_fields(request.GET.get('fields'))
+
+
+# Whether the client asked for the normalized payload (?format=normalized). APIViews
+# get it through DRF's format override, plain (async) views from the query string.
+def normalized_requested(request):
+    renderer = getattr(request, 'accepted_renderer', None)
+    if renderer is not None:
+        return renderer.format == 'normalized'
+    return request.GET.get('format') == 'normalized'
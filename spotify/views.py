@@ -1,13 +1,25 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import redirect
+from django.http import HttpResponse
 from dotenv import load_dotenv
-from datetime import datetime
-from requests import Request, post
+from requests import Request
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from .serializers import SpotifyTokensSerializer
-from .models import SpotifyToken
 from .util import *
+from .pagination import fetch_offset_pages, fetch_cursor_pages, iter_offset_pages, iter_cursor_pages, with_first_page
+from .streaming import ndjson_response
+from .renderers import with_normalized
+from .ratelimit import get_rate_limit_stats
+from .analytics import listening_analytics
+from .metrics import render_metrics
+from .enrichment import enrich_pages
+from .taste import similar_users
+from .tokenlist import parse_token_fields, token_page, iter_token_export, get_token_count, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from .catalog import local_top_tracks, local_top_artists, local_songs_history, local_saved_songs
+from .transforms import *
+from .dashboard import build_dashboard, parse_sections
 import os
 
 # Global variables
@@ -57,15 +69,16 @@ def spotify_callback(request, format=None):
     error = request.GET.get('error')
 
     # Performing post petition
-    response = post(
-                'https://accounts.spotify.com/api/token',
+    response = get_session().post(
+                TOKEN_URL,
                 data = {
                     'grant_type' : 'authorization_code',
                     'code' : code,
                     'redirect_uri' : REDIRECT_URI,
                     'client_id': CLIENT_ID,
                     'client_secret': CLIENT_SECRET,
-                }
+                },
+                timeout=get_timeout()
             ).json()
 
     # Fetching data from response
@@ -79,7 +92,8 @@ def spotify_callback(request, format=None):
     if not request.session.exists(request.session.session_key):
         request.session.create()
 
-    # Saving tokens on the database
+    # Saving tokens on the database, responses cached for a previous login are dropped
+    invalidate_user_cache(request.session.session_key)
     update_or_create_user_tokens(request.session.session_key, access_token=access_token, token_type=token_type, expires_in=expires_in, refresh_token=refresh_token)
 
     return redirect("frontend:index")
@@ -97,32 +111,41 @@ class IsAuthenticated(APIView):
                         status.HTTP_200_OK)
 
 
-# List all session tokens stored on Database
+# List session tokens stored on Database, a page at a time: ?limit=, ?after=<next>,
+# ?fields=user,expires_in picks columns. ?export=1 streams every token as NDJSON.
 class ListAllTokens(APIView):
 
     def get(self, request, format=None):
-        all_tokens = SpotifyToken.objects.all()
-        serializer = SpotifyTokensSerializer(all_tokens, many=True)
-        return Response(serializer.data, status.HTTP_200_OK)
+        try:
+            fields = parse_token_fields(request.GET.get('fields'))
+        except ValueError as e:
+            return Response({'error':str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.GET.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+            after = int(request.GET['after']) if request.GET.get('after') else None
+        except ValueError:
+            return Response({'error':'Invalid limit or cursor.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        if query_flag(request, 'export'):
+            return ndjson_response(iter_token_export(fields))
+
+        tokens, next_cursor = token_page(after, limit, fields)
+        return Response({'count':get_token_count(), 'results':tokens, 'next':next_cursor}, status.HTTP_200_OK)
+
+
+# Views answered from the Spotify API take ?fields= to return only some fields of
+# each item, e.g. top-tracks?fields=name,artists.name. Track lists also take
+# ?format=normalized: artists & albums in top-level tables keyed by id.
+# When Spotify keeps rate limiting they answer 429 with Retry-After (see spotify/errors.py).
 
 # Retrieve User Info
 class UserInfo(APIView):
     def get(self, request, fotmat=None):
         user_session = self.request.session.session_key
         endpoint = ""
-        response = execute_spotify_api_request(user_session, endpoint)
-
-        # Fetch important info
-        user_info = {
-            'username': response.get('display_name'),
-            'profile_url': response.get('external_urls').get('spotify'),
-            'thumbail': response.get('images')[-1].get('url'),
-            'followers':response.get('followers').get('total')
-        }
+        response = execute_spotify_api_request(user_session, endpoint, bypass_cache=cache_bypassed(request))
 
-
-        return Response({'user_info':user_info}, status=status.HTTP_200_OK)
+        return Response(build_user_info(response, requested_fields(request)), status=status.HTTP_200_OK)
             
 
 # Retrieving current playing song from Spotify API
@@ -130,214 +153,189 @@ class CurrentSong(APIView):
     def get(self, request, format=None):
         user_session = self.request.session.session_key
         endpoint = "/player/currently-playing"
-        response = execute_spotify_api_request(user_session, endpoint)
-
-        current_song = {
-            'name': response.get('item').get('name'),
-            'artists':get_all_artists(response.get('item').get('artists')),
-            'album':response.get('item').get('album').get('name'),
-            'thumbnail':response.get('item').get('album').get('images')[0].get('url'),
-            'song_url':response.get('item').get('external_urls').get('spotify'),
-            'is_playing':response.get('is_playing')
-        }
-        
-        return Response({'current_song':current_song}, status=status.HTTP_200_OK)
+        response = execute_spotify_api_request(user_session, endpoint, bypass_cache=cache_bypassed(request))
+
+        return Response(build_current_song(response, requested_fields(request)), status=status.HTTP_200_OK)
 
 
 # Get user last played songs
+# ?source=local pages through the whole synced history: ?limit=, ?before=<next cursor>
+# ?enrich=1 adds the genres and image of each artist (see spotify/enrichment.py)
 class SongsHistory(APIView):
+    renderer_classes = with_normalized(api_settings.DEFAULT_RENDERER_CLASSES)
+
     def get(self, request, format=None):
         user_session = self.request.session.session_key
+        if request.GET.get('source') == 'local':
+            try:
+                limit = min(max(int(request.GET.get('limit', 50)), 1), 500)
+                history = local_songs_history(get_user_tokens(user_session), request.GET.get('before'), limit)
+            except ValueError:
+                return Response({'error':'Invalid limit or cursor.'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(history, status=status.HTTP_200_OK)
+
         endpoint = "/player/recently-played"
-        response = execute_spotify_api_request(user_session, endpoint)
-        
-        track_list = []
-
-        for track in response.get('items'):
-            track_info = {
-                'name': track.get('track').get('name'),
-                'artists':get_all_artists(track.get('track').get('artists')),
-                'album':track.get('track').get('album').get('name'),
-                'thumbnail':track.get('track').get('album').get('images')[0].get('url'),
-                'song_url':track.get('track').get('external_urls').get('spotify'),
-            }
-            track_list.append(track_info)
+        response = execute_spotify_api_request(user_session, endpoint, bypass_cache=cache_bypassed(request))
+        enrich = query_flag(request, 'enrich')
+        if enrich:
+            response = enrich_pages(user_session, [response], 'track')[0]
 
-        return Response({'last_played_songs':track_list}, status=status.HTTP_200_OK)
+        return Response(build_songs_history(response, requested_fields(request), normalized_requested(request), enrich), status=status.HTTP_200_OK)
 
 
-# Get user top Artists & Top Genres
+# Get user top Artists & Top Genres (?source=local answers from the synced catalog)
 class TopArtists(APIView):
     def get(self, request, format=None):
         user_session = self.request.session.session_key
-        endpoint = "/top/artists"
-        response = execute_spotify_api_request(user_session, endpoint)
-
-        artists_list = []
-        all_genres = {}
-
-        # Gettin artist info
-        for artist in response.get('items'):
-            artist = {
-                'name':artist.get('name'),
-                'artist_url':artist.get('external_urls').get('spotify'),
-                'genres':artist.get('genres'),
-                'thumbnail':artist.get('images')[0].get('url'),
-                'followers':artist.get('followers').get('total'),
-                'popularity':artist.get('popularity')
-            }
+        if request.GET.get('source') == 'local':
+            return Response(local_top_artists(get_user_tokens(user_session)), status=status.HTTP_200_OK)
 
-            artists_list.append(artist)
-            
-            # Adding votes to each genre
-            for genre in artist.get('genres'):
-                if genre in all_genres:
-                    all_genres[genre] += 1
-                else:
-                    all_genres[genre] = 1
-
-            # Getting the top 10 genres in list format
-            all_genres_sorted = sorted(all_genres.items(), key=lambda kv: kv[1], reverse=True)[:10]
-            genres_list = [x[0] for x in all_genres_sorted]
+        endpoint = "/top/artists"
+        response = execute_spotify_api_request(user_session, endpoint, bypass_cache=cache_bypassed(request))
 
-        return Response({'top_artists':artists_list, 'top_genres':genres_list}, status=status.HTTP_200_OK)
+        return Response(build_top_artists(response, requested_fields(request)), status=status.HTTP_200_OK)
 
 
-# Get user top tracks
+# Get user top tracks (?source=local answers from the synced catalog)
+# ?enrich=1 adds the genres and image of each artist
 class TopTracks(APIView):
-    
+    renderer_classes = with_normalized(api_settings.DEFAULT_RENDERER_CLASSES)
+
     def get(self, request, format=None):
         user_session = self.request.session.session_key
+        if request.GET.get('source') == 'local':
+            return Response(local_top_tracks(get_user_tokens(user_session)), status=status.HTTP_200_OK)
+
         endpoint = "/top/tracks"
-        response = execute_spotify_api_request(user_session, endpoint)
-        
-        track_list = []
-
-        for track in response.get('items'):
-            track_info = {
-                'name': track.get('name'),
-                'artists':get_all_artists(track.get('artists')),
-                'album':track.get('album').get('name'),
-                'thumbnail':track.get('album').get('images')[0].get('url'),
-                'song_url':track.get('external_urls').get('spotify'),
-            }
-            track_list.append(track_info)
+        response = execute_spotify_api_request(user_session, endpoint, bypass_cache=cache_bypassed(request))
+        enrich = query_flag(request, 'enrich')
+        if enrich:
+            response = enrich_pages(user_session, [response])[0]
 
-        return Response({'top_tracks':track_list}, status=status.HTTP_200_OK)
+        return Response(build_top_tracks(response, requested_fields(request), normalized_requested(request), enrich), status=status.HTTP_200_OK)
     
 
-# Get user last saved songs
+# Get user last saved songs (?all=1 returns the whole library, ?enrich=1 adds artist genres and images)
+# ?source=local serves the synced library: ?q= searches track/album/artist names,
+# ?artist=<id> filters by artist, ?limit= and ?before=<next cursor> page through it
 class LastSavedSongs(APIView):
+    renderer_classes = with_normalized(api_settings.DEFAULT_RENDERER_CLASSES)
+
     def get(self, request, format=None):
         user_session = self.request.session.session_key
         endpoint = "/tracks"
-        params = {'limit':10}
-        response = execute_spotify_api_request(user_session, endpoint, params_=params)
-
-        track_list = []
-        for track in response.get('items'):
-
-            track_info = {
-                'name':track.get('track').get('name'),
-                'added_at':get_formatted_date(track.get('added_at')),
-                'artists':get_all_artists(track.get('track').get('artists')),
-                'song_url':track.get('track').get('external_urls').get('spotify'),
-            }
 
-            track_list.append(track_info)
+        if request.GET.get('source') == 'local':
+            try:
+                limit = min(max(int(request.GET.get('limit', 50)), 1), 500)
+                saved = local_saved_songs(get_user_tokens(user_session), request.GET.get('q'),
+                                          request.GET.get('artist'), request.GET.get('before'), limit)
+            except ValueError:
+                return Response({'error':'Invalid limit or cursor.'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(saved, status=status.HTTP_200_OK)
 
-        return Response({'saved_songs':track_list}, status=status.HTTP_200_OK)
+        if request.GET.get('all') in ('1', 'true'):
+            pages = fetch_offset_pages(user_session, endpoint, page_size=50, bypass_cache=cache_bypassed(request))
+        else:
+            params = {'limit':10}
+            pages = [execute_spotify_api_request(user_session, endpoint, params_=params, bypass_cache=cache_bypassed(request))]
+        enrich = query_flag(request, 'enrich')
+        if enrich:
+            pages = enrich_pages(user_session, pages, 'track')
 
-
-def get_all_artists(artists) -> list:
-    artists_list = []
-
-    for artist in artists:
-        artist_info = {
-            'name':artist.get('name'),
-            'profile_url':artist.get('external_urls').get('spotify')
-        }
-        artists_list.append(artist_info)
-    
-    return artists_list
-
-def get_formatted_date(date) -> str:
-    date = datetime.strptime(date,"%Y-%m-%dT%H:%M:%SZ")
-    return (date.strftime("%d-%m-%Y"))
-
-def get_playlist_list(response) -> list:
-    playlists = []
-
-    for playlist in response.get('items'):
-        playlist_info = {
-            'name': playlist.get('name'),
-            'total_songs':playlist.get('tracks').get('total'),
-            'playlist_url':playlist.get('external_urls').get('spotify'),
-            'owner':playlist.get('owner').get('display_name'),
-            'owner_url':playlist.get('owner').get('external_urls').get('spotify'),
-            'is_public':playlist.get('public'),
-            'thumbnail':playlist.get('images')[0].get('url')
-        }
-        playlists.append(playlist_info)
-    
-    return playlists
-
-def get_followed_artists(response) -> list:
-    artists = []
-
-    for artist in response:
-        artist_info = {
-            'name':artist.get('name'),
-            'artist_url':artist.get('external_urls').get('spotify'),
-            'followers':artist.get('followers').get('total'),
-            'rank':artist.get('popularity'),
-        }
-        if len(artist.get('images')) > 0:
-            artist_info['thumbnail'] = artist.get('images')[0].get('url')
-        artists.append(artist_info)
-    
-    return artists
+        return Response(build_saved_songs(pages, requested_fields(request), normalized_requested(request), enrich), status=status.HTTP_200_OK)
 
 
 # Get user seved playlists
+# ?stream=1 streams them as NDJSON while pages arrive, ?sort=1 sorts the stream first
 class GetUserPlaylists(APIView):
     def get(self, request, format=None):
         user_session = self.request.session.session_key
         endpoint = "/playlists"
-        params = {'limit':50, 'offset':0}
+        tokens = get_user_tokens(user_session)
 
-        response = execute_spotify_api_request(user_session, endpoint, params_=params)
+        if query_flag(request, 'stream'):
+            pages = with_first_page(iter_offset_pages(user_session, endpoint, page_size=50, tokens=tokens,
+                                                      bypass_cache=cache_bypassed(request)))
+            return ndjson_response(iter_user_playlists(pages, requested_fields(request), query_flag(request, 'sort')))
 
-        playlists = get_playlist_list(response)
-    
-        while params['offset'] <= response.get('total'):
-            params['offset'] += 50
-            response = execute_spotify_api_request(user_session, endpoint, params_=params)
-            playlists += get_playlist_list(response)
+        pages = fetch_offset_pages(user_session, endpoint, page_size=50, tokens=tokens, bypass_cache=cache_bypassed(request))
 
-        playlists = [p for p in playlists if p['name'] != ""]
-        playlists_sorted = sorted(playlists, key=lambda kv: kv['total_songs'], reverse=True)
-
-        return Response({'user_playlists':playlists_sorted}, status=status.HTTP_200_OK)
+        return Response(build_user_playlists(pages, requested_fields(request)), status=status.HTTP_200_OK)
 
 # Get user followed artists
+# ?stream=1 streams them as NDJSON while pages arrive, ?sort=1 sorts the stream first
 class GetFollowedArtists(APIView):
     def get(self, request, format=None):
         user_session = self.request.session.session_key
         endpoint = "/following"
+        tokens = get_user_tokens(user_session)
         params = {'type':'artist','limit':50}
-        
-        response = execute_spotify_api_request(user_session, endpoint, params_=params)
-        
-        followed_artists = get_followed_artists(response.get('artists').get('items'))
 
-        params['after'] = response.get('artists').get('items')[-1].get('id')
+        if query_flag(request, 'stream'):
+            pages = with_first_page(iter_cursor_pages(user_session, endpoint, params, tokens=tokens,
+                                                      bypass_cache=cache_bypassed(request)))
+            return ndjson_response(iter_followed_artists(pages, requested_fields(request), query_flag(request, 'sort')))
+
+        pages = fetch_cursor_pages(user_session, endpoint, params, tokens=tokens, bypass_cache=cache_bypassed(request))
+
+        return Response(build_followed_artists(pages, requested_fields(request)), status=status.HTTP_200_OK)
+
+
+# All dashboard sections in one response, fetched concurrently (?sections= picks them)
+class Dashboard(APIView):
+    def get(self, request, format=None):
+        try:
+            sections = parse_sections(request.GET.get('sections'))
+        except ValueError as e:
+            return Response({'error':str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        dashboard = build_dashboard(request.session.session_key, sections, bypass_cache=cache_bypassed(request))
+        if dashboard is None:
+            return Response({'error':'Not authenticated.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        return Response(dashboard, status=status.HTTP_200_OK)
+
+
+# Upstream rate limiter queue depth and throttle counters
+class RateLimitStatus(APIView):
+    def get(self, request, format=None):
+        return Response({'rate_limits':get_rate_limit_stats()}, status=status.HTTP_200_OK)
+
+
+# Genre/artist distributions, listening heatmaps and trends over the synced play
+# history (`manage.py sync_spotify history`), ?days= (at least 1) limits the distributions
+class ListeningAnalytics(APIView):
+    def get(self, request, format=None):
+        tokens = get_user_tokens(self.request.session.session_key)
+        if tokens is None:
+            return Response({'error':'Not authenticated.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            days = int(request.GET['days']) if request.GET.get('days') else None
+            if days is not None and days < 1:
+                raise ValueError(days)
+        except ValueError:
+            return Response({'error':'Invalid days.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(listening_analytics(tokens, days), status=status.HTTP_200_OK)
+
+
+# Stored users whose top artists & genres are closest to this user's (?k= results)
+class SimilarUsers(APIView):
+    def get(self, request, format=None):
+        tokens = get_user_tokens(self.request.session.session_key)
+        if tokens is None:
+            return Response({'error':'Not authenticated.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            k = min(max(int(request.GET.get('k', 10)), 1), 100)
+        except ValueError:
+            return Response({'error':'Invalid k.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        while len(followed_artists) < response.get('artists').get('total'):
-            response = execute_spotify_api_request(user_session, endpoint, params_=params)
-            followed_artists += get_followed_artists(response.get('artists').get('items'))
-            params['after'] = response.get('artists').get('items')[-1].get('id')
+        return Response(similar_users(tokens, k), status=status.HTTP_200_OK)
 
-        sorted_artists = sorted(followed_artists, key=lambda kv: kv["rank"], reverse=True)
 
-        return Response({'followed_artists':sorted_artists}, status=status.HTTP_200_OK)
\ No newline at end of file
+# Request and upstream histograms of this process, in the Prometheus text format
+def metrics(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')